@@ -0,0 +1,247 @@
+"""
+Construction benchmark: how building the circuits scales with the code distance.
+
+Every (case, distance) runs in its own python process, which reports its wall time (best of --repeats),
+its peak RSS and the size of the circuit it built. The results are compared with a stored baseline and checked
+for super-linear scaling of the time in the circuit size.
+Times are compared as ratios to a reference build timed in the same process (see reference_build), and memory
+as the growth of the peak RSS during the case, so that the baseline carries over to other machines.
+The baseline can also be regenerated locally with --update-baseline before changing the builders.
+
+Run from data_collection:
+    python -m benchmark.construction                          # compare with benchmark/baseline.json
+    python -m benchmark.construction --update-baseline        # record a new baseline
+    python -m benchmark.construction --cases magicd2 --distances 7 15 31
+"""
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+
+DISTANCES = [3, 5, 7, 11, 15, 21, 31, 41, 51]
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+TOLERANCE = 1.5  # allowed ratio to the baseline, for time and peak RSS
+MAX_SLOPE = 1.25  # allowed exponent of time ~ size^slope over the larger distances
+MIN_SECONDS = 0.01  # shorter times are too noisy for the scaling check
+MIN_COMPARE_SECONDS = 0.05  # shorter times are too noisy to compare with the baseline
+MIN_RSS_GROWTH_MB = 8  # smaller growths of the peak RSS are not compared
+ERROR_RATE = 0.001
+
+
+def _surface_code(d):
+    import src.surface_code as sc
+    code = sc.SurfaceCode(d, d, ERROR_RATE)
+    return code.initialize_circuit_position()
+
+
+def _circuit_standard(d):
+    import src.surface_code as sc
+    return sc.SurfaceCode(d, d, ERROR_RATE).circuit_standard('Z', rounds=d)
+
+
+def _growth_cycle(d):
+    import src.surface_code as sc
+    code = sc.SurfaceCode(3, 3, ERROR_RATE)
+    circuit = code.circuit_standard('X', rounds=1, if_measure=False)
+    code.growth_cycle(circuit, d, d, 1, postselection='all')
+    return circuit
+
+
+def _grow_code(d):
+    import src.surface_code as sc
+    code = sc.SurfaceCode(3, 3, ERROR_RATE)
+    circuit = code.circuit_standard('X', rounds=1, if_measure=False)
+    return code.grow_code(circuit, 1, d, d, d, postselection='all')
+
+
+def _magicd2(d2):
+    import src.magic as magic
+    import src.magicd2 as magicd2
+    # the prefix snapshots are memoized per process, every repeat builds from scratch
+    magic._prefix_snapshot.cache_clear()
+    return magicd2.magic_preparation(T_sc_pre=0, T_lat_surg=3, T_before_grow=1, T_ps_grow=2, T_maintain=0,
+                                     error_rate=ERROR_RATE, d=3, d2=d2)
+
+
+CASES = {
+    'surface_code': _surface_code,  # SurfaceCode layout and qubit coordinates
+    'circuit_standard': _circuit_standard,  # d rounds of a distance-d memory
+    'growth_cycle': _growth_cycle,  # one growth round from distance 3 to d
+    'grow_code': _grow_code,  # growth from distance 3 to d and d - 1 more rounds
+    'magicd2': _magicd2,  # full magic state preparation grown to d2
+}
+
+
+def reference_build():
+    """
+    A fixed workload that does not depend on this package: the instructions of a stim-generated distance-9 memory
+    appended one by one to a new circuit, the mix of Python calls and stim appends of the builders.
+    """
+    import stim
+    generated = stim.Circuit.generated('surface_code:rotated_memory_z', distance=9, rounds=9,
+                                       after_clifford_depolarization=ERROR_RATE).flattened()
+    circuit = stim.Circuit()
+    for inst in generated:
+        circuit.append(inst.name, inst.targets_copy(), inst.gate_args_copy())
+    return circuit
+
+
+def _circuit_size(circuit):
+    import src.stats as stats
+    return {
+        'qubits': circuit.num_qubits,
+        'operations': sum(stats.gate_counts(circuit).values()),
+        'measurements': circuit.num_measurements,
+        'detectors': circuit.num_detectors,
+    }
+
+
+def run_case(case, d, repeats):
+    """
+    Time one case in this process: {'seconds', 'reference_seconds', 'relative', 'peak_rss_mb', 'start_rss_mb',
+    'rss_growth_mb', 'size'}, with relative = seconds / reference_seconds (see reference_build).
+    """
+    build = CASES[case]
+    build(3)  # imports and warm-up
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    seconds = math.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        circuit = build(d)
+        seconds = min(seconds, time.perf_counter() - t0)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # the reference alternates with the case, so that both see the same load of the machine;
+    # the first repeats of the case come before, so that its peak RSS is not the reference's
+    reference_seconds = math.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        reference_build()
+        reference_seconds = min(reference_seconds, time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        build(d)
+        seconds = min(seconds, time.perf_counter() - t0)
+    return {
+        'seconds': seconds,
+        'reference_seconds': reference_seconds,
+        'relative': seconds / reference_seconds,
+        'peak_rss_mb': peak_rss,
+        'start_rss_mb': start_rss,
+        'rss_growth_mb': peak_rss - start_rss,
+        'size': _circuit_size(circuit),
+    }
+
+
+def measure(case, d, repeats):
+    """run_case in a fresh python process, so that the peak RSS is the one of this case only."""
+    command = [sys.executable, '-m', 'benchmark.construction', '--worker', case, str(d), '--repeats', str(repeats)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def scaling_slope(results):
+    """
+    Exponent of time ~ size^slope, fitted (least squares on the logarithms) over the larger half of the distances
+    of a case; None if fewer than 3 of them take at least MIN_SECONDS.
+    The size is the number of operations, or of qubits for circuits without operations (the SurfaceCode layout).
+    """
+    points = sorted((r['size']['operations'] or r['size']['qubits'], r['seconds']) for r in results.values())
+    points = [(math.log(size), math.log(seconds)) for size, seconds in points[len(points) // 2:] if seconds >= MIN_SECONDS]
+    if len(points) < 3:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def compare(results, baseline, tolerance, max_slope):
+    """
+    Problems found in the results: regressions against the baseline (time relative to the reference build,
+    growth of the peak RSS), changed circuit sizes, super-linear scaling.
+    """
+    problems = []
+    for case, by_distance in results.items():
+        for d, result in by_distance.items():
+            reference = baseline.get(case, {}).get(d)
+            if reference is None:
+                continue
+            if reference['seconds'] >= MIN_COMPARE_SECONDS and result['relative'] > tolerance * reference['relative']:
+                problems.append(f"{case} d={d}: {result['relative']:.3f} x reference build, "
+                                f"baseline {reference['relative']:.3f} x")
+            # growth below a few MB is allocator noise
+            if result['rss_growth_mb'] > tolerance * max(reference['rss_growth_mb'], MIN_RSS_GROWTH_MB):
+                problems.append(f"{case} d={d}: peak RSS grew by {result['rss_growth_mb']:.0f}MB, "
+                                f"baseline {reference['rss_growth_mb']:.0f}MB")
+            if result['size'] != reference['size']:
+                problems.append(f"{case} d={d}: circuit size {result['size']}, baseline {reference['size']}")
+        slope = scaling_slope(by_distance)
+        if slope is not None and slope > max_slope:
+            problems.append(f"{case}: time grows like size^{slope:.2f} over the larger distances")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--distances', nargs='+', type=int, default=DISTANCES)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--max-slope', type=float, default=MAX_SLOPE)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--worker', nargs=2, metavar=('CASE', 'D'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        case, d = args.worker
+        print(json.dumps(run_case(case, int(d), args.repeats)))
+        return 0
+
+    results = {}
+    print(f"{'case':<18}{'d':>4}{'seconds':>10}{'relative':>10}{'peak MB':>9}{'qubits':>8}{'operations':>12}"
+          f"{'detectors':>10}")
+    for case in args.cases:
+        results[case] = {}
+        for d in args.distances:
+            # json keys, as in the baseline file
+            result = results[case][str(d)] = measure(case, d, args.repeats)
+            size = result['size']
+            print(f"{case:<18}{d:>4}{result['seconds']:>10.4f}{result['relative']:>10.3f}{result['peak_rss_mb']:>9.0f}"
+                  f"{size['qubits']:>8}{size['operations']:>12}{size['detectors']:>10}", flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        for case, by_distance in results.items():
+            baseline.setdefault(case, {}).update(by_distance)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        print(f"No baseline at {args.baseline}, only checking the scaling.")
+    problems = compare(results, baseline, args.tolerance, args.max_slope)
+    for problem in problems:
+        print('FLAG', problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+
+import numpy as np
+import stim
+
+import src.stats as stats
+
+
+@functools.lru_cache(maxsize=None)
+def source_hash(directory: str):
+    """Hash of the python sources in a directory, so that cached artifacts are invalidated when a builder changes."""
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(directory, '*.py'))):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def records_mask(builder):
+    """Whether a builder can return the post-selection mask it records while building (with_mask=True, see
+    magic.magic_preparation)."""
+    try:
+        return 'with_mask' in inspect.signature(builder).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def build_with_mask(builder, params, postselection=True):
+    """
+    (circuit, mask): builder(**params) and its packed post-selection mask (None without postselection).
+    The mask is the one the builder recorded if it can (see records_mask), else stats.postselection_mask.
+    """
+    if postselection and records_mask(builder):
+        return builder(**params, with_mask=True)
+    circuit, _ = _split(builder(**params))
+    return circuit, stats.postselection_mask(circuit) if postselection else None
+
+
+def _split(result):
+    # a circuit, (circuit, mask) from a builder called with with_mask=True,
+    # or (circuit, stages) from builders such as magic.magic_stages
+    if not isinstance(result, tuple):
+        return result, None
+    circuit, extra = result
+    return circuit, extra if isinstance(extra, np.ndarray) else None
+
+
+def _write_atomic(path: str, write):
+    # concurrent builders of the same key (e.g. TaskFactory workers) never see a partial file
+    handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(handle)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class CircuitCache:
+    """
+    On-disk cache of circuits, detector error models and packed post-selection masks,
+    content-addressed by the builder, its keyword parameters, the sources of the builder's package
+    (see source_hash) and the stim version.
+    Every artifact is built at most once per key; repeated and resumed sweeps read them back from disk.
+    Only the post-selection masks are memory-mapped: circuits and DEMs are stored as stim text and parsed back
+    by stim (stim has no binary format for them, and sinter needs the stim objects). The parse is still a small
+    fraction of what it replaces, e.g. ~10 ms to read the decomposed DEM of magic_preparation at d=11 against
+    ~1 s to build the circuit and ~0.1 s to analyse it.
+
+    Usage:
+        cache = CircuitCache('circuit_cache')
+        params = dict(T_sc_pre=0, T_lat_surg=3, T_before_grow=1, T_ps_grow=2, T_maintain=0, error_rate=1e-3)
+        circuit = cache.circuit(magic.magic_preparation, params)
+        dem = cache.detector_error_model(magic.magic_preparation, params)
+        mask = cache.postselection_mask(magic.magic_preparation, params)
+
+    Layout: <directory>/<key[:2]>/<key>/{params.json, circuit.stim, dem.dem, dem_decomposed.dem, mask.npy}
+        and the results stored by record (e.g. preflight.json)
+    """
+    def __init__(self, directory='circuit_cache'):
+        self.directory = directory
+
+    def key(self, builder, params):
+        """Hex key of a builder called with the keyword parameters `params`."""
+        description = {
+            'builder': f'{builder.__module__}.{builder.__qualname__}',
+            'params': params,
+            'sources': source_hash(os.path.dirname(os.path.abspath(inspect.getfile(builder)))),
+            'stim': stim.__version__,
+        }
+        text = json.dumps(description, sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, builder, params, name=None):
+        """Directory of the artifacts of a key, or the path of one of them."""
+        key = self.key(builder, params)
+        directory = os.path.join(self.directory, key[:2], key)
+        return directory if name is None else os.path.join(directory, name)
+
+    def _entry(self, builder, params):
+        directory = self.path(builder, params)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+            _write_atomic(os.path.join(directory, 'params.json'), lambda tmp: _dump_params(tmp, builder, params))
+        return directory
+
+    def circuit(self, builder, params, build=None):
+        """
+        The circuit builder(**params), built on a miss.
+        The post-selection mask recorded by the builder (see records_mask) is stored with it.
+        Args:
+            build: function without arguments building the same circuit in another way,
+                e.g. a noise.NoiseSkeleton instantiation, used instead of the builder on a miss;
+                it may return (circuit, mask) like a builder called with with_mask=True
+        """
+        directory = self._entry(builder, params)
+        path = os.path.join(directory, 'circuit.stim')
+        if not os.path.exists(path):
+            if build is not None:
+                circuit, mask = _split(build())
+            elif records_mask(builder):
+                circuit, mask = builder(**params, with_mask=True)
+            else:
+                circuit, mask = _split(builder(**params))
+            if mask is not None:
+                if len(mask) != (circuit.num_detectors + 7) // 8:
+                    raise ValueError(f"Post-selection mask of {len(mask)} bytes for {circuit.num_detectors} detectors.")
+                _write_atomic(os.path.join(directory, 'mask.npy'), lambda tmp: _save_npy(tmp, mask))
+            _write_atomic(path, circuit.to_file)
+            return circuit
+        return stim.Circuit.from_file(path)
+
+    def detector_error_model(self, builder, params, decompose_errors=False, build=None):
+        """The detector error model of the circuit builder(**params), see circuit for `build`."""
+        name = 'dem_decomposed.dem' if decompose_errors else 'dem.dem'
+        path = os.path.join(self._entry(builder, params), name)
+        if not os.path.exists(path):
+            dem = self.circuit(builder, params, build).detector_error_model(decompose_errors=decompose_errors)
+            _write_atomic(path, dem.to_file)
+            return dem
+        return stim.DetectorErrorModel.from_file(path)
+
+    def postselection_mask(self, builder, params, build=None):
+        """
+        The post-selection mask of the circuit builder(**params) (as sinter.post_selection_mask_from_4th_coord:
+        bit-packed uint8, little bit order), memory-mapped read-only. See circuit for `build`.
+        The mask is stored when the circuit is built if the builder records it, else it is read off the
+        detector coordinates of the circuit (stats.postselection_mask).
+        """
+        path = os.path.join(self._entry(builder, params), 'mask.npy')
+        if not os.path.exists(path):
+            circuit = self.circuit(builder, params, build)
+            if not os.path.exists(path):
+                mask = stats.postselection_mask(circuit)
+                _write_atomic(path, lambda tmp: _save_npy(tmp, mask))
+        return np.load(path, mmap_mode='r')
+
+    def record(self, builder, params, name, value):
+        """Stores a JSON-serializable result about builder(**params) under `name`, e.g. 'preflight.json'."""
+        path = os.path.join(self._entry(builder, params), name)
+        _write_atomic(path, lambda tmp: _dump_json(tmp, value))
+
+    def recorded(self, builder, params, name):
+        """The result stored by record, None if there is none."""
+        path = self.path(builder, params, name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+
+def _dump_params(path, builder, params):
+    with open(path, 'w') as f:
+        json.dump({'builder': f'{builder.__module__}.{builder.__qualname__}', 'params': params}, f, default=repr, indent=1)
+
+
+def _dump_json(path, value):
+    with open(path, 'w') as f:
+        json.dump(value, f, default=repr, indent=1)
+
+
+def _save_npy(path, array):
+    # np.save appends .npy to names without it
+    with open(path, 'wb') as f:
+        np.save(f, array)
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+class DetectorIndex:
+    """
+    The detectors of a circuit by id, from the metadata the builders record as they append them
+    (MeasurementLedger.detector_metadata): stage, position (x, y), round, whether the detector is post-selected,
+    and the builder call that appended it, e.g.
+        'SurfaceCode.add_detectors', 'SurfaceCode.add_detectors_initial', 'SurfaceCode.add_detectors_after_growth',
+        'SurfaceCode.logical_measurement', 'SurgeryUnit.checks', 'SurgeryUnit.flags', 'SurgeryUnit.lattice_surgery'
+        (surface code checks during the surgery), 'SurgeryUnit.decouple_after_surgery', 'QRMCode.metachecks', ...
+    Selections are boolean masks over the detector ids, so that detection events (shots, detectors) of a stage
+    or a region are events[:, index.select(...)], without parsing the circuit or its DEM.
+
+    Usage:
+        circuit, index = magic.magic_detectors(1, 3, 1, 2, 5, 1e-3)
+        events = circuit.compile_detector_sampler().sample(10000)
+        grown = events[:, index.select(stage='growth', origin='SurfaceCode.add_detectors_after_growth')]
+        corner = index.ids(stage=['ps_grow', 'maintain'], x=(0, 4), y=(0, 4), postselected=False)
+    """
+    def __init__(self, metadata):
+        self.stage = np.asarray(metadata['stage'])
+        self.x = np.asarray(metadata['x'])
+        self.y = np.asarray(metadata['y'])
+        self.round = np.asarray(metadata['round'])
+        self.postselected = np.asarray(metadata['postselected'])
+        self.origin = np.asarray(metadata['origin'])
+        self.stages = [str(name) for name in metadata['stages']]
+        self.origins = [str(name) for name in metadata['origins']]
+
+    def __len__(self):
+        return len(self.stage)
+
+    @staticmethod
+    def _codes(names, selected, kind):
+        selected = [selected] if isinstance(selected, str) else list(selected)
+        unknown = set(selected) - set(names)
+        if unknown:
+            raise ValueError(f"Unknown {kind} {sorted(unknown)}. The circuit has {names}.")
+        return [names.index(name) for name in selected]
+
+    @staticmethod
+    def _within(values, selected):
+        # a value, or an inclusive (low, high) range
+        if isinstance(selected, tuple):
+            low, high = selected
+            return (values >= low) & (values <= high)
+        return values == selected
+
+    def select(self, stage=None, origin=None, x=None, y=None, round=None, postselected=None):
+        """
+        Boolean mask over the detector ids of the detectors meeting all the given conditions.
+        Args:
+            stage: a stage name or a list of them
+            origin: a builder call (see the class docstring) or a list of them
+            x, y, round: a value, or an inclusive (low, high) range
+            postselected: True or False
+        """
+        mask = np.ones(len(self), dtype=np.bool_)
+        if stage is not None:
+            mask &= np.isin(self.stage, self._codes(self.stages, stage, 'stages'))
+        if origin is not None:
+            mask &= np.isin(self.origin, self._codes(self.origins, origin, 'origins'))
+        for values, selected in ((self.x, x), (self.y, y), (self.round, round)):
+            if selected is not None:
+                mask &= self._within(values, selected)
+        if postselected is not None:
+            mask &= self.postselected == bool(postselected)
+        return mask
+
+    def ids(self, **selection):
+        """Detector ids meeting the conditions of select(), in increasing order."""
+        return np.flatnonzero(self.select(**selection))
+
+    def stage_of(self, ids):
+        """Stage names of the given detector ids."""
+        # stage -1 (detectors before the first begin_stage) has no name
+        return np.array(self.stages + [''], dtype=str)[self.stage[ids]]
+
+    def origin_of(self, ids):
+        """Builder calls that appended the given detector ids."""
+        return np.array(self.origins + [''], dtype=str)[self.origin[ids]]
+
+    def coords(self, ids=slice(None)):
+        """(x, y, round) of the given detector ids, all of them by default."""
+        return np.stack([self.x[ids], self.y[ids], self.round[ids]], axis=-1)
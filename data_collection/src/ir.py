@@ -0,0 +1,192 @@
+import copyreg
+from array import array
+
+import numpy as np
+import stim
+
+FRAGMENT = -1  # op code of an instruction kept as a prebuilt stim.Circuit (e.g. a compiled round or a REPEAT block)
+
+
+class CircuitBuffer:
+    """
+    Instruction buffer that the builders write into instead of a stim.Circuit.
+    Each append only stores an op code, a tag and slices of flat target / argument arrays;
+    the buffer is turned into a stim.Circuit in one pass (to_circuit) or written as .stim text (to_text, write).
+    It accepts the part of the stim.Circuit interface the builders use: append, append_operation, += and len.
+
+    Targets are stored as int64: qubits as themselves (>= 0), measurement records rec[-k] as -k.
+    Instructions with other targets (Pauli products, inverted or sweep targets) are kept as stim fragments.
+    """
+    def __init__(self):
+        self.names = []  # op code -> instruction name
+        self.codes = {}  # instruction name -> op code
+        self.ops = array('q')  # op code of each instruction, FRAGMENT for prebuilt circuits
+        self.tags = []  # tag of each instruction
+        self.targets = array('q')
+        self.target_offsets = array('q', [0])  # targets of instruction i: targets[target_offsets[i]:target_offsets[i + 1]]
+        self.args = array('d')
+        self.arg_offsets = array('q', [0])  # arguments of instruction i: args[arg_offsets[i]:arg_offsets[i + 1]]
+        self.fragments = {}  # instruction index -> stim.Circuit, for op code FRAGMENT
+
+    def __len__(self):
+        return len(self.ops)
+
+    def op_code(self, name: str):
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def append(self, name: str, targets=(), arg=None, *, tag: str = ''):
+        encoded = encode_targets(targets)
+        if encoded is None:
+            fragment = stim.Circuit()
+            fragment.append(name, targets, arg, tag=tag)
+            self.append_fragment(fragment)
+            return
+        if arg is None:
+            arg = ()
+        elif np.isscalar(arg):
+            arg = (arg,)
+        self.ops.append(self.op_code(name))
+        self.tags.append(tag)
+        self.targets.extend(encoded)
+        self.target_offsets.append(len(self.targets))
+        self.args.extend(float(a) for a in arg)
+        self.arg_offsets.append(len(self.args))
+
+    # the older stim name used in qrm.py
+    append_operation = append
+
+    def append_fragment(self, circuit: stim.Circuit):
+        self.fragments[len(self.ops)] = circuit
+        self.ops.append(FRAGMENT)
+        self.tags.append('')
+        self.target_offsets.append(len(self.targets))
+        self.arg_offsets.append(len(self.args))
+
+    def __iadd__(self, other):
+        if isinstance(other, stim.Circuit):
+            self.append_fragment(other)
+            return self
+        if not isinstance(other, CircuitBuffer):
+            return NotImplemented
+        for i in range(len(other)):
+            code = other.ops[i]
+            if code == FRAGMENT:
+                self.append_fragment(other.fragments[i])
+                continue
+            self.ops.append(self.op_code(other.names[code]))
+            self.tags.append(other.tags[i])
+            self.targets.extend(other.targets[other.target_offsets[i]:other.target_offsets[i + 1]])
+            self.target_offsets.append(len(self.targets))
+            self.args.extend(other.args[other.arg_offsets[i]:other.arg_offsets[i + 1]])
+            self.arg_offsets.append(len(self.args))
+        return self
+
+    def instruction_text(self, i: int):
+        """The .stim line of instruction i (not a fragment)."""
+        line = self.names[self.ops[i]]
+        if self.tags[i]:
+            line += f'[{self.tags[i]}]'
+        args = self.args[self.arg_offsets[i]:self.arg_offsets[i + 1]]
+        if len(args):
+            line += '(' + ', '.join(map(repr, args)) + ')'
+        targets = self.targets[self.target_offsets[i]:self.target_offsets[i + 1]]
+        if len(targets):
+            if min(targets) >= 0:
+                line += ' ' + ' '.join(map(str, targets))
+            else:
+                line += ' ' + ' '.join(str(t) if t >= 0 else f'rec[{t}]' for t in targets)
+        return line
+
+    def segments(self):
+        """Yields the buffer in order as .stim text (str) between prebuilt fragments (stim.Circuit)."""
+        lines = []
+        for i, code in enumerate(self.ops):
+            if code == FRAGMENT:
+                if lines:
+                    yield '\n'.join(lines)
+                    lines = []
+                yield self.fragments[i]
+            else:
+                lines.append(self.instruction_text(i))
+        if lines:
+            yield '\n'.join(lines)
+
+    def to_circuit(self):
+        """The buffer as a stim.Circuit, parsing each run of instructions between fragments in one call."""
+        circuit = stim.Circuit()
+        for segment in self.segments():
+            circuit += stim.Circuit(segment) if isinstance(segment, str) else segment
+        return circuit
+
+    def to_text(self):
+        """The buffer as .stim text, without going through stim."""
+        return '\n'.join(segment if isinstance(segment, str) else str(segment) for segment in self.segments()) + '\n'
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_text())
+
+
+def encode_targets(targets):
+    """
+    Flat int64 targets (see CircuitBuffer), or None if some target is neither a qubit nor a measurement record.
+    """
+    if isinstance(targets, (int, np.integer)):
+        return array('q', [int(targets)])
+    if isinstance(targets, stim.GateTarget):
+        targets = [targets]
+    if isinstance(targets, np.ndarray):
+        return array('q', targets.astype(np.int64, copy=False).ravel().tobytes())
+    try:
+        return array('q', targets)
+    except TypeError:
+        pass
+    encoded = array('q')
+    for t in targets:
+        if isinstance(t, stim.GateTarget):
+            if t.is_measurement_record_target or (t.is_qubit_target and not t.is_inverted_result_target):
+                encoded.append(t.value)
+            else:
+                return None
+        else:
+            encoded.append(int(t))
+    return encoded
+
+
+def _instruction_state(inst):
+    if isinstance(inst, stim.CircuitRepeatBlock):
+        return inst.repeat_count, circuit_state(inst.body_copy()), inst.tag
+    # the targets as text (GateTargets cannot be pickled), the arguments as floats
+    args = inst.gate_args_copy()
+    text = str(stim.CircuitInstruction(inst.name, inst.targets_copy(), [0] * len(args), tag=inst.tag))
+    return text, args
+
+
+def circuit_state(circuit: stim.Circuit):
+    """
+    The instructions of a circuit in a picklable form that keeps their arguments exact.
+    stim pickles (and so deep-copies) a circuit as its .stim text, which rounds the arguments to 6 significant digits.
+    """
+    return [_instruction_state(inst) for inst in circuit]
+
+
+def circuit_from_state(state):
+    """The circuit of circuit_state."""
+    circuit = stim.Circuit()
+    for entry in state:
+        if len(entry) == 3:
+            repeat_count, body, tag = entry
+            circuit.append(stim.CircuitRepeatBlock(repeat_count, circuit_from_state(body), tag=tag))
+        else:
+            text, args = entry
+            inst = stim.Circuit(text)[0]
+            circuit.append(stim.CircuitInstruction(inst.name, inst.targets_copy(), args, tag=inst.tag))
+    return circuit
+
+
+# the builders deep-copy codes holding compiled rounds, and send prefix circuits to pool processes (see magic.seed_prefixes)
+copyreg.pickle(stim.Circuit, lambda circuit: (circuit_from_state, (circuit_state(circuit),)))
@@ -3,8 +3,23 @@ import src.qrm as qrm
 import stim
 import numpy as np
 import src.surgery as sg
+import src.measurements as ms
+import src.passes as passes
+import src.stats as stats
+import src.detectors as detectors
+import copy
+import functools
+from collections import Counter
 
-def magic_preparation(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7):
+# stages after which the circuit is snapshotted, in order, with the number of leading prefix parameters
+# (T_sc_pre, T_lat_surg, error_rate, repeat, noise_tags, coords, recycle_qubits, T_before_grow, d, T_ps_grow, T_maintain)
+# the circuit up to the end of the stage depends on
+PREFIX_STAGES = {'decouple': 6, 'growth': 9, 'ps_grow': 10, 'maintain': 11}
+PREFIX_CACHE_SIZE = 16  # snapshots kept per process, enough for the schedule sweeps
+_SEEDED_PREFIXES = {}  # (stage, prefix parameters) -> snapshot built by another process, see seed_prefixes
+
+def magic_preparation(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, repeat=False, noise_tags=False, compact=False, recycle_qubits=False,
+                      with_mask=False, fuse_noise=False, lean=False):
     """
     Args:
         T_sc_pre: number of rounds of surface code stabilizer measurements during the initial preparation stage
@@ -13,48 +28,182 @@ def magic_preparation(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain
         T_ps_grow: number of post-selected rounds of surface code stabilizer measurements during lattice growth
         T_maintain: number of rounds of surface code stabilizer measurements after lattice growth
         error_rate: physical error rate for each gate
+        repeat: emit runs of identical syndrome rounds as stim REPEAT blocks instead of unrolling them
+        noise_tags: tag the noise channels with their stage ('qrm', 'sc', 'surgery'), so that the circuit
+            can serve as a noise.NoiseSkeleton and be instantiated for other error rates
+        compact: renumber the qubits densely (see passes.compact_qubits)
+        fuse_noise: merge stacked noise channels on the same qubits and drop the noiseless ones (see passes.fuse_noise)
+        recycle_qubits: let the growth reuse the QRM and surgery qubits, which are retired after decoupling
+        with_mask: also return the post-selection mask, recorded by the builders as they append the detectors
+            (bit-packed like sinter.post_selection_mask_from_4th_coord, without its pass over the circuit)
+        lean: sampling-only circuit, without QUBIT_COORDS, SHIFT_COORDS and detector coordinates; the mask and the
+            detector metadata (stage, position, round, see MeasurementLedger.detector_metadata) come as side arrays
     Returns:
-        A stim circuit object that prepares a surface code magic state.
+        A stim circuit object that prepares a surface code magic state, or (circuit, mask) if with_mask,
+        or (circuit, mask, detector metadata) if lean.
+    Everything before the readout comes from the memoized prefix (see magic_prefix),
+    so sweeping one schedule parameter only rebuilds the stages from that one on.
+    """
+    circuit, ledger = _magic_circuit(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=d,
+                                     repeat=repeat, noise_tags=noise_tags, recycle_qubits=recycle_qubits, coords=not lean)
+    if fuse_noise:
+        circuit = passes.fuse_noise(circuit)
+    if compact:
+        circuit, _ = passes.compact_qubits(circuit)
+    if lean:
+        return circuit, ledger.postselection_mask(), ledger.detector_metadata()
+    return (circuit, ledger.postselection_mask()) if with_mask else circuit
+
+def magic_stages(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, repeat=False, noise_tags=False, recycle_qubits=False):
+    """
+    The circuit of magic_preparation (before compaction) and its stages:
+    a list of (stage name, index of its first measurement, index of its first instruction), see MeasurementLedger.
+    """
+    circuit, ledger = _magic_circuit(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=d,
+                                     repeat=repeat, noise_tags=noise_tags, recycle_qubits=recycle_qubits)
+    return circuit, list(ledger.stages)
+
+def _magic_circuit(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, repeat=False, noise_tags=False, recycle_qubits=False,
+                   coords=True):
+    # the circuit of magic_preparation (before compaction) and its measurement ledger
+    circuit, sc_code, surface_clock = magic_prefix('maintain', T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain,
+                                                   error_rate, d=d, repeat=repeat, noise_tags=noise_tags,
+                                                   recycle_qubits=recycle_qubits, coords=coords)
+    # measure logical Y of the surface code
+    sc_code.measurements.begin_stage('readout', len(circuit))
+    sc_code.Y_measurement_noiseless(circuit)
+    # one round of error-free syndrome measurement to finalize the detectors
+    sc_code.syndrome_cycle(circuit, surface_clock, error_rate=0.0)
+
+    return circuit, sc_code.measurements
+
+def magic_detectors(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, repeat=False, noise_tags=False, recycle_qubits=False):
+    """
+    The circuit of magic_preparation (before compaction) and the index of its detectors, see detectors.DetectorIndex.
+    """
+    circuit, ledger = _magic_circuit(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=d,
+                                     repeat=repeat, noise_tags=noise_tags, recycle_qubits=recycle_qubits)
+    return circuit, detectors.DetectorIndex(ledger.detector_metadata())
+
+def magic_stats(*args, dem=True, **kwargs):
     """
-    qrm_code = qrm.QRMCode(error_rate, x_pos_shift=-10)
+    Per-stage size of the magic_preparation circuit (qubits, gates, TICKs, detectors, DEM errors), see stats.circuit_stats.
+    Takes the arguments of magic_preparation.
+    """
+    return stats.circuit_stats(*magic_stages(*args, **kwargs), dem=dem)
+
+def magic_prefix(stage, T_sc_pre, T_lat_surg, T_before_grow=0, T_ps_grow=0, T_maintain=0, error_rate=0.001, d=7, repeat=False, noise_tags=False,
+                 recycle_qubits=False, coords=True):
+    """
+    The magic state preparation up to the end of `stage` (a key of PREFIX_STAGES), parameters of later stages are ignored.
+    Snapshots are memoized, each one extending the snapshot of the stage before.
+    coords: emit qubit and detector coordinates (see MeasurementLedger)
+    Returns:
+        (circuit, sc_code, surface_clock): copies of the circuit and of the surface code (with its measurement ledger)
+        that the caller may extend, and the next round of the surface code.
+    """
+    params = (T_sc_pre, T_lat_surg, error_rate, repeat, noise_tags, coords, recycle_qubits, T_before_grow, d, T_ps_grow, T_maintain)
+    circuit, sc_code, surface_clock = _prefix_snapshot(stage, params[:PREFIX_STAGES[stage]])
+    return circuit.copy(), copy.deepcopy(sc_code), surface_clock
+
+def shared_prefixes(grid):
+    """
+    The prefix snapshots (see magic_prefix) that several tasks of a sweep start from, built once in this process:
+    for each task, the one of the deepest stage it shares with another task.
+    grid: keyword dicts of magic_preparation (or of magicd2.magic_preparation, magic_stages, ...), one per task
+    Returns:
+        {(stage, prefix parameters): snapshot}, to hand to the processes building the tasks (see seed_prefixes)
+    """
+    keys = [_prefix_params(**point) for point in grid]
+    counts = {stage: Counter(key[:size] for key in keys) for stage, size in PREFIX_STAGES.items()}
+    shared = set()
+    for key in keys:
+        for stage in reversed(list(PREFIX_STAGES)):
+            if counts[stage][key[:PREFIX_STAGES[stage]]] > 1:
+                shared.add((stage, key[:PREFIX_STAGES[stage]]))
+                break
+    return {(stage, params): _prefix_snapshot(stage, params) for stage, params in shared}
+
+def seed_prefixes(snapshots):
+    """Lets magic_prefix use snapshots of shared_prefixes built by another process instead of rebuilding them."""
+    _SEEDED_PREFIXES.update(snapshots)
+
+def prefix_initializer(grid):
+    """
+    (initializer, initargs) of the processes building the tasks of grid (see tasks.TaskFactory):
+    the shared prefixes are built once here, and every process starts with them (see shared_prefixes).
+    """
+    return seed_prefixes, (shared_prefixes(grid),)
+
+def _prefix_params(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, repeat=False, noise_tags=False,
+                   recycle_qubits=False, lean=False, **_):
+    # the parameters of magic_prefix a task builds its circuit from, in the order of PREFIX_STAGES
+    return (T_sc_pre, T_lat_surg, error_rate, repeat, noise_tags, not lean, recycle_qubits, T_before_grow, d, T_ps_grow, T_maintain)
+
+@functools.lru_cache(maxsize=PREFIX_CACHE_SIZE)
+def _prefix_snapshot(stage, params):
+    if (stage, params) in _SEEDED_PREFIXES:
+        return _SEEDED_PREFIXES[stage, params]
+    T_sc_pre, T_lat_surg, error_rate, repeat, noise_tags, coords = params[:6]
+    if stage == 'decouple':
+        return _decouple_prefix(T_sc_pre, T_lat_surg, error_rate, repeat, noise_tags, coords)
+    stages = list(PREFIX_STAGES)
+    previous = stages[stages.index(stage) - 1]
+    circuit, sc_code, surface_clock = _prefix_snapshot(previous, params[:PREFIX_STAGES[previous]])
+    circuit = circuit.copy()
+    sc_code = copy.deepcopy(sc_code)
+    ledger = sc_code.measurements
+    if stage == 'growth':
+        recycle_qubits, T_before_grow, d = params[6:9]
+        if recycle_qubits:
+            # the qubits below the surface code's offset belong to the QRM code and the surgery unit
+            sc_code.recycle_qubits(range(sc_code.off_set))
+        # do T_before_grow rounds of surface code stabilizer measurements
+        # (the first one looks back over the QRM measurement, see MeasurementLedger)
+        ledger.begin_stage('sc_before_grow', len(circuit))
+        sc_code.syndrome_cycles(circuit, surface_clock, T_before_grow, postselection='all', repeat=repeat)
+        surface_clock += T_before_grow
+        # grow the surface code
+        ledger.begin_stage('growth', len(circuit))
+        sc_code.growth_cycle(circuit, d, d, surface_clock, postselection='all')
+        surface_clock += 1
+    elif stage == 'ps_grow':
+        T_ps_grow = params[9]
+        # do T_ps_grow rounds of post-selected surface code stabilizer measurements
+        ledger.begin_stage('ps_grow', len(circuit))
+        sc_code.syndrome_cycles(circuit, surface_clock, T_ps_grow, postselection='all', repeat=repeat)
+        surface_clock += T_ps_grow
+    elif stage == 'maintain':
+        T_maintain = params[10]
+        # do T_maintain rounds of surface code stabilizer measurements
+        ledger.begin_stage('maintain', len(circuit))
+        sc_code.syndrome_cycles(circuit, surface_clock, T_maintain, repeat=repeat)
+        surface_clock += T_maintain
+    return circuit, sc_code, surface_clock
+
+def _decouple_prefix(T_sc_pre, T_lat_surg, error_rate, repeat, noise_tags, coords):
+    # one measurement record for all stages, so that detectors can look back across stages
+    ledger = ms.MeasurementLedger(coords=coords)
+    qrm_code = qrm.QRMCode(error_rate, x_pos_shift=-10, noise_tag='qrm' if noise_tags else '', measurements=ledger)
     sc_shift = qrm_code.total_qubit_number + 1 + 2
-    sc_code = sc.SurfaceCode(3, 3, error_rate, off_set=sc_shift)
+    sc_code = sc.SurfaceCode(3, 3, error_rate, off_set=sc_shift, noise_tag='sc' if noise_tags else '', measurements=ledger)
+    ledger.begin_stage('qrm', 0)
     circuit = qrm_code.prepare_S_state()
+    ledger.begin_stage('sc_pre', len(circuit))
     circuit += sc_code.initialize_cycle('X', postselection='all')
     surface_clock = 1
     # do T_sc_pre rounds of surface code stabilizer measurements
-    for t in range(surface_clock, surface_clock + T_sc_pre):
-        sc_code.syndrome_cycle(circuit, t, error_rate, postselection='all')
+    sc_code.syndrome_cycles(circuit, surface_clock, T_sc_pre, postselection='all', repeat=repeat)
     surface_clock += T_sc_pre
     # do T_lat_surg rounds of lattice surgery
     surgery_shift = qrm_code.total_qubit_number + 1
-    surgery_unit = sg.SurgeryUnit(qrm_code, sc_code, error_rate, sg_shift=surgery_shift, T_lat_surg=T_lat_surg)
-    surgery_unit.lattice_surgery(circuit, T_sc_pre, surface_clock)
+    surgery_unit = sg.SurgeryUnit(qrm_code, sc_code, error_rate, sg_shift=surgery_shift, T_lat_surg=T_lat_surg,
+                                      noise_tag='surgery' if noise_tags else '')
+    ledger.begin_stage('surgery', len(circuit))
+    surgery_unit.lattice_surgery(circuit, surface_clock)
     surface_clock += T_lat_surg
     # decouple
+    ledger.begin_stage('decouple', len(circuit))
     surgery_unit.decouple_after_surgery(circuit, surface_clock)
     surface_clock += 1
-    # do T_before_grow rounds of surface code stabilizer measurements
-    for t in range(surface_clock, surface_clock + T_before_grow):
-        rec_shift = 0
-        if t == surface_clock:
-            rec_shift = 15 # shift due to lattice surgery and QRM measurement
-        sc_code.syndrome_cycle(circuit, t, rec_shift=rec_shift, postselection='all')
-    surface_clock += T_before_grow
-    # grow the surface code
-    sc_code.growth_cycle(circuit, d, d, surface_clock, postselection='all')
-    surface_clock += 1
-    # do T_ps_grow rounds of post-selected surface code stabilizer measurements
-    for t in range(surface_clock, surface_clock + T_ps_grow):
-        sc_code.syndrome_cycle(circuit, t, error_rate, postselection='all')
-    surface_clock += T_ps_grow
-    # do T_maintain rounds of surface code stabilizer measurements
-    for t in range(surface_clock, surface_clock + T_maintain):
-        sc_code.syndrome_cycle(circuit, t, error_rate)
-    surface_clock += T_maintain
-    # measure logical Y of the surface code
-    sc_code.Y_measurement_noiseless(circuit)
-    # one round of error-free syndrome measurement to finalize the detectors
-    sc_code.syndrome_cycle(circuit, surface_clock, error_rate=0.0, rec_shift=1)
-
-    return circuit
\ No newline at end of file
+    return circuit, sc_code, surface_clock
@@ -1,10 +1,15 @@
-import src.surface_code as sc
-import src.qrm as qrm
 import stim
 import numpy as np
-import src.surgery as sg
+import src.magic as magic
+import src.passes as passes
+import src.stats as stats
+import src.detectors as detectors
 
-def magic_preparation(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, d2=9):
+# the stages up to T_maintain are those of magic, and so are the prefixes tasks can share (see tasks.TaskFactory)
+prefix_initializer = magic.prefix_initializer
+
+def magic_preparation(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, d2=9, repeat=False, noise_tags=False, compact=False, recycle_qubits=False,
+                      with_mask=False, fuse_noise=False, lean=False):
     """
     Args:
         T_sc_pre: number of rounds of surface code stabilizer measurements during the initial preparation stage
@@ -13,52 +18,69 @@ def magic_preparation(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain
         T_ps_grow: number of post-selected rounds of surface code stabilizer measurements during lattice growth
         T_maintain: number of rounds of surface code stabilizer measurements after lattice growth
         error_rate: physical error rate for each gate
+        d: code distance after the first growth
+        d2: final code distance, or a sequence of distances (e.g. [15, 31]) to grow through one cycle each
+        repeat: emit runs of identical syndrome rounds as stim REPEAT blocks instead of unrolling them
+        noise_tags: tag the noise channels with their stage ('qrm', 'sc', 'surgery'), so that the circuit
+            can serve as a noise.NoiseSkeleton and be instantiated for other error rates
+        compact: renumber the qubits densely (see passes.compact_qubits)
+        fuse_noise: merge stacked noise channels on the same qubits and drop the noiseless ones (see passes.fuse_noise)
+        recycle_qubits: let the growth reuse the QRM and surgery qubits, which are retired after decoupling
+        with_mask: also return the post-selection mask recorded by the builders, see magic.magic_preparation
+        lean: sampling-only circuit without coordinates, with the mask and the detector metadata as side arrays,
+            see magic.magic_preparation
     Returns:
-        A stim circuit object that prepares a surface code magic state.
+        A stim circuit object that prepares a surface code magic state, or (circuit, mask) if with_mask,
+        or (circuit, mask, detector metadata) if lean.
+    The stages up to T_maintain are shared with magic.magic_preparation through the memoized prefix.
+    """
+    circuit, ledger = _magic_circuit(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=d, d2=d2,
+                                     repeat=repeat, noise_tags=noise_tags, recycle_qubits=recycle_qubits, coords=not lean)
+    if fuse_noise:
+        circuit = passes.fuse_noise(circuit)
+    if compact:
+        circuit, _ = passes.compact_qubits(circuit)
+    if lean:
+        return circuit, ledger.postselection_mask(), ledger.detector_metadata()
+    return (circuit, ledger.postselection_mask()) if with_mask else circuit
+
+def magic_stats(*args, dem=True, **kwargs):
+    """
+    Per-stage size of the magic_preparation circuit, see magic.magic_stats.
+    """
+    return stats.circuit_stats(*magic_stages(*args, **kwargs), dem=dem)
+
+def magic_stages(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, d2=9, repeat=False, noise_tags=False, recycle_qubits=False):
     """
-    qrm_code = qrm.QRMCode(error_rate, x_pos_shift=-10)
-    sc_shift = qrm_code.total_qubit_number + 1 + 2
-    sc_code = sc.SurfaceCode(3, 3, error_rate, off_set=sc_shift)
-    circuit = qrm_code.prepare_S_state()
-    circuit += sc_code.initialize_cycle('X', postselection='all')
-    surface_clock = 1
-    # do T_sc_pre rounds of surface code stabilizer measurements
-    for t in range(surface_clock, surface_clock + T_sc_pre):
-        sc_code.syndrome_cycle(circuit, t, error_rate, postselection='all')
-    surface_clock += T_sc_pre
-    # do T_lat_surg rounds of lattice surgery
-    surgery_shift = qrm_code.total_qubit_number + 1
-    surgery_unit = sg.SurgeryUnit(qrm_code, sc_code, error_rate, sg_shift=surgery_shift, T_lat_surg=T_lat_surg)
-    surgery_unit.lattice_surgery(circuit, T_sc_pre, surface_clock)
-    surface_clock += T_lat_surg
-    # decouple
-    surgery_unit.decouple_after_surgery(circuit, surface_clock)
-    surface_clock += 1
-    # do T_before_grow rounds of surface code stabilizer measurements
-    for t in range(surface_clock, surface_clock + T_before_grow):
-        rec_shift = 0
-        if t == surface_clock:
-            rec_shift = 15 # shift due to lattice surgery and QRM measurement
-        sc_code.syndrome_cycle(circuit, t, rec_shift=rec_shift, postselection='all')
-    surface_clock += T_before_grow
-    # grow the surface code
-    sc_code.growth_cycle(circuit, d, d, surface_clock, postselection='all')
-    surface_clock += 1
-    # do T_ps_grow rounds of post-selected surface code stabilizer measurements
-    for t in range(surface_clock, surface_clock + T_ps_grow):
-        sc_code.syndrome_cycle(circuit, t, error_rate, postselection='all')
-    surface_clock += T_ps_grow
-    # do T_maintain rounds of surface code stabilizer measurements
-    for t in range(surface_clock, surface_clock + T_maintain):
-        sc_code.syndrome_cycle(circuit, t, error_rate)
-    surface_clock += T_maintain
+    The circuit of magic_preparation (before compaction) and its stages, see magic.magic_stages.
+    """
+    circuit, ledger = _magic_circuit(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=d, d2=d2,
+                                     repeat=repeat, noise_tags=noise_tags, recycle_qubits=recycle_qubits)
+    return circuit, list(ledger.stages)
+
+def magic_detectors(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, d2=9, repeat=False, noise_tags=False, recycle_qubits=False):
+    """
+    The circuit of magic_preparation (before compaction) and the index of its detectors, see magic.magic_detectors.
+    """
+    circuit, ledger = _magic_circuit(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=d, d2=d2,
+                                     repeat=repeat, noise_tags=noise_tags, recycle_qubits=recycle_qubits)
+    return circuit, detectors.DetectorIndex(ledger.detector_metadata())
+
+def _magic_circuit(T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate, d=7, d2=9, repeat=False, noise_tags=False, recycle_qubits=False,
+                   coords=True):
+    # the circuit of magic_preparation (before compaction) and its measurement ledger
+    circuit, sc_code, surface_clock = magic.magic_prefix('maintain', T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain,
+                                                         error_rate, d=d, repeat=repeat, noise_tags=noise_tags,
+                                                         recycle_qubits=recycle_qubits, coords=coords)
+    ledger = sc_code.measurements
     # grow to d2
-    if d2 > d:
-        sc_code.growth_cycle(circuit, d2, d2, surface_clock)
-        surface_clock += 1
+    ledger.begin_stage('growth_d2', len(circuit))
+    d2_path = [d2] if np.isscalar(d2) else list(d2)
+    surface_clock = sc_code.growth_path(circuit, d2_path, surface_clock)
     # measure logical Y of the surface code
+    ledger.begin_stage('readout', len(circuit))
     sc_code.Y_measurement_noiseless(circuit)
     # one round of error-free syndrome measurement to finalize the detectors
-    sc_code.syndrome_cycle(circuit, surface_clock, error_rate=0.0, rec_shift=1)
+    sc_code.syndrome_cycle(circuit, surface_clock, error_rate=0.0)
 
-    return circuit
\ No newline at end of file
+    return circuit, ledger
\ No newline at end of file
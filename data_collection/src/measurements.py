@@ -0,0 +1,194 @@
+import numpy as np
+import stim
+
+# side arrays of MeasurementLedger.detector_metadata: one entry per detector, in circuit order
+DETECTOR_METADATA = {'stage': np.int16, 'x': np.float32, 'y': np.float32, 'round': np.int32, 'postselected': np.bool_,
+                     'origin': np.int16}
+
+
+class MeasurementIndex:
+    """
+    Position of the latest measurement of each qubit, counted over the measurements recorded here.
+    Record lookbacks (rec[-k]) of a qubit are then O(1): position - count.
+    Lookbacks are only valid while every measurement appended to the circuit since the one looked up
+    has also been recorded in this index.
+    """
+    def __init__(self):
+        self.count = 0  # number of recorded measurements
+        self.position = np.full(0, -1, dtype=np.int64)  # qubit -> position of its latest measurement, -1 if never measured
+
+    def grow_to(self, num_qubits: int):
+        if num_qubits > len(self.position):
+            position = np.full(num_qubits, -1, dtype=np.int64)
+            position[:len(self.position)] = self.position
+            self.position = position
+
+    def record(self, qubits):
+        """Record a measurement (MR, M, ...) of the qubits, in target order."""
+        qubits = np.asarray(qubits, dtype=np.int64)
+        if len(qubits):
+            self.grow_to(qubits.max() + 1)
+        self.position[qubits] = self.count + np.arange(len(qubits))
+        self.count += len(qubits)
+
+    def advance(self, num: int):
+        """Record num measurements that do not belong to a single qubit (e.g. MPP products)."""
+        self.count += num
+
+    def lookback(self, qubits):
+        """Negative record offsets of the latest measurements of the qubits (same shape as qubits)."""
+        qubits = np.asarray(qubits, dtype=np.int64)
+        position = self.position[qubits]
+        if np.any(position < 0):
+            raise ValueError(f"Qubits {qubits[position < 0].tolist()} have not been measured.")
+        return position - self.count
+
+    def rec(self, qubits):
+        """stim record targets of the latest measurements of the qubits."""
+        return [stim.target_rec(k) for k in self.lookback(qubits).tolist()]
+
+
+class MeasurementLedger(MeasurementIndex):
+    """
+    The measurement record of a whole protocol, shared by all builders of the circuit
+    (QRMCode, SurfaceCode, SurgeryUnit), so that no builder has to know how many
+    measurements the other stages appended.
+
+    Measurements are referred to per qubit: the latest (back=0) or the previous (back=1) measurement of a qubit,
+    e.g. ('compare this round with the previous one') for any check ancilla, resolved to rec[-k] at the point
+    where the detector is appended.
+
+    The detectors are recorded too, in circuit order, with whether they are post-selected,
+    so that the post-selection mask comes with the circuit (see postselection_mask),
+    and with their stage, position, round and the builder call that appended them (see detector_metadata).
+
+    With coords=False the builders leave out QUBIT_COORDS, SHIFT_COORDS and the detector coordinates:
+    a lean circuit for sampling, whose detectors are only described by the recorded metadata.
+    """
+    def __init__(self, coords: bool = True):
+        super().__init__()
+        self.coords = coords
+        self.previous = np.full(0, -1, dtype=np.int64)  # qubit -> position of the measurement before the latest
+        self.stages = []  # (stage name, position of its first measurement, index of its first circuit instruction), in order
+        self.detector_runs = []  # [number of detectors, post-selected] runs, in circuit order
+        self.detector_rows = []  # metadata rows of the detectors appended one by one, not yet in detector_blocks
+        self.detector_blocks = []  # (num, 6) arrays of [stage, x, y, round, postselected, origin], in circuit order
+        self.origins = []  # names of the builder calls that appended detectors, e.g. 'SurfaceCode.add_detectors'
+
+    def grow_to(self, num_qubits: int):
+        if num_qubits > len(self.previous):
+            previous = np.full(num_qubits, -1, dtype=np.int64)
+            previous[:len(self.previous)] = self.previous
+            self.previous = previous
+        super().grow_to(num_qubits)
+
+    def begin_stage(self, name: str, position=None):
+        """
+        Measurements recorded from now on belong to the stage `name`.
+        position: number of instructions in the circuit when the stage starts (len(circuit)), if known,
+            so that the circuit can be split into stages afterwards (see passes.stage_slices)
+        """
+        self.stages.append((name, self.count, position))
+
+    def record(self, qubits):
+        """Record a measurement of the qubits, in target order."""
+        qubits = np.asarray(qubits, dtype=np.int64)
+        if len(qubits):
+            self.grow_to(qubits.max() + 1)
+        self.previous[qubits] = self.position[qubits]
+        super().record(qubits)
+
+    def lookback(self, qubits, back: int = 0):
+        """
+        Negative record offsets of the latest (back=0) or previous (back=1) measurements of the qubits.
+        """
+        if back == 0:
+            return super().lookback(qubits)
+        if back != 1:
+            raise ValueError(f"Unsupported back={back}. Use 0 (latest) or 1 (previous).")
+        qubits = np.asarray(qubits, dtype=np.int64)
+        position = self.previous[qubits]
+        if np.any(position < 0):
+            raise ValueError(f"Qubits {qubits[position < 0].tolist()} have not been measured twice.")
+        return position - self.count
+
+    def rec(self, qubits, back: int = 0):
+        """stim record targets of the latest (back=0) or previous (back=1) measurements of the qubits."""
+        return [stim.target_rec(k) for k in self.lookback(qubits, back).tolist()]
+
+    def record_detectors(self, num: int, postselected: bool, coords=None, origin: str = ''):
+        """
+        Record num DETECTOR instructions just appended to the circuit, all post-selected or none.
+        coords: their coordinates (num rows of at least [x, y, round]), whether or not the circuit carries them
+        origin: the builder call that appended them
+        """
+        postselected = bool(postselected)
+        if num <= 0:
+            return
+        coords = np.zeros((num, 3)) if coords is None else np.asarray(coords, dtype=np.float64)
+        self._flush_detector_rows()
+        block = np.empty((num, 6))
+        block[:, 0] = len(self.stages) - 1
+        block[:, 1:4] = coords[:, :3]
+        block[:, 4] = postselected
+        block[:, 5] = self.origin_code(origin)
+        self.detector_blocks.append(block)
+        self._record_run(num, postselected)
+
+    def origin_code(self, origin: str):
+        """Index of a builder call in self.origins, added on first use."""
+        if origin not in self.origins:
+            self.origins.append(origin)
+        return self.origins.index(origin)
+
+    def _flush_detector_rows(self):
+        if self.detector_rows:
+            self.detector_blocks.append(np.array(self.detector_rows, dtype=np.float64))
+            self.detector_rows = []
+
+    def _record_run(self, num, postselected):
+        if self.detector_runs and self.detector_runs[-1][1] == postselected:
+            self.detector_runs[-1][0] += num
+        else:
+            self.detector_runs.append([num, postselected])
+
+    def detector(self, circuit, targets, coords, origin: str = ''):
+        """
+        Append a DETECTOR to the circuit and record it. It is post-selected if its 4th coordinate is non-zero,
+        the convention of sinter.post_selection_mask_from_4th_coord.
+        origin: the builder call that appends it, e.g. 'SurgeryUnit.flags'
+        """
+        circuit.append('DETECTOR', targets, coords if self.coords else None)
+        postselected = len(coords) > 3 and coords[3] != 0
+        self.detector_rows.append([len(self.stages) - 1] + (list(coords[:3]) + [0, 0, 0])[:3]
+                                  + [postselected, self.origin_code(origin)])
+        self._record_run(1, postselected)
+
+    @property
+    def num_detectors(self):
+        return sum(num for num, _ in self.detector_runs)
+
+    def postselection_mask(self):
+        """
+        The recorded detectors as a post-selection mask: bit-packed uint8, little bit order
+        (the format of sinter.post_selection_mask_from_4th_coord and sinter.Task).
+        """
+        flags = np.repeat([postselected for _, postselected in self.detector_runs],
+                          [num for num, _ in self.detector_runs]).astype(np.bool_)
+        return np.packbits(flags, bitorder='little')
+
+    def detector_metadata(self):
+        """
+        The recorded detectors as side arrays (see DETECTOR_METADATA): 'stage' (index into 'stages', the names of
+        the stages in begin_stage order, -1 before the first one), 'x', 'y' and 'round' (the first three detector
+        coordinates, 0 where a detector has fewer), 'postselected' and 'origin' (index into 'origins', the names
+        of the builder calls).
+        Enough to rebuild the detector coordinates of a circuit built with coords=False, e.g. for diagrams,
+        see detectors.DetectorIndex for queries.
+        """
+        self._flush_detector_rows()
+        table = np.concatenate(self.detector_blocks) if self.detector_blocks else np.empty((0, len(DETECTOR_METADATA)))
+        metadata = {name: table[:, k].astype(dtype) for k, (name, dtype) in enumerate(DETECTOR_METADATA.items())}
+        metadata['stages'] = np.array([name for name, _, _ in self.stages], dtype=str)
+        metadata['origins'] = np.array(self.origins, dtype=str)
+        return metadata
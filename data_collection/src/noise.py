@@ -0,0 +1,47 @@
+import re
+import stim
+
+# noise channels whose probability is substituted on instantiation
+NOISE_GATES = ('DEPOLARIZE1', 'DEPOLARIZE2', 'X_ERROR', 'Y_ERROR', 'Z_ERROR')
+# a tagged noise instruction in stim text, e.g. "DEPOLARIZE1[sc](0.001) 1 2 3"
+TAGGED_NOISE = re.compile(r'\b(' + '|'.join(NOISE_GATES) + r')\[([^\]]*)\]\(([^)]*)\)')
+
+
+class NoiseSkeleton:
+    """
+    A circuit whose noise channels are tagged with the stage that emitted them
+    ('qrm', 'sc', 'surgery', see the noise_tag of the builders), built once for a sweep.
+    instantiate() substitutes the probabilities of the tagged channels without
+    re-running any construction logic: the stim text is pre-split at the noise
+    arguments, so an instantiation is a string join plus one stim parse.
+    Untagged channels (e.g. the noiseless final round) keep their probability.
+    """
+    def __init__(self, circuit: stim.Circuit):
+        # chunks alternate: text, gate, tag, argument, text, gate, tag, argument, ..., text
+        self.chunks = TAGGED_NOISE.split(str(circuit))
+        self.tags = sorted(set(self.chunks[2::4]))
+
+    def instantiate(self, error_rate, keep_tags: bool = False) -> stim.Circuit:
+        """
+        Args:
+            error_rate: a probability for every tagged channel, or a dict tag -> probability
+                for per-stage rates (stages not in the dict keep the skeleton's probability)
+            keep_tags: keep the noise tags in the output, e.g. to instantiate again later.
+                Without tags the result equals a circuit built directly at these rates.
+        Returns:
+            A stim circuit with the substituted noise.
+        """
+        if isinstance(error_rate, dict):
+            unknown = set(error_rate) - set(self.tags)
+            if unknown:
+                raise ValueError(f"Unknown noise tags {sorted(unknown)}. The skeleton has {self.tags}.")
+            rates = {tag: repr(float(error_rate[tag])) if tag in error_rate else None for tag in self.tags}
+        else:
+            rates = {tag: repr(float(error_rate)) for tag in self.tags}
+        parts = [self.chunks[0]]
+        for k in range(1, len(self.chunks), 4):
+            gate, tag, arg, text = self.chunks[k:k + 4]
+            rate = rates[tag] if rates[tag] is not None else arg
+            parts.append(f'{gate}[{tag}]({rate})' if keep_tags else f'{gate}({rate})')
+            parts.append(text)
+        return stim.Circuit(''.join(parts))
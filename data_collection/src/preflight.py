@@ -0,0 +1,224 @@
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import stim
+
+import src.cache as cache_lib
+from src.detectors import DetectorIndex
+
+SHOTS = 256  # noiseless shots: a random detector or observable is missed with probability 2^-256
+
+
+def _locate(circuit: stim.Circuit, detector: int):
+    # (top-level instruction position, DETECTOR instruction) of a detector id, looking into REPEAT blocks
+    for position, inst in enumerate(circuit):
+        if isinstance(inst, stim.CircuitRepeatBlock):
+            body = inst.body_copy()
+            count = body.num_detectors * inst.repeat_count
+            if detector < count:
+                return position, _locate(body, detector % body.num_detectors)[1]
+            detector -= count
+        elif inst.name == 'DETECTOR':
+            if detector == 0:
+                return position, inst
+            detector -= 1
+    raise IndexError(f"No detector {detector} in the circuit.")
+
+
+def _stage_at(stages, position):
+    # the last stage begun at or before an instruction position (see MeasurementLedger.begin_stage)
+    names = [name for name, _, begin in stages if begin <= position]
+    return names[-1] if names else ''
+
+
+def _split(result):
+    # a circuit, or a builder's (circuit, mask), (circuit, stages) or (circuit, DetectorIndex)
+    if not isinstance(result, tuple):
+        return result, None, None
+    circuit, extra = result
+    if isinstance(extra, DetectorIndex):
+        return circuit, None, extra
+    if isinstance(extra, list):
+        return circuit, extra, None
+    return circuit, None, None
+
+
+def _samples(circuit: stim.Circuit, shots: int):
+    return circuit.without_noise().compile_detector_sampler().sample(shots, separate_observables=True)
+
+
+def bisect_failure(circuit: stim.Circuit):
+    """
+    (position, instruction) of the first top-level instruction from which the noiseless circuit cannot be sampled,
+    e.g. a DETECTOR whose rec target reaches before the first measurement (stim only finds it when sampling).
+    None if the whole circuit can be sampled.
+    """
+    def fails(length):
+        try:
+            _samples(circuit[:length], 1)
+        except (IndexError, ValueError):
+            return True
+        return False
+
+    if not fails(len(circuit)):
+        return None
+    low, high = 0, len(circuit)  # circuit[:low] can be sampled, circuit[:high] cannot
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fails(middle):
+            high = middle
+        else:
+            low = middle
+    return low, circuit[low]
+
+
+def check_circuit(circuit: stim.Circuit, stages=None, index: DetectorIndex = None, shots: int = SHOTS):
+    """
+    The non-deterministic detectors and observables of a circuit, from noiseless samples compared to stim's
+    reference sample (a noiseless tableau simulation): a deterministic detector or observable never flips,
+    a random one flips in half of the shots.
+    Returns a JSON-serializable dict:
+        detectors: for each non-deterministic detector, its id, the DETECTOR instruction, its top-level instruction
+            position, its coordinates, and with `stages` (MeasurementLedger.stages) or `index` its stage;
+            with `index`, the builder call that appended it (see DetectorIndex)
+        observables: ids of the non-deterministic observables
+    """
+    detection_events, observable_flips = _samples(circuit, shots)
+    random_detectors = np.flatnonzero(detection_events.any(axis=0)).tolist()
+    coordinates = circuit.get_detector_coordinates(random_detectors)
+    detectors = []
+    for detector in random_detectors:
+        position, inst = _locate(circuit, detector)
+        found = {'id': detector, 'instruction': str(inst), 'position': position,
+                 'coords': list(coordinates.get(detector, []))}
+        if index is not None:
+            found['stage'] = str(index.stage_of(detector))
+            found['origin'] = str(index.origin_of(detector))
+            found['coords'] = index.coords(detector).tolist()
+        elif stages is not None:
+            found['stage'] = _stage_at(stages, position)
+        detectors.append(found)
+    return {'detectors': detectors, 'observables': np.flatnonzero(observable_flips.any(axis=0)).tolist()}
+
+
+def check(builder, params, shots: int = SHOTS):
+    """
+    Builds builder(**params) and checks its determinism (see check_circuit).
+    Builders returning (circuit, DetectorIndex), like magic.magic_detectors, or (circuit, stages), like
+    magic.magic_stages, locate the offending detectors in their stages and builder calls.
+    A builder raising is reported with its traceback; a circuit that cannot be sampled (e.g. a rec_shift reaching
+    before the first measurement) with the instruction found by bisect_failure, and the stage and builder call of
+    the detector if it is one.
+    Returns the dict of check_circuit with
+        params: the keyword parameters
+        ok: whether the circuit was built and all its detectors and observables are deterministic
+        error: the traceback of the builder or the check, if it raised
+        failure: with an error of the check, {'position', 'instruction'} of the failing instruction, with the
+            'id', 'stage' and 'origin' of the detector if it is a DETECTOR (as in check_circuit)
+    """
+    result = {'params': params, 'ok': False, 'error': None, 'detectors': [], 'observables': []}
+    try:
+        circuit, stages, index = _split(builder(**params))
+    except Exception:
+        result['error'] = traceback.format_exc()
+        return result
+    try:
+        result.update(check_circuit(circuit, stages, index, shots))
+    except (IndexError, ValueError):
+        result['error'] = traceback.format_exc()
+        result['failure'] = _describe_failure(circuit, stages, index)
+        return result
+    result['ok'] = not result['detectors'] and not result['observables']
+    return result
+
+
+def _describe_failure(circuit, stages, index):
+    found = bisect_failure(circuit)
+    if found is None:
+        return None
+    position, inst = found
+    failure = {'position': position, 'instruction': str(inst)}
+    if not isinstance(inst, stim.CircuitRepeatBlock) and inst.name == 'DETECTOR':
+        detector = circuit[:position].num_detectors
+        failure['id'] = detector
+        if index is not None:
+            failure['stage'] = str(index.stage_of(detector))
+            failure['origin'] = str(index.origin_of(detector))
+    if stages is not None and 'stage' not in failure:
+        failure['stage'] = _stage_at(stages, position)
+    return failure
+
+
+def _check_task(builder, params, shots, cache_dir):
+    result = check(builder, params, shots)
+    if cache_dir is not None:
+        cache_lib.CircuitCache(cache_dir).record(builder, params, 'preflight.json', result)
+    return result
+
+
+def validate(builder, grid, fixed=None, num_workers=None, cache_dir=None, shots: int = SHOTS):
+    """
+    Checks every circuit of a sweep grid (see check) in a process pool, before any of them is sampled.
+    With cache_dir, the results are stored in the cache.CircuitCache of this directory (preflight.json, next to the
+    circuits of the same key) and read back for the grid points whose builder sources and parameters are unchanged,
+    broken ones included.
+
+    Usage:
+        grid = tasks.parameter_grid(T_maintain=range(10))
+        fixed = dict(T_sc_pre=1, T_lat_surg=3, T_before_grow=1, T_ps_grow=2, error_rate=0.001)
+        results = preflight.validate(magic.magic_detectors, grid, fixed=fixed, cache_dir='circuit_cache')
+        preflight.report(results)
+        grid = preflight.passed(grid, results)
+
+    Args:
+        builder: module-level function, see check (it is sent to the pool processes by reference)
+        grid: list of keyword dicts, one per task (see tasks.parameter_grid)
+        fixed: keyword arguments shared by all tasks
+        num_workers: processes checking circuits, all cores by default
+        cache_dir: directory of the cache.CircuitCache holding the results
+        shots: noiseless shots per circuit
+    Returns:
+        the results of check, in the order of the grid
+    """
+    fixed = dict(fixed or {})
+    params = [{**fixed, **point} for point in grid]
+    results = [None] * len(params)
+    if cache_dir is not None:
+        cache = cache_lib.CircuitCache(cache_dir)
+        results = [cache.recorded(builder, point, 'preflight.json') for point in params]
+    missing = [k for k, result in enumerate(results) if result is None]
+    if missing:
+        # spawn like tasks.TaskFactory, so that the validation can run next to a sinter.collect
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as pool:
+            futures = {pool.submit(_check_task, builder, params[k], shots, cache_dir): k for k in missing}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    return results
+
+
+def passed(grid, results):
+    """The grid points whose circuits passed validate."""
+    return [point for point, result in zip(grid, results) if result['ok']]
+
+
+def report(results, file=None):
+    """Prints the failed checks of validate: the builder errors and the offending detectors and observables."""
+    failed = [result for result in results if not result['ok']]
+    print(f"{len(results) - len(failed)}/{len(results)} circuits passed the pre-flight check.", file=file)
+    for result in failed:
+        print(f"{result['params']}:", file=file)
+        if result['error'] is not None:
+            print(result['error'], file=file)
+        failure = result.get('failure')
+        if failure is not None:
+            where = ', '.join(f'{key} {failure[key]}' for key in ('id', 'stage', 'origin') if key in failure)
+            print(f"  fails at instruction {failure['position']} ({where}): {failure['instruction']}", file=file)
+        for found in result['detectors']:
+            where = ', '.join(f'{key} {found[key]}' for key in ('stage', 'origin') if key in found)
+            print(f"  non-deterministic D{found['id']} at instruction {found['position']} ({where}) "
+                  f"coords {found['coords']}: {found['instruction']}", file=file)
+        for observable in result['observables']:
+            print(f"  non-deterministic L{observable}", file=file)
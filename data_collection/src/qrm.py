@@ -1,10 +1,12 @@
 import numpy as np
 import stim
 import galois
+import src.measurements as ms
+import src.ir as ir
 
 
 class QRMCode:
-    def __init__(self, error_rate, x_pos_shift = 0):
+    def __init__(self, error_rate, x_pos_shift = 0, noise_tag = '', measurements = None):
         self.n = 15
         self.k = 1
         self.d = 3
@@ -49,6 +51,9 @@ class QRMCode:
         self.error_rate = error_rate
         self.total_qubit_number = 51  # 15 data qubits + 18 ancilla qubits + 18 flag qubits
         self.x_pos_shift = x_pos_shift  # shift the x coordinates of the QRM code qubits by this amount
+        # measurement record, shared with the other builders of the same circuit (see MeasurementLedger)
+        self.measurements = measurements if measurements is not None else ms.MeasurementLedger()
+        self.noise_tag = noise_tag  # stim tag of the noise channels, e.g. 'qrm' to build a noise skeleton (see noise.py)
 
 
     def z_syndrome_feedback_gen(self):
@@ -89,17 +94,18 @@ class QRMCode:
         Returns a QRM circuit with depolarizing noise applied.
         The error rate can be adjusted.
         """
-        circuit = stim.Circuit()
-        for i in range(1, 16):
-            circuit.append_operation("QUBIT_COORDS", [i], [self.x_pos_shift + self.get_bit(i,0) + 2 * self.get_bit(i,2), self.get_bit(i,1) + 2 * self.get_bit(i,3)])
-        for j in range(16,34):
-            circuit.append_operation("QUBIT_COORDS", [j], [self.x_pos_shift + (j - 16) % 6, 5 + (j - 16) // 6])
-        for j in range(34,52):
-            circuit.append_operation("QUBIT_COORDS", [j], [self.x_pos_shift + (j - 34) % 6, 8 + (j - 34) // 6])
+        circuit = ir.CircuitBuffer()
+        if self.measurements.coords:
+            for i in range(1, 16):
+                circuit.append_operation("QUBIT_COORDS", [i], [self.x_pos_shift + self.get_bit(i,0) + 2 * self.get_bit(i,2), self.get_bit(i,1) + 2 * self.get_bit(i,3)])
+            for j in range(16,34):
+                circuit.append_operation("QUBIT_COORDS", [j], [self.x_pos_shift + (j - 16) % 6, 5 + (j - 16) // 6])
+            for j in range(34,52):
+                circuit.append_operation("QUBIT_COORDS", [j], [self.x_pos_shift + (j - 34) % 6, 8 + (j - 34) // 6])
 
         # initialize data qubits, ancilla qubits and flags
         circuit.append('H', list(range(1, 16)) + list(range(34, 52)))
-        circuit.append("DEPOLARIZE1", range(1,52), [self.error_rate])
+        circuit.append("DEPOLARIZE1", range(1,52), [self.error_rate], tag=self.noise_tag)
         circuit.append('TICK')
 
         # one round of stabilizer measurements
@@ -110,7 +116,7 @@ class QRMCode:
                 for j in range(18):
                     CNOT_list.extend([34 + j, 16 + j])
                 circuit.append('CNOT', CNOT_list)
-                circuit.append("DEPOLARIZE2", CNOT_list, [self.error_rate])
+                circuit.append("DEPOLARIZE2", CNOT_list, [self.error_rate], tag=self.noise_tag)
                 circuit.append('TICK')
             # Z-check measurements
             CNOT_list = []
@@ -119,7 +125,7 @@ class QRMCode:
                 if qubit != 0:
                     CNOT_list.extend([qubit, 16 + j])
             circuit.append('CNOT', CNOT_list)
-            circuit.append("DEPOLARIZE2", CNOT_list, [self.error_rate])
+            circuit.append("DEPOLARIZE2", CNOT_list, [self.error_rate], tag=self.noise_tag)
             circuit.append('TICK')
             # final flags
             if i == 5:
@@ -127,23 +133,25 @@ class QRMCode:
                 for j in range(18):
                     CNOT_list.extend([34 + j, 16 + j])
                 circuit.append('CNOT', CNOT_list)
-                circuit.append("DEPOLARIZE2", CNOT_list, [self.error_rate])
+                circuit.append("DEPOLARIZE2", CNOT_list, [self.error_rate], tag=self.noise_tag)
                 circuit.append('TICK')
                 circuit.append('H', list(range(34,52)))
-                circuit.append("DEPOLARIZE1", range(34,52), [self.error_rate])
+                circuit.append("DEPOLARIZE1", range(34,52), [self.error_rate], tag=self.noise_tag)
                 circuit.append('TICK')
-        circuit.append('X_ERROR', list(range(16, 52)), [self.error_rate])
+        circuit.append('X_ERROR', list(range(16, 52)), [self.error_rate], tag=self.noise_tag)
         circuit.append('MR', list(range(16, 52)))
+        self.measurements.record(range(16, 52))
 
 
-        # metachecks
+        # metachecks (Z check c is measured by ancilla 15 + c)
         for i, mc in enumerate(self.meta_checks):
-            mc = [c - 37 for c in mc]
-            circuit.append('DETECTOR', [stim.target_rec(mc[0]),stim.target_rec(mc[1]),stim.target_rec(mc[2]),stim.target_rec(mc[3])], [self.x_pos_shift + i, 0, 0, 1])
+            self.measurements.detector(circuit, self.measurements.rec([15 + c for c in mc]), [self.x_pos_shift + i, 0, 0, 1],
+                                       origin='QRMCode.metachecks')
 
         # check flags
         for j in range(18):
-            circuit.append('DETECTOR', [stim.target_rec(-j-1)], [self.x_pos_shift + j // 4, j % 4, 1, 1]) 
+            self.measurements.detector(circuit, self.measurements.rec([51 - j]), [self.x_pos_shift + j // 4, j % 4, 1, 1],
+                                       origin='QRMCode.flags')
         circuit.append('TICK')
 
 
@@ -153,13 +161,13 @@ class QRMCode:
         for i in range(15):
             for j in range(10):
                 if self.z_syndrome_feedback[i, j] == 1:
-                    feedback_list.extend([stim.target_rec(j - 36), i + 1])
+                    feedback_list.extend(self.measurements.rec([16 + j]) + [i + 1])
         circuit.append('CZ', feedback_list)
-        circuit.append("DEPOLARIZE1", range(1,16), [self.error_rate])
+        circuit.append("DEPOLARIZE1", range(1,16), [self.error_rate], tag=self.noise_tag)
         circuit.append('TICK')
 
         # return a standard qrm code in S state
-        return circuit
+        return circuit.to_circuit()
 
 
     def Y_measurement(self, circuit):
@@ -168,41 +176,49 @@ class QRMCode:
         """
         circuit.append('S_DAG', list(range(1, 16)))
         circuit.append('H', list(range(1, 16)))
-        circuit.append("DEPOLARIZE1", range(1,16), [self.error_rate])
+        circuit.append("DEPOLARIZE1", range(1,16), [self.error_rate], tag=self.noise_tag)
         circuit.append('TICK')
 
-        circuit.append('X_ERROR', list(range(1, 16)), [self.error_rate])
+        circuit.append('X_ERROR', list(range(1, 16)), [self.error_rate], tag=self.noise_tag)
         circuit.append('MR', list(range(1, 16)))
+        self.measurements.record(range(1, 16))
         circuit.append('TICK')
     
         # readout checks
         for i, stabilizer in enumerate(self.X_checks):
-            circuit.append('DETECTOR', [stim.target_rec(i - 16) for i in stabilizer], [self.x_pos_shift + i, 0, 2, 1])
+            self.measurements.detector(circuit, self.measurements.rec(stabilizer), [self.x_pos_shift + i, 0, 2, 1],
+                                       origin='QRMCode.Y_measurement')
 
     
         # readout logical Y
-        circuit.append('OBSERVABLE_INCLUDE', [stim.target_rec(i - 15) for i in range(15)], 0)
+        circuit.append('OBSERVABLE_INCLUDE', self.measurements.rec(range(1, 16)), 0)
     
 
     def X_measurement(self, circuit, ext_stabilizer):
         """
         Returns a QRM circuit with X measurements applied.
+        ext_stabilizer: (qubit, back) pairs of measurements outside the QRM code joining the first X check,
+            resolved in the measurement ledger after the readout (back=0 latest, back=1 previous measurement).
         """
         circuit.append('H', list(range(1, 16)))
-        circuit.append("DEPOLARIZE1", range(1,16), [self.error_rate])
+        circuit.append("DEPOLARIZE1", range(1,16), [self.error_rate], tag=self.noise_tag)
         circuit.append('TICK')
 
-        circuit.append('X_ERROR', list(range(1, 16)), [self.error_rate])
+        circuit.append('X_ERROR', list(range(1, 16)), [self.error_rate], tag=self.noise_tag)
         circuit.append('MR', list(range(1, 16)))
+        self.measurements.record(range(1, 16))
         circuit.append('TICK')
     
         # readout checks
+        ext_rec = [target for q, back in ext_stabilizer for target in self.measurements.rec([q], back)]
         for i, stabilizer in enumerate(self.X_checks):
             if i > 0:
-                circuit.append('DETECTOR', [stim.target_rec(j - 16) for j in stabilizer], [self.x_pos_shift + i, 0, 2, 1])
+                self.measurements.detector(circuit, self.measurements.rec(stabilizer), [self.x_pos_shift + i, 0, 2, 1],
+                                           origin='QRMCode.X_measurement')
             else:
-                circuit.append('DETECTOR', [stim.target_rec(j - 16) for j in stabilizer] + [stim.target_rec(j) for j in ext_stabilizer], [self.x_pos_shift + i, 0, 2, 1])
+                self.measurements.detector(circuit, self.measurements.rec(stabilizer) + ext_rec, [self.x_pos_shift + i, 0, 2, 1],
+                                           origin='QRMCode.X_measurement')
 
     
         # readout logical X
-        circuit.append('OBSERVABLE_INCLUDE', [stim.target_rec(i - 15) for i in range(15)], 0)
\ No newline at end of file
+        circuit.append('OBSERVABLE_INCLUDE', self.measurements.rec(range(1, 16)), 0)
\ No newline at end of file
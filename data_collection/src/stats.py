@@ -0,0 +1,131 @@
+from collections import Counter
+
+import numpy as np
+import stim
+
+import src.passes as passes
+
+ANNOTATIONS = ('DETECTOR', 'OBSERVABLE_INCLUDE', 'QUBIT_COORDS', 'SHIFT_COORDS', 'TICK', 'MPAD')
+
+
+def gate_counts(circuit: stim.Circuit):
+    """
+    Number of operations per gate, counting REPEAT blocks as often as they repeat:
+    one per qubit for single-qubit gates, one per pair for two-qubit gates, one per product for MPP.
+    Noise channels are counted like gates, annotations (DETECTOR, TICK, ...) are not.
+    """
+    counts = Counter()
+
+    def walk(block, multiplier):
+        for inst in block:
+            if isinstance(inst, stim.CircuitRepeatBlock):
+                walk(inst.body_copy(), multiplier * inst.repeat_count)
+            elif inst.name not in ANNOTATIONS:
+                counts[inst.name] += multiplier * len(inst.target_groups())
+
+    walk(circuit, 1)
+    return dict(counts)
+
+
+def postselected_detectors(circuit: stim.Circuit):
+    """Boolean array over the detectors: True for detectors with a non-zero 4th coordinate (post-selected)."""
+    mask = np.zeros(circuit.num_detectors, dtype=np.bool_)
+    for k, coord in circuit.get_detector_coordinates().items():
+        mask[k] = len(coord) >= 4 and coord[3] != 0
+    return mask
+
+
+def postselection_mask(circuit: stim.Circuit):
+    """
+    postselected_detectors bit-packed like sinter.post_selection_mask_from_4th_coord (uint8, little bit order).
+    A pass over all detector coordinates: builders that record their detectors give the mask directly
+    (see MeasurementLedger.postselection_mask and magic.magic_preparation(with_mask=True)).
+    """
+    return np.packbits(postselected_detectors(circuit), bitorder='little')
+
+
+def dem_errors(circuit: stim.Circuit):
+    """
+    The distinct errors of the (undecomposed) detector error model, as (sorted detectors, sorted observables) they flip.
+    Errors with the same targets count once, as in the DEM of the unrolled circuit: for REPEAT blocks, stim may list
+    a mechanism in several parts.
+    """
+    dem = circuit.detector_error_model(decompose_errors=False).flattened()
+    errors = set()
+    for inst in dem:
+        if inst.type == 'error':
+            targets = inst.targets_copy()
+            errors.add((tuple(sorted(t.val for t in targets if t.is_relative_detector_id())),
+                        tuple(sorted(t.val for t in targets if t.is_logical_observable_id()))))
+    return sorted(errors)
+
+
+def undetected_error_positions(circuit: stim.Circuit, errors):
+    """
+    For errors of dem_errors that flip no detector (only observables), the top-level instruction position of a circuit
+    error causing each of them, {error: position}.
+    """
+    undetected = [error for error in errors if not error[0]]
+    if not undetected:
+        return {}
+    dem_filter = stim.DetectorErrorModel()
+    for _, observables in undetected:
+        dem_filter.append('error', 0.5, [stim.target_logical_observable_id(k) for k in observables])
+    positions = {}
+    for explained in circuit.explain_detector_error_model_errors(dem_filter=dem_filter,
+                                                                   reduce_to_one_representative_error=True):
+        observables = tuple(sorted(term.dem_target.val for term in explained.dem_error_terms))
+        positions[(), observables] = explained.circuit_error_locations[0].stack_frames[0].instruction_offset
+    return positions
+
+
+def circuit_stats(circuit: stim.Circuit, stages=None, dem=True):
+    """
+    Size of a circuit, in total and per stage, as a JSON-serializable dict (e.g. for sinter json_metadata):
+        qubits: number of qubits acted on
+        gates: operation counts by gate (see gate_counts)
+        ticks: TICK depth
+        detectors, postselected_detectors: number of detectors, and of those with a non-zero 4th coordinate
+        dem_errors, hyperedges: number of distinct errors of the detector error model (see dem_errors), and a histogram
+            {number of detectors flipped: number of errors}
+    Args:
+        stages: list of (name, first measurement, first instruction) as recorded by MeasurementLedger.begin_stage,
+            e.g. from magic.magic_stages; errors are attributed to the stage of their earliest detector,
+            errors that flip no detector to the stage of a circuit error causing them
+        dem: include the detector error model statistics (which need the DEM of the whole circuit)
+    Returns:
+        {'total': {...}, 'stages': {name: {...}}} ('stages' only if stages are given)
+    """
+    postselected = postselected_detectors(circuit)
+    errors = dem_errors(circuit) if dem else None
+    undetected = undetected_error_positions(circuit, errors) if dem and stages is not None else {}
+
+    def summary(part, first_detector, first_instruction=0):
+        num_detectors = part.num_detectors
+        stats = {
+            'qubits': int(len(passes.used_qubits(part))),
+            'gates': gate_counts(part),
+            'ticks': part.num_ticks,
+            'detectors': num_detectors,
+            'postselected_detectors': int(postselected[first_detector:first_detector + num_detectors].sum()),
+        }
+        if errors is not None:
+            if part is circuit:
+                selected = errors
+            else:
+                selected = [e for e in errors if e[0] and first_detector <= e[0][0] < first_detector + num_detectors]
+                selected += [e for e, position in undetected.items()
+                             if first_instruction <= position < first_instruction + len(part)]
+            degrees = Counter(len(detectors) for detectors, _ in selected)
+            stats['dem_errors'] = len(selected)
+            stats['hyperedges'] = {str(k): degrees[k] for k in sorted(degrees)}
+        return stats
+
+    result = {'total': summary(circuit, 0)}
+    if stages is not None:
+        result['stages'] = {}
+        first_detector = 0
+        for (name, part), (_, _, position) in zip(passes.stage_slices(circuit, stages), stages):
+            result['stages'][name] = summary(part, first_detector, position)
+            first_detector += part.num_detectors
+    return result
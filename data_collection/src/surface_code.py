@@ -1,15 +1,42 @@
 import numpy as np
 import stim
+import src.measurements as ms
+import src.ir as ir
+
+# check type codes used in the array-backed check layout
+CHECK_X = 0
+CHECK_Z = 1
+CHECK_TYPE_CODES = {'X': CHECK_X, 'Z': CHECK_Z}
+# sentinel in the data-qubit matrix for a missing corner on the boundary
+NO_QUBIT = -1
+# corner offsets of a check, in CNOT order (X checks go column-wise, Z checks row-wise)
+X_CHECK_CORNERS = np.array([[-1, -1], [-1, 1], [1, -1], [1, 1]], dtype=np.int32)
+Z_CHECK_CORNERS = np.array([[-1, -1], [1, -1], [-1, 1], [1, 1]], dtype=np.int32)
+# stands for the round coordinate in cached detector templates
+ROUND_PLACEHOLDER = '$round'
+
+
+def rows_of(check_rows: dict, check_pos):
+    """
+    Row of each position of check_pos in a layout indexed by check_rows, -1 if the position is not in it.
+    """
+    return np.fromiter((check_rows.get(pos, -1) for pos in map(tuple, check_pos.tolist())),
+                       dtype=np.int64, count=len(check_pos))
 
 class SurfaceCode:
-    def __init__(self, m: int, n: int, error_rate: float = 0.001, off_set: int = 0):
+    def __init__(self, m: int, n: int, error_rate: float = 0.001, off_set: int = 0, noise_tag: str = '', measurements=None):
         self.m = m # Number of columns
         self.n = n # Number of rows
         self.error_rate = error_rate
         self.off_set = off_set
+        self.noise_tag = noise_tag # stim tag of the noise channels, e.g. 'sc' to build a noise skeleton (see noise.py)
         self.data_dict, self.data_list = self.generate_data_dict_and_list()
-        self.check_list = self.generate_check_list(self.data_dict)
-        self.total_qubit_number = len(self.data_list) + len(self.check_list) + self.off_set
+        self.set_check_layout(*self.generate_check_layout(self.data_dict))
+        self.total_qubit_number = len(self.data_list) + self.num_checks + self.off_set
+        self.free_qubits = []  # retired qubits that growth reuses before allocating new indices (see recycle_qubits)
+        self.new_qubits = set()  # qubits allocated by the last growth
+        # measurement record, shared with the other builders of the same circuit (see MeasurementLedger)
+        self.measurements = measurements if measurements is not None else ms.MeasurementLedger()
 
     
     #########################################
@@ -19,12 +46,16 @@ class SurfaceCode:
     #     key: position, 
     #     value: index,
     # data_list: list of indices (for loop over data qubits)
-    # check_list: list of dicts: {
-    #     'type': 'X' or 'Z', 
-    #     'pos': position,
-    #     'idx': index,
-    #     'data_qubits'; indices of data qubits to check
-    # }
+    # check layout: NumPy arrays, one row per check, in measurement order
+    #     check_type: (num_checks,) int8, CHECK_X or CHECK_Z
+    #     check_idx: (num_checks,) int32, qubit index of the ancilla
+    #     check_pos: (num_checks, 2) int32, position of the ancilla
+    #     check_data: (num_checks, 4) int32, data qubits in CNOT order, NO_QUBIT for missing corners
+    # check_rows: (for finding a check in the layout from position)
+    #     key: position,
+    #     value: row in the check layout,
+    # measurements: latest and previous measurement of each qubit in the circuit,
+    #     for record lookbacks (see MeasurementLedger)
     #########################################
 
     def generate_data_dict_and_list(self):
@@ -44,100 +75,116 @@ class SurfaceCode:
                 idx += 1
         return data_dict, data_list
 
-    def generate_check_list(self, data_dict):
+    def generate_check_layout(self, data_dict):
         """
-        list of dicts: {
-            'type': 'X' or 'Z',
-            'pos': position,
-            'idx': index,
-            'data_qubits'; indices of data qubits to check
-        }
+        Array-backed check layout: X checks first, then Z checks.
+        Returns check_type, check_idx, check_pos, check_data (see Data structures).
+        Ancilla indices are assigned consecutively after the m * n data qubits.
         """
-        check_list = []
-        idx = self.m * self.n + self.off_set
         # X checks
-        for i in range(0, self.m + 1, 2):
-            for j in range(self.n - 1):
-                pos = [2 * i - 1 + 2 * (j % 2), 2 * j + 1]
-                if pos[0] <= 2 * self.m - 1:
-                    check_list.append({
-                        'type': 'X',
-                        'pos': pos,
-                        'idx': idx,
-                        'data_qubits': [
-                            data_dict.get((pos[0] - 1, pos[1] - 1)),
-                            data_dict.get((pos[0] - 1, pos[1] + 1)),
-                            data_dict.get((pos[0] + 1, pos[1] - 1)),
-                            data_dict.get((pos[0] + 1, pos[1] + 1)),
-                        ]
-                    })
-                    idx += 1
+        i, j = np.meshgrid(np.arange(0, self.m + 1, 2), np.arange(self.n - 1), indexing='ij')
+        X_pos = np.stack([2 * i - 1 + 2 * (j % 2), 2 * j + 1], axis=-1).reshape(-1, 2)
+        X_pos = X_pos[X_pos[:, 0] <= 2 * self.m - 1]
         # Z checks
-        for i in range(self.m - 1):
-            for j in range(0, self.n + 1, 2):
-                pos = [2 * i + 1, 2 * j + 1 - 2 * (i % 2)]
-                if pos[1] <= 2 * self.n - 1:
-                    check_list.append({
-                        'type': 'Z',
-                        'pos': pos,
-                        "idx": idx,
-                        'data_qubits': [
-                            data_dict.get((pos[0] - 1, pos[1] - 1)),
-                            data_dict.get((pos[0] + 1, pos[1] - 1)),
-                            data_dict.get((pos[0] - 1, pos[1] + 1)),
-                            data_dict.get((pos[0] + 1, pos[1] + 1)),
-                        ]
-                    })
-                    idx += 1
-        return check_list
+        i, j = np.meshgrid(np.arange(self.m - 1), np.arange(0, self.n + 1, 2), indexing='ij')
+        Z_pos = np.stack([2 * i + 1, 2 * j + 1 - 2 * (i % 2)], axis=-1).reshape(-1, 2)
+        Z_pos = Z_pos[Z_pos[:, 1] <= 2 * self.n - 1]
+
+        check_pos = np.concatenate([X_pos, Z_pos]).astype(np.int32)
+        check_type = np.concatenate([
+            np.full(len(X_pos), CHECK_X, dtype=np.int8),
+            np.full(len(Z_pos), CHECK_Z, dtype=np.int8),
+        ])
+        num_checks = len(check_pos)
+        check_idx = np.arange(num_checks, dtype=np.int32) + self.m * self.n + self.off_set
+
+        # look up the four corners on a grid of data qubit indices
+        data_grid = np.full((self.m, self.n), NO_QUBIT, dtype=np.int32)
+        for pos, idx in data_dict.items():
+            data_grid[pos[0] // 2, pos[1] // 2] = idx
+        corners = np.where((check_type == CHECK_X)[:, None, None], X_CHECK_CORNERS, Z_CHECK_CORNERS)
+        corner_pos = (check_pos[:, None, :] + corners) // 2
+        inside = (
+            (corner_pos[..., 0] >= 0) & (corner_pos[..., 0] < self.m)
+            & (corner_pos[..., 1] >= 0) & (corner_pos[..., 1] < self.n)
+        )
+        check_data = np.full((num_checks, 4), NO_QUBIT, dtype=np.int32)
+        check_data[inside] = data_grid[corner_pos[..., 0][inside], corner_pos[..., 1][inside]]
+        return check_type, check_idx, check_pos, check_data
+
+    def set_check_layout(self, check_type, check_idx, check_pos, check_data):
+        self.check_type = check_type
+        self.check_idx = check_idx
+        self.check_pos = check_pos
+        self.check_data = check_data
+        self.num_checks = len(check_idx)
+        self.check_rows = {pos: row for row, pos in enumerate(map(tuple, check_pos.tolist()))}
+        # compiled syndrome rounds and detector templates depend on the layout: drop them
+        self.round_cache = {}
+
+    @property
+    def check_list(self):
+        """
+        List-of-dicts view of the check layout, for plotting and debugging:
+        {'type': 'X' or 'Z', 'pos': position, 'idx': index, 'data_qubits': indices, None for missing corners}
+        """
+        return [{
+            'type': 'X' if t == CHECK_X else 'Z',
+            'pos': pos,
+            'idx': idx,
+            'data_qubits': [q if q != NO_QUBIT else None for q in data],
+        } for t, idx, pos, data in zip(
+            self.check_type.tolist(), self.check_idx.tolist(), self.check_pos.tolist(), self.check_data.tolist()
+        )]
+
+    def checks_of_type(self, type: str):
+        """Boolean mask over the check layout selecting checks of the given type."""
+        return self.check_type == CHECK_TYPE_CODES[type]
+
+    def recycle_qubits(self, qubits):
+        """
+        Hand qubits that other blocks of the circuit have measured and no longer use (e.g. the QRM code and the
+        surgery ancillas after decoupling) to the growth allocator. They are reset before their first use.
+        """
+        self.free_qubits = sorted(set(self.free_qubits) | set(qubits))
+
+    def allocate_qubits(self, num: int):
+        """num qubit indices for growth: recycled ones first, then new indices after total_qubit_number."""
+        reused = self.free_qubits[:num]
+        self.free_qubits = self.free_qubits[num:]
+        fresh = list(range(self.total_qubit_number, self.total_qubit_number + num - len(reused)))
+        self.total_qubit_number += len(fresh)
+        allocated = reused + fresh
+        self.new_qubits.update(allocated)
+        return allocated
 
     def reset_indices_for_growth(self, m_new, n_new):
         self.m = m_new
         self.n = n_new
+        self.new_qubits = set()
         new_data_dict, new_data_list = self.generate_data_dict_and_list()
-        new_check_list = self.generate_check_list(new_data_dict)
-        
-        # update data qubits and build data index map
-        data_map = {}
+
+        # update data qubits: keep indices of existing positions, allocate new ones
+        num_new = sum(1 for pos in new_data_dict if pos not in self.data_dict)
+        allocated = iter(self.allocate_qubits(num_new))
         for i, data_qubit_position in enumerate(new_data_dict):
-            idx_new_construct = new_data_dict[data_qubit_position]
-            idx_targ = 0
             if data_qubit_position in self.data_dict:
                 idx_targ = self.data_dict[data_qubit_position]
-                # print('existing data qubit found')
             else:
-                idx_targ = self.total_qubit_number
-                self.total_qubit_number += 1
-                # print('new data qubit')
+                idx_targ = next(allocated)
             new_data_dict[data_qubit_position] = idx_targ
             new_data_list[i] = idx_targ
-            data_map[idx_new_construct] = idx_targ
-            # print('reset index as', idx_new_construct, 'to', idx_targ)
         self.data_dict = new_data_dict
         self.data_list = new_data_list
 
-        # update checks
-        for i in range(len(new_check_list)):
-            check = new_check_list[i]
-            idx_targ = 0
-            if_old = False
-            for old_check in self.check_list:
-                if check['pos'] == old_check['pos']:
-                    if_old = True
-                    idx_targ = old_check['idx']
-                    # print('existing check qubit found')
-                    break
-            if not if_old:
-                idx_targ = self.total_qubit_number
-                self.total_qubit_number += 1
-                # print('new check qubit')
-            new_check_list[i]['idx'] = idx_targ
-            # print('reset index as', check['idx'], 'to', idx_targ)
-            for j in range(4):
-                idx_new_construct = check['data_qubits'][j]
-                new_check_list[i]['data_qubits'][j] = data_map.get(idx_new_construct)
-                # print('reset checked data qubit as', idx_new_construct, 'to', new_check_list[i]['data_qubits'][j])
-        self.check_list = new_check_list
+        # update checks: keep indices of checks at existing positions, allocate new ones
+        check_type, check_idx, check_pos, check_data = self.generate_check_layout(self.data_dict)
+        old_row = rows_of(self.check_rows, check_pos)
+        if_old = old_row >= 0
+        check_idx[if_old] = self.check_idx[old_row[if_old]]
+        num_new = int(np.count_nonzero(~if_old))
+        check_idx[~if_old] = np.array(self.allocate_qubits(num_new), dtype=np.int32)
+        self.set_check_layout(check_type, check_idx, check_pos, check_data)
 
     #########################################
     ############### Code cycles ##########################
@@ -151,128 +198,237 @@ class SurfaceCode:
         self.add_detectors_initial(circuit, 0, type, postselection)
         return circuit
 
-    def syndrome_cycle(self, circuit: stim.Circuit, round: int, error_rate=None, rec_shift: int=0, postselection=None):
+    def syndrome_cycle(self, circuit: stim.Circuit, round: int, error_rate=None, rec_shift=None, postselection=None):
         self.syndrome_measurement(circuit, error_rate)
         self.add_detectors(circuit, round, rec_shift=rec_shift, postselection= postselection)
 
+    def syndrome_cycles(self, circuit: stim.Circuit, round_start: int, rounds: int, error_rate=None, postselection=None, repeat=False):
+        """
+        Steady-state syndrome cycles for rounds round_start, ..., round_start + rounds - 1.
+        The first round compares with the latest measurement of each check, wherever it is in the record.
+        If repeat is True, the rounds are emitted as a single REPEAT block whose body shifts
+        the round coordinate with SHIFT_COORDS, so the circuit size does not grow with rounds.
+        The shift is undone after the block, so later coordinates are absolute again.
+        """
+        if repeat and rounds >= 2 and self.pending_rec_shift() != 0:
+            # other measurements since the latest round: the first round is not a steady-state round
+            self.syndrome_cycle(circuit, round_start, error_rate, postselection=postselection)
+            round_start += 1
+            rounds -= 1
+        if not repeat or rounds < 2:
+            for t in range(round_start, round_start + rounds):
+                self.syndrome_cycle(circuit, t, error_rate, postselection=postselection)
+            return
+        body = stim.Circuit()
+        self.syndrome_cycle(body, round_start, error_rate, postselection=postselection)
+        if self.measurements.coords:
+            body.append('SHIFT_COORDS', [], [0, 0, 1])
+        circuit += body * rounds
+        if self.measurements.coords:
+            circuit.append('SHIFT_COORDS', [], [0, 0, -rounds])
+        # the body was recorded once, record the other iterations
+        for t in range(round_start + 1, round_start + rounds):
+            self.measurements.record(self.check_idx)
+        coords = [c for t in range(round_start + 1, round_start + rounds)
+                  for c in self.detector_coords(slice(None), t, postselection)]
+        self.measurements.record_detectors((rounds - 1) * self.num_checks, postselection == 'all', coords,
+                                           origin='SurfaceCode.add_detectors')
+
     def growth_cycle(self, circuit: stim.Circuit, m_new: int, n_new: int, round: int, postselection=None):
-        old_N = self.total_qubit_number
-        old_check_list = self.check_list.copy()
+        old_check_rows = self.check_rows
         old_m = self.m
         old_n = self.n
         self.reset_indices_for_growth(m_new, n_new)
-        new_N = self.total_qubit_number
-        new_data_idx_list = []
-        new_check_idx_list = []
-        for pos in self.data_dict:
-            idx = self.data_dict[pos]
-            if idx >= old_N:
-                circuit.append("QUBIT_COORDS", idx, pos)
-                new_data_idx_list.append(idx)
-        for check in self.check_list:
-            idx = check['idx']
-            if idx in range(old_N, new_N):
-                circuit.append("QUBIT_COORDS", idx, check['pos'])
-                new_check_idx_list.append(idx)
+        # the growth cycle is written into an instruction buffer and handed to stim in one pass
+        target = circuit
+        circuit = ir.CircuitBuffer()
+        new_data_idx_list, new_check_idx_list = self.append_new_qubit_coords(circuit)
         new_data_X_idx_list = [self.data_dict[pos] for pos in self.data_dict if pos[0] > 2 * (old_m - 1)]
         circuit.append("R", new_data_idx_list + new_check_idx_list)
-        circuit.append("DEPOLARIZE1", new_data_idx_list + new_check_idx_list, self.error_rate)
+        circuit.append("DEPOLARIZE1", new_data_idx_list + new_check_idx_list, self.error_rate, tag=self.noise_tag)
         circuit.append('TICK')
         circuit.append("H", new_data_X_idx_list)
-        circuit.append("DEPOLARIZE1", new_data_X_idx_list, self.error_rate)
+        circuit.append("DEPOLARIZE1", new_data_X_idx_list, self.error_rate, tag=self.noise_tag)
 
         circuit.append('TICK')
 
         self.syndrome_measurement(circuit)
-        self.add_detectors_after_growth(circuit, old_check_list, old_m, old_n, round, postselection=postselection)
+        self.add_detectors_after_growth(circuit, old_check_rows, old_m, old_n, round, postselection=postselection)
+        target += circuit.to_circuit()
+
+    def growth_path(self, circuit: stim.Circuit, distances, round: int, postselection=None):
+        """
+        Grow the code through a sequence of distances (e.g. [7, 15, 31]) with one growth cycle per step.
+        Each step only touches the position-keyed maps of the current and the next patch,
+        so the whole path costs time linear in the final patch size.
+        Returns the round after the last growth cycle.
+        """
+        for d in distances:
+            if d > max(self.m, self.n):
+                self.growth_cycle(circuit, d, d, round, postselection=postselection)
+                round += 1
+        return round
 
     #########################################
     ############### Circuit components ##########################
     #########################################
 
     def initialize_circuit_position(self):
-        circuit = stim.Circuit()
+        circuit = ir.CircuitBuffer()
+        if not self.measurements.coords:
+            return circuit.to_circuit()
         for pos in self.data_dict:
             circuit.append("QUBIT_COORDS", self.data_dict[pos], pos)
-        for check in self.check_list:
-            circuit.append("QUBIT_COORDS", check['idx'], check['pos'])
-        return circuit
+        for idx, pos in zip(self.check_idx.tolist(), self.check_pos.tolist()):
+            circuit.append("QUBIT_COORDS", idx, pos)
+        return circuit.to_circuit()
+
+    def append_new_qubit_coords(self, circuit: stim.Circuit):
+        """
+        Declare coordinates of the qubits allocated by the last growth (self.new_qubits), unless the ledger
+        leaves coordinates out.
+        Returns the lists of new data qubits and new check qubits.
+        """
+        coords = self.measurements.coords
+        new_data_idx_list = []
+        for pos in self.data_dict:
+            idx = self.data_dict[pos]
+            if idx in self.new_qubits:
+                if coords:
+                    circuit.append("QUBIT_COORDS", idx, pos)
+                new_data_idx_list.append(idx)
+        is_new = np.isin(self.check_idx, list(self.new_qubits))
+        new_check_idx_list = self.check_idx[is_new].tolist()
+        for idx, pos in zip(new_check_idx_list, self.check_pos[is_new].tolist()):
+            if coords:
+                circuit.append("QUBIT_COORDS", idx, pos)
+        return new_data_idx_list, new_check_idx_list
 
     def initialize_circuit(self, circuit: stim.Circuit, type: str):
         # Initialize data qubits
         circuit.append("R", self.data_list)
         # Initialize ancilla qubits
-        check_idx_list = [check['idx'] for check in self.check_list]
-        circuit.append("R", check_idx_list)
+        circuit.append("R", self.check_idx.tolist())
 
         if type == 'X':
             circuit.append('H', self.data_list)
-            circuit.append("DEPOLARIZE1", self.data_list, self.error_rate)
+            circuit.append("DEPOLARIZE1", self.data_list, self.error_rate, tag=self.noise_tag)
 
     def depolarize_all(self, circuit: stim.Circuit):
-        circuit.append("DEPOLARIZE1", self.data_list, self.error_rate)
-        check_idx_list = [check['idx'] for check in self.check_list]
-        circuit.append("DEPOLARIZE1", check_idx_list, self.error_rate)
+        circuit += self.compiled_round('depolarize')
+
+    def build_depolarize_all(self, circuit: stim.Circuit, error_rate=None):
+        error_rate, tag = self.noise_for(error_rate)
+        circuit.append("DEPOLARIZE1", self.data_list, error_rate, tag=tag)
+        circuit.append("DEPOLARIZE1", self.check_idx.tolist(), error_rate, tag=tag)
         circuit.append('TICK')
 
+    def CNOT_layer_targets(self, i: int, check_mask=None):
+        """
+        Flattened CNOT targets of the i-th CNOT layer: ancilla -> data for X checks, data -> ancilla for Z checks.
+        check_mask optionally restricts the layer to a subset of checks.
+        """
+        data_qubit = self.check_data[:, i]
+        present = data_qubit != NO_QUBIT
+        if check_mask is not None:
+            present &= check_mask
+        is_X = (self.check_type == CHECK_X)[:, None]
+        pairs = np.where(is_X,
+                         np.stack([self.check_idx, data_qubit], axis=-1),
+                         np.stack([data_qubit, self.check_idx], axis=-1))
+        return pairs[present].ravel().tolist()
+
     def syndrome_measurement(self, circuit: stim.Circuit, error_rate=None):
-        # use specified error rate if provided, otherwise use the default one
+        # use specified error rate if provided, otherwise use the default one (see noise_for)
+        circuit += self.compiled_round('XZ', error_rate)
+        self.measurements.record(self.check_idx)
+
+    def Z_syndrome_measurement(self, circuit: stim.Circuit, error_rate=None):
+        # use specified error rate if provided, otherwise use the default one (see noise_for)
+        circuit += self.compiled_round('Z', error_rate)
+        self.measurements.record(self.check_idx[self.checks_of_type('Z')])
+
+    def pending_rec_shift(self):
+        """
+        Number of measurements recorded after the latest round of all checks
+        (the rec_shift of the next round's detectors), None if the checks were not measured in one round.
+        """
+        start = self.measurements.position[self.check_idx] - np.arange(self.num_checks)
+        if np.any(start < 0) or np.any(start != start[0]):
+            return None
+        return int(self.measurements.count - start[0] - self.num_checks)
+
+    def noise_for(self, error_rate=None):
+        """
+        (rate, tag) of the noise of a round: without an explicit rate, the code's own error rate, tagged;
+        an explicit rate (e.g. 0 for the noiseless final round) is left untagged, so that it is kept fixed
+        when a noise skeleton is instantiated, whatever rate the skeleton was built at.
+        """
         if error_rate is None:
-            error_rate = self.error_rate
+            return self.error_rate, self.noise_tag
+        return error_rate, ''
 
+    def compiled_round(self, kind: str, error_rate=None):
+        """
+        A syndrome measurement round of the current layout as a stim.Circuit fragment,
+        built once per (kind, error_rate) through an instruction buffer and reused until the layout changes.
+        error_rate: an explicit rate, or None for the code's own (tagged) noise, see noise_for.
+        kind: 'XZ' for a full round, 'Z' for a round of Z checks only,
+            'depolarize' for the idle noise on all qubits before a round.
+        """
+        key = (kind, error_rate)
+        if key not in self.round_cache:
+            fragment = ir.CircuitBuffer()
+            if kind == 'XZ':
+                self.build_syndrome_round(fragment, error_rate)
+            elif kind == 'Z':
+                self.build_Z_syndrome_round(fragment, error_rate)
+            elif kind == 'depolarize':
+                self.build_depolarize_all(fragment, error_rate)
+            else:
+                raise ValueError(f"Unsupported round kind '{kind}'. Use 'XZ', 'Z' or 'depolarize'.")
+            self.round_cache[key] = fragment.to_circuit()
+        return self.round_cache[key]
+
+    def build_syndrome_round(self, circuit: stim.Circuit, error_rate=None):
+        error_rate, tag = self.noise_for(error_rate)
         # initialize X-check ancillae
-        X_check_idx_list = [check['idx'] for check in self.check_list if check['type'] == 'X']
+        X_check_idx_list = self.check_idx[self.checks_of_type('X')].tolist()
         circuit.append('H', X_check_idx_list)
-        circuit.append("DEPOLARIZE1", X_check_idx_list, error_rate)
+        circuit.append("DEPOLARIZE1", X_check_idx_list, error_rate, tag=tag)
         circuit.append('TICK')
 
         # CNOT layers
         for i in range(4):
-            CNOT_idx_list = []
-            for check in self.check_list:
-                data_qubit = check['data_qubits'][i]
-                if data_qubit is None:
-                    continue
-                if check['type'] == 'X':
-                    CNOT_idx_list.extend([check['idx'], data_qubit])
-                if check['type'] == 'Z':
-                    CNOT_idx_list.extend([data_qubit, check['idx']])
+            CNOT_idx_list = self.CNOT_layer_targets(i)
             circuit.append('CNOT', CNOT_idx_list)
-            circuit.append("DEPOLARIZE2", CNOT_idx_list, error_rate)
+            circuit.append("DEPOLARIZE2", CNOT_idx_list, error_rate, tag=tag)
             circuit.append('TICK')
 
         # Hadamard layer for X-check ancillae
         circuit.append('H', X_check_idx_list)
-        circuit.append("DEPOLARIZE1", X_check_idx_list, error_rate)
+        circuit.append("DEPOLARIZE1", X_check_idx_list, error_rate, tag=tag)
         circuit.append('TICK')
 
         # syndrome measurement
-        check_idx_list = [check['idx'] for check in self.check_list]
-        circuit.append('X_ERROR', check_idx_list, error_rate)
+        check_idx_list = self.check_idx.tolist()
+        circuit.append('X_ERROR', check_idx_list, error_rate, tag=tag)
         circuit.append('MR', check_idx_list)
         circuit.append('TICK')
 
-    def Z_syndrome_measurement(self, circuit: stim.Circuit, error_rate=None):
-        # use specified error rate if provided, otherwise use the default one
-        if error_rate is None:
-            error_rate = self.error_rate
-
+    def build_Z_syndrome_round(self, circuit: stim.Circuit, error_rate=None):
+        error_rate, tag = self.noise_for(error_rate)
         # CNOT layers
+        is_Z = self.checks_of_type('Z')
         for i in range(4):
-            CNOT_idx_list = []
-            for check in self.check_list:
-                data_qubit = check['data_qubits'][i]
-                if data_qubit is None:
-                    continue
-                if check['type'] == 'Z':
-                    CNOT_idx_list.extend([data_qubit, check['idx']])
+            CNOT_idx_list = self.CNOT_layer_targets(i, check_mask=is_Z)
             circuit.append('CNOT', CNOT_idx_list)
-            circuit.append("DEPOLARIZE2", CNOT_idx_list, error_rate)
+            circuit.append("DEPOLARIZE2", CNOT_idx_list, error_rate, tag=tag)
             circuit.append('TICK')
 
         # syndrome measurement
-        check_idx_list = [check['idx'] for check in self.check_list if check['type'] == 'Z']
-        circuit.append('X_ERROR', check_idx_list, error_rate)
+        check_idx_list = self.check_idx[is_Z].tolist()
+        circuit.append('X_ERROR', check_idx_list, error_rate, tag=tag)
         circuit.append('MR', check_idx_list)
         circuit.append('TICK')
 
@@ -280,28 +436,31 @@ class SurfaceCode:
         # Hadamard for X measurement
         if type == 'X':
             circuit.append('H', self.data_list)
-            circuit.append("DEPOLARIZE1", self.data_list, self.error_rate)
+            circuit.append("DEPOLARIZE1", self.data_list, self.error_rate, tag=self.noise_tag)
             circuit.append('TICK')
 
         # Measure all data qubits
-        circuit.append('X_ERROR', self.data_list, self.error_rate)
+        circuit.append('X_ERROR', self.data_list, self.error_rate, tag=self.noise_tag)
         circuit.append('MR', self.data_list)
-
-        # Extract Z/X-syndrome and make a detector
-        for i, check in enumerate(self.check_list):
-            if check['type'] == type:
-                qubit_rec_shift = - self.m * self.n # shift (0, mn) to (-mn, 0)
-                check_rec_shift = - 2 * self.m * self.n + 1 # shift (0, mn-1) to (-2mn + 1, -mn)
-                detector_list = [stim.target_rec(i + check_rec_shift)] + [stim.target_rec(self.data_list.index(check['data_qubits'][j]) + qubit_rec_shift) for j in range(4) if check['data_qubits'][j] != None]
-                circuit.append('DETECTOR', detector_list, [check['pos'][0], check['pos'][1], round])
+        self.measurements.record(self.data_list)
+
+        # Extract Z/X-syndrome and make a detector:
+        # the check's latest measurement and the final measurements of its data qubits
+        is_type = self.checks_of_type(type)
+        check_data = self.check_data[is_type]
+        present = check_data != NO_QUBIT
+        check_rec = self.measurements.lookback(self.check_idx[is_type]).tolist()
+        data_rec = np.zeros(check_data.shape, dtype=np.int64)
+        data_rec[present] = self.measurements.lookback(check_data[present])
+        recs = [[c] + [r for r, p in zip(rs, ps) if p] for c, rs, ps in zip(check_rec, data_rec.tolist(), present.tolist())]
+        self.append_detectors(circuit, recs, self.detector_coords(is_type, round), origin='SurfaceCode.logical_measurement')
 
         # Extract logical Z/X
-        qubit_rec_shift = - self.m * self.n # shift (0, mn) to (-mn, 0)
         logical = []
         if type == 'Z':
-            logical = [stim.target_rec(self.data_list.index(self.data_dict[(0, i * 2)]) + qubit_rec_shift) for i in range(self.n)]
+            logical = self.measurements.rec([self.data_dict[(0, i * 2)] for i in range(self.n)])
         elif type == 'X':
-            logical = [stim.target_rec(self.data_list.index(self.data_dict[(i * 2, 0)]) + qubit_rec_shift) for i in range(self.m)]
+            logical = self.measurements.rec([self.data_dict[(i * 2, 0)] for i in range(self.m)])
         circuit.append('OBSERVABLE_INCLUDE', logical, 0)
 
     def Y_measurement_noiseless(self, circuit: stim.Circuit):
@@ -317,59 +476,97 @@ class SurfaceCode:
 
         logical_Y = stim.target_combined_paulis(logical_Y)
         circuit.append('MPP', logical_Y)
+        self.measurements.advance(1)
 
         circuit.append('OBSERVABLE_INCLUDE', stim.target_rec(-1), 0)
 
-    def add_detectors(self, circuit: stim.Circuit, round: int, rec_shift: int = 0, postselection=None):
-        check_count = len(self.check_list)
-        for i_crr, check in enumerate(self.check_list):
-            rec_crr  = stim.target_rec(-(check_count - i_crr))
-            rec_prev = stim.target_rec(-(check_count - i_crr) - check_count - rec_shift)
-            detector_pos = [check['pos'][0], check['pos'][1], round]
-            if postselection == 'all':
-                detector_pos.append(1)
-            circuit.append('DETECTOR', [rec_crr, rec_prev], detector_pos)
+    def detector_coords(self, check_mask, round: int, postselection=None):
+        """
+        Detector coordinates [x, y, round] (plus a 4th coordinate 1 if post-selected) of the selected checks.
+        """
+        pos = self.check_pos[check_mask]
+        coords = np.empty((len(pos), 4 if postselection == 'all' else 3), dtype=np.int64)
+        coords[:, :2] = pos
+        coords[:, 2] = round
+        if postselection == 'all':
+            coords[:, 3] = 1
+        return coords.tolist()
+
+    def append_detectors(self, circuit: stim.Circuit, recs, coords, origin: str = ''):
+        """
+        Append one DETECTOR per row: recs[k] lists the (negative) record offsets, coords[k] the coordinates.
+        origin: the builder call recorded with them in the ledger
+        """
+        for rec, coord in zip(recs, coords):
+            self.measurements.detector(circuit, [stim.target_rec(r) for r in rec], coord, origin=origin)
+
+    def add_detectors(self, circuit: stim.Circuit, round: int, rec_shift=None, postselection=None):
+        """
+        Detectors comparing the round just measured with the previous measurement of each check.
+        rec_shift is the number of measurements between the two rounds; by default it is read from the ledger.
+        """
+        if rec_shift is None:
+            check_count = self.num_checks
+            rec_prev = self.measurements.lookback(self.check_idx, back=1)
+            shift = np.arange(-check_count, 0) - check_count - rec_prev
+            if np.any(shift != shift[0]):
+                # the previous round was interleaved with other measurements
+                recs = np.stack([self.measurements.lookback(self.check_idx), rec_prev], axis=-1)
+                self.append_detectors(circuit, recs.tolist(), self.detector_coords(slice(None), round, postselection),
+                                      origin='SurfaceCode.add_detectors')
+                return
+            rec_shift = int(shift[0])
+        coords = self.measurements.coords
+        key = ('detectors', rec_shift, postselection, coords)
+        if key not in self.round_cache:
+            check_count = self.num_checks
+            rec_crr = np.arange(-check_count, 0)
+            rec_prev = rec_crr - check_count - rec_shift
+            ps = ', 1' if postselection == 'all' else ''
+            # the round coordinate is filled in per call
+            self.round_cache[key] = ''.join(
+                (f'DETECTOR({x}, {y}, {ROUND_PLACEHOLDER}{ps})' if coords else 'DETECTOR') + f' rec[{c}] rec[{p}]\n'
+                for (x, y), c, p in zip(self.check_pos.tolist(), rec_crr.tolist(), rec_prev.tolist())
+            )
+        circuit += stim.Circuit(self.round_cache[key].replace(ROUND_PLACEHOLDER, str(round)))
+        self.measurements.record_detectors(self.num_checks, postselection == 'all',
+                                           self.detector_coords(slice(None), round, postselection), origin='SurfaceCode.add_detectors')
 
     def add_detectors_initial(self, circuit: stim.Circuit, round: int, type: str, postselection=None):
-        check_count = len(self.check_list)
-        for i_crr, check in enumerate(self.check_list):
-            if check['type'] == type:
-                rec_crr  = stim.target_rec(-(check_count - i_crr))
-                detector_pos = [check['pos'][0], check['pos'][1], round]
-                if postselection == 'all':
-                    detector_pos.append(1)
-                circuit.append('DETECTOR', [rec_crr], detector_pos)
-
-    def add_detectors_after_growth(self, circuit: stim.Circuit, old_check_list, old_m, old_n, round:int, postselection=None):
+        check_count = self.num_checks
+        is_type = self.checks_of_type(type)
+        rec_crr = np.arange(-check_count, 0)[is_type]
+        coords = self.detector_coords(is_type, round, postselection)
+        self.append_detectors(circuit, rec_crr[:, None].tolist(), coords, origin='SurfaceCode.add_detectors_initial')
+
+    def add_detectors_after_growth(self, circuit: stim.Circuit, old_check_rows, old_m, old_n, round:int, postselection=None):
         # 3 cases:
         #   1. The check qubit is in the old list: the detector compares measurement in this round with the previous round
         #   2. The check is of type-Z and pos[0] < 2 * (old_m - 1) and pos[1] > 2 * old_n: the detector is directly this round of measurement
         #   3. The check is of type-X and pos[0] > 2 * old_m: the detector is directly this round of measurement
-        old_positions = {tuple(ch['pos']) for ch in old_check_list}
-        prev_check_count = len(old_check_list)
-        curr_check_count = len(self.check_list)
-        pos_to_prev_idx = {tuple(ch['pos']): i for i, ch in enumerate(old_check_list)}
-
-        for i_curr, check in enumerate(self.check_list):
-            pos = tuple(check['pos'])
-            pos_t = [pos[0], pos[1], round]
-            if postselection == 'all':
-                pos_t.append(1)
-
-            # REC of this round for this check (based on MR order, not qubit index)
-            rec_curr = stim.target_rec(-(curr_check_count - i_curr))
-
-            # Case 1: existing check within old region -> compare with previous round
-            if pos in old_positions:
-                i_prev = pos_to_prev_idx[pos]
-                rec_prev = stim.target_rec(-(curr_check_count + (prev_check_count - i_prev)))
-                circuit.append('DETECTOR', [rec_curr, rec_prev], pos_t)
-            # Case 2: new Z-check -> single-round detector
-            elif check['type'] == 'Z' and (pos[0] < 2 * (old_m - 1) and pos[1] > 2 * old_n):
-                circuit.append('DETECTOR', [rec_curr], pos_t)
-            # Case 3: new X-check -> single-round detector
-            elif check['type'] == 'X' and pos[0] > 2 * old_m:
-                circuit.append('DETECTOR', [rec_curr], pos_t)
+        curr_check_count = self.num_checks
+        i_prev = rows_of(old_check_rows, self.check_pos)
+
+        # REC of this round for each check (based on MR order, not qubit index)
+        rec_curr = np.arange(-curr_check_count, 0)
+        pos = self.check_pos
+        # Case 1: existing check within old region -> compare with previous round
+        is_old = i_prev >= 0
+        # its previous measurement is read from the ledger: other stages may have measured since (e.g. no round
+        # between the surgery and the growth), so it is not always the round just before this one
+        rec_prev = np.zeros(curr_check_count, dtype=np.int64)
+        rec_prev[is_old] = self.measurements.lookback(self.check_idx[is_old], back=1)
+        # Case 2: new Z-check -> single-round detector
+        new_Z = ~is_old & self.checks_of_type('Z') & (pos[:, 0] < 2 * (old_m - 1)) & (pos[:, 1] > 2 * old_n)
+        # Case 3: new X-check -> single-round detector
+        new_X = ~is_old & self.checks_of_type('X') & (pos[:, 0] > 2 * old_m)
+
+        selected = is_old | new_Z | new_X
+        recs = [[c, p] if old else [c] for c, p, old in zip(
+            rec_curr[selected].tolist(), rec_prev[selected].tolist(), is_old[selected].tolist()
+        )]
+        self.append_detectors(circuit, recs, self.detector_coords(selected, round, postselection),
+                              origin='SurfaceCode.add_detectors_after_growth')
 
     def encoding(self, gate: list[str] = ['I']):
         """
@@ -381,7 +578,7 @@ class SurfaceCode:
         src_idx = self.data_dict[(0, 0)]
 
         circuit.append("R", self.data_list)
-        circuit.append("R", [c['idx'] for c in self.check_list])
+        circuit.append("R", self.check_idx.tolist())
 
         # Apply single-qubit Clifford gate to the source data qubit
         for g in gate:
@@ -425,34 +622,21 @@ class SurfaceCode:
         return circuit
 
     def grow_code(self, circuit: stim.Circuit, round_start: int, round_end: int, m_new: int, n_new: int, postselection=None):
-        old_N = self.total_qubit_number
-        old_check_list = self.check_list.copy()
+        old_check_rows = self.check_rows
         old_m = self.m
         old_n = self.n
         self.reset_indices_for_growth(m_new, n_new)
-        new_N = self.total_qubit_number
-        new_data_idx_list = []
-        new_check_idx_list = []
-        for pos in self.data_dict:
-            idx = self.data_dict[pos]
-            if idx >= old_N:
-                circuit.append("QUBIT_COORDS", idx, pos)
-                new_data_idx_list.append(idx)
-        for check in self.check_list:
-            idx = check['idx']
-            if idx in range(old_N, new_N):
-                circuit.append("QUBIT_COORDS", idx, check['pos'])
-                new_check_idx_list.append(idx)
+        new_data_idx_list, new_check_idx_list = self.append_new_qubit_coords(circuit)
         new_data_X_idx_list = [self.data_dict[pos] for pos in self.data_dict if pos[0] > 2 * (old_m - 1)]
         circuit.append("R", new_data_idx_list + new_check_idx_list)
         circuit.append("H", new_data_X_idx_list)
-        circuit.append("DEPOLARIZE1", new_data_X_idx_list, self.error_rate)
+        circuit.append("DEPOLARIZE1", new_data_X_idx_list, self.error_rate, tag=self.noise_tag)
 
         circuit.append('TICK')
 
         self.depolarize_all(circuit)
         self.syndrome_measurement(circuit)
-        self.add_detectors_after_growth(circuit, old_check_list, old_m, old_n, round_start, postselection=postselection)
+        self.add_detectors_after_growth(circuit, old_check_rows, old_m, old_n, round_start, postselection=postselection)
 
         for t in range(round_start+1, round_end):
             self.depolarize_all(circuit)
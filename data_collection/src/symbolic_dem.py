@@ -0,0 +1,158 @@
+import math
+import re
+
+import numpy as np
+import scipy.sparse as sp
+import stim
+
+import src.noise as noise
+
+# a noise instruction in stim text, tagged or not, e.g. "DEPOLARIZE1[sc](0.001)"
+NOISE_CHANNEL = re.compile(r'\b(' + '|'.join(noise.NOISE_GATES) + r')(?:\[([^\]]*)\])?\(([^)]*)\)')
+# an error line of a DEM: probability and targets
+DEM_ERROR = re.compile(r'^error\(([^)]*)\) (.*)$')
+REFERENCE_RATE = 0.01  # rate of the channels of a group when counting its contributions
+
+
+def independent_log(gate: str, rate):
+    """
+    log(1 - 2 q) for the independent components (probability q each) that stim splits a channel of the given rate into:
+    DEPOLARIZE1(p) into 3 with 1 - 2q = (1 - 4p/3)^(1/2), DEPOLARIZE2(p) into 15 with 1 - 2q = (1 - 16p/15)^(1/8),
+    X_ERROR, Y_ERROR and Z_ERROR(p) into one with q = p.
+    """
+    rate = np.asarray(rate, dtype=np.float64)
+    if gate == 'DEPOLARIZE1':
+        return np.log1p(-4 * rate / 3) / 2
+    if gate == 'DEPOLARIZE2':
+        return np.log1p(-16 * rate / 15) / 8
+    return np.log1p(-2 * rate)
+
+
+class SymbolicDem:
+    """
+    The detector error model of a noise-tagged circuit (see noise.NoiseSkeleton) as a function of the noise rates.
+    The detectors and observables each error flips do not depend on the rates: every error of the DEM is an XOR of
+    independent components of the circuit's channels, so its probability is
+        p = (1 - prod_g (1 - 2 q_g)^n_g) / 2
+    over the channel groups g = (gate, tag), with q_g the component probability of the group's channels at their rate
+    and n_g the number of components of the group that flip exactly these detectors and observables.
+    The counts n_g are found once, from one DEM per group; instantiating the DEM for other rates is a sparse
+    matrix-vector product, without circuit analysis.
+    Untagged channels keep their probability, like in NoiseSkeleton.instantiate.
+
+    Usage:
+        symbolic = SymbolicDem(magic.magic_preparation(..., noise_tags=True))
+        dem = symbolic.instantiate(1e-3)  # == NoiseSkeleton(circuit).instantiate(1e-3).detector_error_model() up to rounding
+        H, L, p = symbolic.matrices({'qrm': 1e-3, 'sc': 2e-3, 'surgery': 1e-3})
+    """
+    def __init__(self, circuit: stim.Circuit):
+        # chunks alternate: text, gate, tag, argument, text, gate, tag, argument, ..., text
+        # (unrolled: stim's loop folding can list an error several times)
+        self.chunks = NOISE_CHANNEL.split(str(circuit.flattened()))
+        channels = list(zip(self.chunks[1::4], self.chunks[2::4], self.chunks[3::4]))
+        self.tags = sorted({tag for _, tag, _ in channels if tag is not None})
+        # groups of channels with one rate: (gate, tag, None) for tagged channels, (gate, None, probability)
+        # for untagged ones (noiseless channels add no error)
+        self.groups = sorted({(gate, tag, None) if tag is not None else (gate, None, float(arg))
+                              for gate, tag, arg in channels if tag is not None or float(arg) != 0},
+                             key=lambda group: (group[0], group[1] or '', group[2] or 0))
+
+        counts = {}
+        for g, group in enumerate(self.groups):
+            for targets, n in self._group_counts(group).items():
+                counts.setdefault(targets, {})[g] = n
+        # stim's order: sorted by targets, detectors before observables
+        self.targets = sorted(counts, key=lambda targets: [(t[0] == 'L', int(t[1:])) for t in targets.split()])
+        rows = [k for k, targets in enumerate(self.targets) for _ in counts[targets]]
+        cols = [g for targets in self.targets for g in counts[targets]]
+        values = [n for targets in self.targets for n in counts[targets].values()]
+        # (errors, groups) numbers of components
+        self.counts = sp.csr_matrix((values, (rows, cols)), shape=(len(self.targets), len(self.groups)), dtype=np.float64)
+
+        noiseless = self._group_text(None)
+        self.num_detectors = noiseless.num_detectors
+        self.num_observables = noiseless.num_observables
+        self.H, self.L = self._matrices()
+        # detector and observable declarations of the DEM; stim only declares a detector without coordinates
+        # or an observable if no error flips it
+        self.declarations = str(noiseless.detector_error_model()).splitlines()
+
+    def _group_text(self, group):
+        # the circuit with only the channels of one group noisy, tags removed
+        parts = [self.chunks[0]]
+        for k in range(1, len(self.chunks), 4):
+            gate, tag, arg, text = self.chunks[k:k + 4]
+            if group is not None and (gate, tag, None if tag is not None else float(arg)) == group:
+                rate = repr(REFERENCE_RATE) if tag is not None else arg
+            else:
+                rate = '0'
+            parts.append(f'{gate}({rate})')
+            parts.append(text)
+        return stim.Circuit(''.join(parts))
+
+    def _group_counts(self, group):
+        gate, tag, fixed = group
+        log_component = float(independent_log(gate, REFERENCE_RATE if tag is not None else fixed))
+        counts = {}
+        for line in str(self._group_text(group).detector_error_model()).splitlines():
+            match = DEM_ERROR.match(line)
+            if match is None:
+                continue
+            n = math.log1p(-2 * float(match.group(1))) / log_component
+            if abs(n - round(n)) > 1e-6:
+                raise ValueError(f"Non-integer number of {gate} components ({n}) for the error {match.group(2)}.")
+            counts[match.group(2)] = round(n)
+        return counts
+
+    def _matrices(self):
+        rows = {'D': [], 'L': []}
+        cols = {'D': [], 'L': []}
+        for k, targets in enumerate(self.targets):
+            for t in targets.split():
+                rows[t[0]].append(int(t[1:]))
+                cols[t[0]].append(k)
+
+        def matrix(kind, num_rows):
+            data = np.ones(len(rows[kind]), dtype=np.uint8)
+            return sp.csc_matrix((data, (rows[kind], cols[kind])), shape=(num_rows, len(self.targets)))
+
+        return matrix('D', self.num_detectors), matrix('L', self.num_observables)
+
+    def probabilities(self, error_rate):
+        """
+        Probabilities of the errors (in the order of self.targets) at the given rates.
+        Args:
+            error_rate: a rate for every tag, or a dict tag -> rate (as in NoiseSkeleton.instantiate,
+                all tags must then be given)
+        """
+        if isinstance(error_rate, dict):
+            unknown = set(error_rate) - set(self.tags)
+            missing = set(self.tags) - set(error_rate)
+            if unknown or missing:
+                raise ValueError(f"Rates for {sorted(error_rate)} given, the circuit has the noise tags {self.tags}.")
+            rates = error_rate
+        else:
+            rates = {tag: error_rate for tag in self.tags}
+        logs = np.array([independent_log(gate, rates[tag] if tag is not None else fixed)
+                         for gate, tag, fixed in self.groups], dtype=np.float64)
+        return -np.expm1(self.counts @ logs) / 2
+
+    def matrices(self, error_rate):
+        """
+        (H, L, p) at the given rates: the (detectors, errors) parity-check and (observables, errors) observable
+        matrices (CSC, uint8) and the error probabilities, as in sparse_dem / hypergraph_decoders.
+        H and L are shared by all rates.
+        """
+        return self.H, self.L, self.probabilities(error_rate)
+
+    def instantiate(self, error_rate) -> stim.DetectorErrorModel:
+        """The stim.DetectorErrorModel at the given rates (errors of probability 0 are left out, as stim does)."""
+        p = self.probabilities(error_rate)
+        lines = [f'error({q!r}) {targets}' for q, targets in zip(p.tolist(), self.targets) if q > 0]
+        possible = (p > 0).astype(np.uint8)
+        flipped = {'D': self.H @ possible, 'L': self.L @ possible}
+        for line in self.declarations:
+            name, _, target = line.partition(' ')
+            if '(' in name or not flipped[target[0]][int(target[1:])]:
+                lines.append(line)
+        return stim.DetectorErrorModel('\n'.join(lines))
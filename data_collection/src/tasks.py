@@ -0,0 +1,109 @@
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import sinter
+
+import src.cache as cache_lib
+import src.stats as stats
+
+
+def parameter_grid(**axes):
+    """
+    All combinations of the given parameter values, as keyword dicts.
+    e.g. parameter_grid(T_ps_grow=range(10), error_rate=[0.001]) -> [{'T_ps_grow': 0, 'error_rate': 0.001}, ...]
+    """
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def _build_task(builder, params, postselection, with_stats, cache_dir):
+    if cache_dir is not None and not with_stats:
+        cache = cache_lib.CircuitCache(cache_dir)
+        circuit = cache.circuit(builder, params)
+        mask = cache.postselection_mask(builder, params) if postselection else None
+        # a plain array to send back to the main process
+        return circuit, None if mask is None else np.array(mask), None
+    if not with_stats:
+        circuit, mask = cache_lib.build_with_mask(builder, params, postselection)
+        return circuit, mask, None
+    circuit = builder(**params)
+    # builders such as magic.magic_stages also return the stage marks of the circuit
+    circuit, stages = circuit if isinstance(circuit, tuple) else (circuit, None)
+    mask = stats.postselection_mask(circuit) if postselection else None
+    return circuit, mask, stats.circuit_stats(circuit, stages)
+
+
+class TaskFactory:
+    """
+    Builds the circuits of a parameter sweep in a process pool, then hands them to sinter.collect.
+    The two phases do not overlap: sinter.collect draws all its tasks (list(tasks)) before it starts sampling,
+    so the pool only shortens the build phase, which otherwise runs one circuit after the other.
+
+    Usage:
+        tasks = TaskFactory(magic.magic_preparation, parameter_grid(T_ps_grow=range(10)),
+                            fixed=dict(T_sc_pre=1, T_lat_surg=3, T_before_grow=1, T_maintain=0, error_rate=0.001))
+        sinter.collect(num_workers=16, tasks=tasks, decoders=['pymatching'], ...)  # or tasks.build()
+
+    Args:
+        builder: module-level function returning a stim circuit, or a (circuit, stages) pair like magic.magic_stages
+            (it is sent to the pool processes by reference)
+        grid: list of keyword dicts, one per task (see parameter_grid)
+        fixed: keyword arguments shared by all tasks
+        metadata: function of the grid point returning the json_metadata of the task, the grid point itself by default
+        num_workers: processes building circuits, all cores by default
+        postselection: post-select on the detectors with a non-zero 4th coordinate, with the mask recorded by the
+            builder if it can (see cache.records_mask), else read off the circuit (stats.postselection_mask)
+        with_stats: add the circuit statistics (stats.circuit_stats, per stage if the builder returns stages)
+            to json_metadata under 'stats'
+        cache_dir: read the circuits and masks from a cache.CircuitCache in this directory, building only the
+            missing ones (not used with with_stats, which needs the builder's stages)
+        initializer: function of the task parameters (list of keyword dicts) returning (initializer, initargs) of
+            the pool processes, e.g. magic.prefix_initializer: the stage prefixes shared by several tasks are then
+            built once here and handed to every process, rather than rebuilt by each process that gets such a task
+    """
+    def __init__(self, builder, grid, fixed=None, metadata=None, num_workers=None, postselection=True, with_stats=False,
+                 cache_dir=None, initializer=None):
+        self.builder = builder
+        self.grid = list(grid)
+        self.fixed = dict(fixed or {})
+        self.metadata = metadata if metadata is not None else dict
+        self.num_workers = num_workers
+        self.postselection = postselection
+        self.with_stats = with_stats
+        self.cache_dir = cache_dir
+        self.initializer = initializer
+
+    def __len__(self):
+        return len(self.grid)
+
+    def __iter__(self):
+        # sinter.collect consumes the whole iterator up front, so nothing is gained by yielding tasks as they finish
+        return iter(self.build())
+
+    def build(self):
+        """The sinter.Task of every grid point, in grid order, built in the process pool."""
+        # spawn rather than fork: the caller may have threads running
+        context = multiprocessing.get_context('spawn')
+        params = [{**self.fixed, **point} for point in self.grid]
+        initializer, initargs = self.initializer(params) if self.initializer is not None else (None, ())
+        tasks = [None] * len(self.grid)
+        with ProcessPoolExecutor(max_workers=self.num_workers, mp_context=context, initializer=initializer,
+                                 initargs=initargs) as pool:
+            futures = {
+                pool.submit(_build_task, self.builder, point, self.postselection, self.with_stats, self.cache_dir): k
+                for k, point in enumerate(params)
+            }
+            for future in as_completed(futures):
+                circuit, mask, circuit_stats = future.result()
+                point = self.grid[futures[future]]
+                metadata = self.metadata(point)
+                if circuit_stats is not None:
+                    metadata = {**metadata, 'stats': circuit_stats}
+                tasks[futures[future]] = sinter.Task(
+                    circuit=circuit,
+                    postselection_mask=mask,
+                    json_metadata=metadata,
+                )
+        return tasks
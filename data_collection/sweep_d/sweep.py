@@ -1,6 +1,7 @@
 import stim
 import src.magicd2 as magic# 假设这是你自定义的库
 import sinter
+import src.tasks as tasks_lib
 import numpy as np
 from typing import List
 
@@ -13,33 +14,24 @@ T_MAINTAIN = 0
 ERROR_RATE = 0.001
 
 if __name__ == "__main__":
-    tasks = []
-    
-    # 遍历参数 T_MAINTAIN (从 0 到 10)
-    for d in [7, 9,11,13,15]:
-        # 1. 生成 Circuit (使用当前的 t_maintain)
-        circuit = magic.magic_preparation(
+    # 遍历最终码距 d2
+    # 先在进程池中并行生成全部电路和 mask, 再一起交给 sinter 采样 (sinter.collect 开始前会取完所有任务)
+    tasks = tasks_lib.TaskFactory(
+        magic.magic_preparation,
+        tasks_lib.parameter_grid(d2=[7, 9, 11, 13, 15]),
+        fixed=dict(
             T_sc_pre=T_SC_PRE,
             T_lat_surg=T_LAT_SURG,
             T_before_grow=T_BEFORE_GROW,
             T_ps_grow=T_PS_GROW,
-            T_maintain=T_MAINTAIN,  # 注意这里使用循环变量
+            T_maintain=T_MAINTAIN,
             error_rate=ERROR_RATE,
             d=7,
-            d2=d
-        )
-
-        # 2. 从该 Circuit 生成 Mask
-        psmask = sinter.post_selection_mask_from_4th_coord(circuit)
-
-        # 3. 添加到任务列表
-        tasks.append(
-            sinter.Task(
-                circuit=circuit,
-                postselection_mask=psmask,
-                json_metadata={'d': d}
-            )
-        )
+        ),
+        metadata=lambda point: {'d': point['d2']},
+        # 多个任务共用的电路前缀 (QRM 制备、surgery 等) 只在主进程中构造一次, 再交给每个工作进程
+        initializer=magic.prefix_initializer,
+    )
 
     print(f"Starting simulation for {len(tasks)} tasks...")
 
@@ -1,5 +1,7 @@
 import stim
 import src.magic as magic# 假设这是你自定义的库
+import src.noise as noise
+import src.cache as cache_lib
 import sinter
 import numpy as np
 from typing import List
@@ -14,20 +16,36 @@ T_MAINTAIN = 0
 
 if __name__ == "__main__":
     tasks = []
-    
+
+    params = dict(
+        T_sc_pre=T_SC_PRE,
+        T_lat_surg=T_LAT_SURG,
+        T_before_grow=T_BEFORE_GROW,
+        T_ps_grow=T_PS_GROW,
+        T_maintain=T_MAINTAIN,
+    )
+    # 电路和 mask 缓存在磁盘上, 重复运行或中断后继续时不再重新生成
+    cache = cache_lib.CircuitCache('circuit_cache')
+    skeleton = None
+    skeleton_mask = None
+
+    def instantiate(error_rate):
+        # 只构造一次带噪声标签的线路骨架，每个错误率只替换噪声参数 (仅在缓存未命中时)
+        # post-selection mask 与错误率无关, 由构造过程直接记录, 随骨架一起复用
+        global skeleton, skeleton_mask
+        if skeleton is None:
+            circuit, skeleton_mask = magic.magic_preparation(**params, error_rate=1e-3, noise_tags=True, with_mask=True)
+            skeleton = noise.NoiseSkeleton(circuit)
+        return skeleton.instantiate(error_rate), skeleton_mask
+
     for error_rate in np.linspace(1e-4, 1e-3, 10):
-        # 1. 生成 Circuit (使用当前的 t_maintain)
-        circuit = magic.magic_preparation(
-            T_sc_pre=T_SC_PRE,
-            T_lat_surg=T_LAT_SURG,
-            T_before_grow=T_BEFORE_GROW,
-            T_ps_grow=T_PS_GROW,
-            T_maintain=T_MAINTAIN,  # 注意这里使用循环变量
-            error_rate=error_rate
-        )
+        point = {**params, 'error_rate': error_rate}
+        build = lambda: instantiate(error_rate)
+        # 1. 生成 Circuit
+        circuit = cache.circuit(magic.magic_preparation, point, build=build)
 
-        # 2. 从该 Circuit 生成 Mask
-        psmask = sinter.post_selection_mask_from_4th_coord(circuit)
+        # 2. 读取 Mask (与 Circuit 一起缓存)
+        psmask = cache.postselection_mask(magic.magic_preparation, point, build=build)
 
         # 3. 添加到任务列表
         tasks.append(
@@ -1,6 +1,8 @@
 import stim
 import src.magic as magic# 假设这是你自定义的库
 import sinter
+import src.tasks as tasks_lib
+import src.preflight as preflight
 import numpy as np
 from typing import List
 
@@ -13,31 +15,33 @@ T_PS_GROW = 2
 ERROR_RATE = 0.001
 
 if __name__ == "__main__":
-    tasks = []
-    
+    grid = tasks_lib.parameter_grid(T_maintain=range(0, 10))
+    fixed = dict(
+        T_sc_pre=T_SC_PRE,
+        T_lat_surg=T_LAT_SURG,
+        T_before_grow=T_BEFORE_GROW,
+        T_ps_grow=T_PS_GROW,
+        error_rate=ERROR_RATE,
+        # maintain 轮以 REPEAT 块输出: stim 折叠循环, 每个 T_MAINTAIN 的 DEM 只需分析约一轮, 而不是整条电路
+        repeat=True,
+    )
+
+    # 采样前先并行检查所有电路: 无噪声下 detector 和 observable 是否确定, 出错时定位到具体的 DETECTOR 和生成它的函数;
+    # 结果按参数缓存, 未改动的任务不再重复检查, 有问题的任务不提交给 sinter
+    results = preflight.validate(magic.magic_detectors, grid, fixed=fixed, cache_dir='circuit_cache')
+    preflight.report(results)
+    grid = preflight.passed(grid, results)
+
     # 遍历参数 T_MAINTAIN (从 0 到 10)
-    for t_maintain in range(0, 10):
-        # 1. 生成 Circuit (使用当前的 t_maintain)
-        circuit = magic.magic_preparation(
-            T_sc_pre=T_SC_PRE,
-            T_lat_surg=T_LAT_SURG,
-            T_before_grow=T_BEFORE_GROW,
-            T_ps_grow=T_PS_GROW,
-            T_maintain=t_maintain,  # 注意这里使用循环变量
-            error_rate=ERROR_RATE
-        )
-
-        # 2. 从该 Circuit 生成 Mask
-        psmask = sinter.post_selection_mask_from_4th_coord(circuit)
-
-        # 3. 添加到任务列表
-        tasks.append(
-            sinter.Task(
-                circuit=circuit,
-                postselection_mask=psmask,
-                json_metadata={'T_MAINTAIN': t_maintain, 'p': ERROR_RATE}
-            )
-        )
+    # 先在进程池中并行生成全部电路和 mask, 再一起交给 sinter 采样 (sinter.collect 开始前会取完所有任务)
+    tasks = tasks_lib.TaskFactory(
+        magic.magic_preparation,
+        grid,
+        fixed=fixed,
+        metadata=lambda point: {'T_MAINTAIN': point['T_maintain'], 'p': ERROR_RATE},
+        # 多个任务共用的电路前缀 (QRM 制备、surgery 等) 只在主进程中构造一次, 再交给每个工作进程
+        initializer=magic.prefix_initializer,
+    )
 
     print(f"Starting simulation for {len(tasks)} tasks...")
 
@@ -1,6 +1,7 @@
 import stim
 import src.magic as magic# 假设这是你自定义的库
 import sinter
+import src.tasks as tasks_lib
 import numpy as np
 from typing import List
 
@@ -13,31 +14,22 @@ T_MAINTAIN = 0
 ERROR_RATE = 0.001
 
 if __name__ == "__main__":
-    tasks = []
-    
-    # 遍历参数 T_MAINTAIN (从 0 到 10)
-    for t_ps_grow in range(0, 10):
-        # 1. 生成 Circuit (使用当前的 t_maintain)
-        circuit = magic.magic_preparation(
+    # 遍历参数 T_PS_GROW (从 0 到 10)
+    # 先在进程池中并行生成全部电路和 mask, 再一起交给 sinter 采样 (sinter.collect 开始前会取完所有任务)
+    tasks = tasks_lib.TaskFactory(
+        magic.magic_preparation,
+        tasks_lib.parameter_grid(T_ps_grow=range(0, 10)),
+        fixed=dict(
             T_sc_pre=T_SC_PRE,
             T_lat_surg=T_LAT_SURG,
             T_before_grow=T_BEFORE_GROW,
-            T_ps_grow=t_ps_grow,
-            T_maintain=T_MAINTAIN,  # 注意这里使用循环变量
-            error_rate=ERROR_RATE
-        )
-
-        # 2. 从该 Circuit 生成 Mask
-        psmask = sinter.post_selection_mask_from_4th_coord(circuit)
-
-        # 3. 添加到任务列表
-        tasks.append(
-            sinter.Task(
-                circuit=circuit,
-                postselection_mask=psmask,
-                json_metadata={'T_PS_GROW': t_ps_grow, 'p': ERROR_RATE}
-            )
-        )
+            T_maintain=T_MAINTAIN,
+            error_rate=ERROR_RATE,
+        ),
+        metadata=lambda point: {'T_PS_GROW': point['T_ps_grow'], 'p': ERROR_RATE},
+        # 多个任务共用的电路前缀 (QRM 制备、surgery 等) 只在主进程中构造一次, 再交给每个工作进程
+        initializer=magic.prefix_initializer,
+    )
 
     print(f"Starting simulation for {len(tasks)} tasks...")
 
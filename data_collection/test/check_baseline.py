@@ -0,0 +1,38 @@
+import hashlib
+import sys
+
+import src.magic as magic
+import src.magicd2 as magicd2
+
+# 基线 (重构之前的 magic_preparation) 生成的线路文本的 sha256 前 16 位
+# 参数顺序: T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate
+BASELINE = [
+    (magic, (1, 3, 1, 2, 3, 0.001), {}, '61ae15225fa77026'),
+    (magic, (0, 3, 1, 0, 2, 0.001), {}, '7cb620324acf6d68'),
+    (magic, (2, 4, 2, 1, 4, 0.0005), {}, '786214e06f9767d5'),
+    (magic, (1, 3, 1, 2, 3, 0.0), {}, 'fb080b20712f5d27'),
+    (magic, (1, 3, 1, 2, 3, 0.0018643565), {}, 'dc53c607e1a01570'),
+    (magic, (1, 3, 1, 2, 3, 0.001), {'d': 5}, 'cf400f9395c5056b'),
+    (magicd2, (1, 3, 1, 2, 2, 0.001), {}, '0035ab0e2b6e95f1'),
+    (magicd2, (0, 3, 1, 1, 1, 0.0005), {}, '4abf40420f6fddd6'),
+]
+
+
+def text_hash(circuit):
+    return hashlib.sha256(str(circuit).encode()).hexdigest()[:16]
+
+
+if __name__ == "__main__":
+    # 默认参数 (不开 repeat / noise_tags / lean 等选项) 生成的线路必须与基线逐字节相同
+    failed = []
+    for module, args, kwargs, expected in BASELINE:
+        got = text_hash(module.magic_preparation(*args, **kwargs))
+        status = "ok" if got == expected else "MISMATCH"
+        print(f"{module.__name__}.magic_preparation{args}{' ' + str(kwargs) if kwargs else ''}: {got} ({status})")
+        if got != expected:
+            failed.append((module.__name__, args, kwargs))
+
+    if failed:
+        print(f">> FAIL: {len(failed)} default builds differ from the baseline.")
+        sys.exit(1)
+    print(">> PASSED: default builds match the baseline byte for byte.")
@@ -0,0 +1,43 @@
+import sys
+
+import src.magic as magic
+import src.magicd2 as magicd2
+import src.passes as passes
+
+# 参数顺序: T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate
+SCHEDULES = [
+    (magic, (1, 3, 1, 2, 3, 0.001)),
+    (magic, (0, 3, 2, 0, 1, 0.0018643565)),
+    (magicd2, (1, 3, 1, 2, 2, 0.001)),
+]
+OPTIONS = [dict(compact=True), dict(recycle_qubits=True), dict(compact=True, recycle_qubits=True)]
+
+if __name__ == "__main__":
+    # 比特压缩 (compact) 和回收 QRM 比特 (recycle_qubits) 只改变比特编号, DEM 必须完全不变
+    failed = []
+    for module, args in SCHEDULES:
+        for repeat in (False, True):
+            circuit = module.magic_preparation(*args, repeat=repeat)
+            dem = circuit.detector_error_model()
+            for options in OPTIONS:
+                renumbered = module.magic_preparation(*args, repeat=repeat, **options)
+                problems = []
+                if renumbered.detector_error_model() != dem:
+                    problems.append("DEM changed")
+                if renumbered.get_detector_coordinates() != circuit.get_detector_coordinates():
+                    problems.append("detector coordinates changed")
+                if options.get('compact') and renumbered.num_qubits != len(passes.used_qubits(renumbered)):
+                    problems.append(f"{renumbered.num_qubits} qubits, {len(passes.used_qubits(renumbered))} used")
+                if renumbered.num_qubits > circuit.num_qubits:
+                    problems.append(f"{renumbered.num_qubits} qubits instead of at most {circuit.num_qubits}")
+                if problems:
+                    failed.append((module.__name__, args, repeat, options))
+                    print(f">> Mismatch: {module.__name__}{args} repeat={repeat} {options}: {'; '.join(problems)}")
+                else:
+                    print(f"{module.__name__}{args} repeat={repeat} {options}: "
+                          f"{circuit.num_qubits} -> {renumbered.num_qubits} qubits (ok)")
+
+    if failed:
+        print(f">> FAIL: {len(failed)} renumbered circuits change the DEM.")
+        sys.exit(1)
+    print(">> PASSED: compact and recycle_qubits leave the DEM unchanged.")
@@ -0,0 +1,42 @@
+import sys
+
+import numpy as np
+import sinter
+
+import src.magic as magic
+import src.magicd2 as magicd2
+
+# 参数顺序: T_sc_pre, T_lat_surg, T_before_grow, T_ps_grow, T_maintain, error_rate
+SCHEDULES = [
+    (magic, (1, 3, 1, 2, 3, 0.001)),
+    (magic, (0, 3, 2, 0, 1, 0.001)),
+    (magicd2, (1, 3, 1, 2, 2, 0.001)),
+]
+
+if __name__ == "__main__":
+    # lean 模式 (不输出坐标) 记录的 post-selection mask 必须与完整线路的 mask 相同,
+    # 也必须与 sinter 从第 4 个 detector 坐标算出的 mask 相同
+    failed = []
+    for module, args in SCHEDULES:
+        for repeat in (False, True):
+            circuit, mask = module.magic_preparation(*args, repeat=repeat, with_mask=True)
+            lean_circuit, lean_mask, metadata = module.magic_preparation(*args, repeat=repeat, lean=True)
+            sinter_mask = sinter.post_selection_mask_from_4th_coord(circuit)
+            packed_metadata = np.packbits(metadata['postselected'], bitorder='little')
+            problems = []
+            if lean_circuit.num_detectors != circuit.num_detectors:
+                problems.append(f"{lean_circuit.num_detectors} detectors instead of {circuit.num_detectors}")
+            if not np.array_equal(mask, sinter_mask):
+                problems.append("with_mask mask != sinter mask")
+            if not np.array_equal(lean_mask, mask):
+                problems.append("lean mask != with_mask mask")
+            if not np.array_equal(packed_metadata, mask):
+                problems.append("metadata 'postselected' != mask")
+            if problems:
+                failed.append((module.__name__, args, repeat))
+                print(f">> Mismatch: {module.__name__}{args} repeat={repeat}: {'; '.join(problems)}")
+
+    if failed:
+        print(f">> FAIL: {len(failed)} circuits have inconsistent post-selection masks.")
+        sys.exit(1)
+    print(">> PASSED: lean, with_mask and sinter post-selection masks are equal.")
@@ -1,5 +1,7 @@
 import stim
 import src.magic as magic# 假设这是你自定义的库
+import src.symbolic_dem as symbolic_dem
+import src.sparse_dem as sparse_dem
 import sinter
 import numpy as np
 from typing import List
@@ -9,22 +11,23 @@ import math
 
 if __name__ == "__main__":
     
+    # 每个 t 只分析一次带噪声标签的线路, 得到以错误率为变量的 DEM, 每个错误率只代入概率
+    symbolic = {
+        t: symbolic_dem.SymbolicDem(magic.magic_preparation(T=7, T_lat_surg=3, t_round=t, error_rate=1e-3, noise_tags=True))
+        for t in [7]
+    }
+
     # 遍历参数 T_BEFORE_GROW (从 1 到 10)
     for logerr in np.linspace(-2.5, -3, 6):
         err = 10**logerr
         for t in [7]:
-            # 1. 生成 Circuit (使用当前的 t_maintain)
-            circuit = magic.magic_preparation(
-                T=7,
-                T_lat_surg=3,
-                t_round=t,
-                error_rate=err
-            )
-
-            # 2. Generate dem
-            dem = circuit.detector_error_model()
+            # 1-2. 生成 dem (不再分析线路)
+            dem = symbolic[t].instantiate(err)
 
             # 3. Print the DEM
             dem_filename = f"ip_decoder/dem/dem_T{t}_err{logerr:.1f}.dem"
             with open(dem_filename, "w") as f:
-                f.write(str(dem))  
\ No newline at end of file
+                f.write(str(dem))
+
+            # 4. 同时写出二进制稀疏格式 (H, L, p), 供 hypergraph_decoders 和 sweep.jl 直接 mmap 读取
+            sparse_dem.save(sparse_dem.SparseDem(*symbolic[t].matrices(err)), dem_filename[:-len(".dem")] + ".sdem")  
\ No newline at end of file
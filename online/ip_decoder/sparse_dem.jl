@@ -0,0 +1,37 @@
+# Reader for the binary sparse DEM files (.sdem) written by src/sparse_dem.py:
+# MAGIC, header length (UInt64, little-endian), JSON header, then the arrays at the offsets given in the header.
+# H (detectors x errors) and L (observables x errors) are stored in CSC form with 0-based indices.
+using JSON
+using Mmap
+using SparseArrays
+
+const SDEM_MAGIC = b"SPARSDEM"
+const SDEM_DTYPES = Dict("<i8" => Int64, "<i4" => Int32, "<f8" => Float64)
+
+function read_sparse_dem(path::AbstractString)
+    open(path, "r") do io
+        read(io, length(SDEM_MAGIC)) == SDEM_MAGIC || error("$path is not a sparse DEM file")
+        header_length = ltoh(read(io, UInt64))
+        header = JSON.parse(String(read(io, header_length)))
+        header["version"] == 1 || error("unsupported sparse DEM version $(header["version"])")
+        arrays = Dict{String, Vector}()
+        for (name, spec) in header["arrays"]
+            # the arrays are memory-mapped in place, the copies below only shift the indices to 1-based
+            T = SDEM_DTYPES[spec["dtype"]]
+            arrays[name] = spec["length"] == 0 ? T[] : Mmap.mmap(io, Vector{T}, spec["length"], spec["offset"])
+        end
+        num_errors = header["num_errors"]
+        csc(indptr, indices, num_rows) = SparseMatrixCSC(num_rows, num_errors, Int.(indptr) .+ 1, Int.(indices) .+ 1,
+                                                          ones(Bool, length(indices)))
+        H = csc(arrays["H_indptr"], arrays["H_indices"], header["num_detectors"])
+        L = csc(arrays["L_indptr"], arrays["L_indices"], header["num_observables"])
+        p = copy(arrays["p"])
+        return (H = H, L = L, p = p)
+    end
+end
+
+# for each detector, the errors flipping it (the checks of a Tanner graph over the errors)
+function detector_checks(H::SparseMatrixCSC)
+    Ht = sparse(transpose(H))
+    return [Ht.rowval[nzrange(Ht, d)] for d in 1:size(Ht, 2)]
+end
@@ -1,14 +1,16 @@
 import math
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import Tuple
 
 import numpy as np
 import scipy.sparse as sp
 import stim
 import sinter
 
+import src.sparse_dem as sparse_dem
 
-def _dem_to_matrices(dem: stim.DetectorErrorModel) -> Tuple[sp.csr_matrix, sp.csr_matrix, np.ndarray]:
+
+def _dem_to_matrices(dem) -> Tuple[sp.csr_matrix, sp.csr_matrix, np.ndarray]:
     """
     Convert a (possibly non-graph-like) DEM into:
         H: (num_detectors, num_errors) sparse parity-check matrix
@@ -16,62 +18,13 @@ def _dem_to_matrices(dem: stim.DetectorErrorModel) -> Tuple[sp.csr_matrix, sp.cs
         p: (num_errors,) probabilities for each error mechanism
 
     IMPORTANT: We do NOT decompose errors. Each `error(p) ...` instruction -> one variable.
+    dem: a stim.DetectorErrorModel, or a sparse_dem.SparseDem (e.g. memory-mapped from a .sdem file)
     """
-    dem = dem.flattened()
-
-    num_dets = dem.num_detectors
-    num_obs = dem.num_observables
-
-    det_rows: List[int] = []
-    det_cols: List[int] = []
-
-    obs_rows: List[int] = []
-    obs_cols: List[int] = []
-
-    probs: List[float] = []
-
-    col = 0
-    for inst in dem:
-        if inst.type != "error":
-            continue
-        args = inst.args_copy()
-        if len(args) != 1:
-            raise ValueError(f"Unexpected error instruction args: {args}")
-
-        p = float(args[0])
-        # Clamp away from 0/1 to avoid infinities in weights / log odds.
-        p = min(max(p, 1e-12), 1 - 1e-12)
-
-        targets = inst.targets_copy()
-        # Note: ignore separators. We treat the whole instruction as one correlated mechanism.
-        for t in targets:
-            if t.is_separator():
-                continue
-            if t.is_relative_detector_id():
-                det_rows.append(t.val)
-                det_cols.append(col)
-            elif t.is_logical_observable_id():
-                obs_rows.append(t.val)
-                obs_cols.append(col)
-            else:
-                # e.g. gauge targets etc. Usually not present in standard DEM.
-                pass
-
-        probs.append(p)
-        col += 1
-
-    num_errs = col
-    H = sp.coo_matrix(
-        (np.ones(len(det_rows), dtype=np.uint8), (np.array(det_rows), np.array(det_cols))),
-        shape=(num_dets, num_errs),
-    ).tocsr()
-
-    L = sp.coo_matrix(
-        (np.ones(len(obs_rows), dtype=np.uint8), (np.array(obs_rows), np.array(obs_cols))),
-        shape=(num_obs, num_errs),
-    ).tocsr()
-
-    return H, L, np.array(probs, dtype=np.float64)
+    if not isinstance(dem, sparse_dem.SparseDem):
+        dem = sparse_dem.dem_to_sparse(dem)
+    # Clamp away from 0/1 to avoid infinities in weights / log odds.
+    p = np.clip(dem.p, 1e-12, 1 - 1e-12)
+    return dem.H.tocsr(), dem.L.tocsr(), p
 
 
 # ---------------------------
@@ -87,7 +40,8 @@ class BPOSDHypergraphDecoder(sinter.Decoder):
     max_iter: int = 50
     osd_order: int = 10
 
-    def compile_decoder_for_dem(self, dem: stim.DetectorErrorModel) -> sinter.CompiledDecoder:
+    def compile_decoder_for_dem(self, dem) -> sinter.CompiledDecoder:
+        """dem: a stim.DetectorErrorModel or a sparse_dem.SparseDem, e.g. sparse_dem.load('dem.sdem')"""
         return _CompiledBPOSDHypergraphDecoder(
             dem=dem,
             bp_method=self.bp_method,
@@ -97,9 +51,9 @@ class BPOSDHypergraphDecoder(sinter.Decoder):
 
 
 class _CompiledBPOSDHypergraphDecoder(sinter.CompiledDecoder):
-    def __init__(self, dem: stim.DetectorErrorModel, bp_method: str, max_iter: int, osd_order: int):
+    def __init__(self, dem, bp_method: str, max_iter: int, osd_order: int):
         self.H, self.L, self.p = _dem_to_matrices(dem)
-        self.num_obs = dem.num_observables
+        self.num_obs = self.L.shape[0]
 
         # ldpc API differs slightly across versions; this is the common one.
         # If import fails or signature differs, see note at the end.
@@ -151,14 +105,15 @@ class ILPHypergraphDecoder(sinter.Decoder):
     """
     solver_name: str = "CBC"  # python-mip default; can also use "GUROBI" if available
 
-    def compile_decoder_for_dem(self, dem: stim.DetectorErrorModel) -> sinter.CompiledDecoder:
+    def compile_decoder_for_dem(self, dem) -> sinter.CompiledDecoder:
+        """dem: a stim.DetectorErrorModel or a sparse_dem.SparseDem, e.g. sparse_dem.load('dem.sdem')"""
         return _CompiledILPHypergraphDecoder(dem=dem, solver_name=self.solver_name)
 
 
 class _CompiledILPHypergraphDecoder(sinter.CompiledDecoder):
-    def __init__(self, dem: stim.DetectorErrorModel, solver_name: str):
+    def __init__(self, dem, solver_name: str):
         self.H, self.L, self.p = _dem_to_matrices(dem)
-        self.num_obs = dem.num_observables
+        self.num_obs = self.L.shape[0]
         self.solver_name = solver_name
 
         # log-likelihood ratio weights for ML:
@@ -3,8 +3,11 @@ import src.qrm as qrm
 import stim
 import numpy as np
 import src.surgery as sg
+import src.measurements as ms
+import src.passes as passes
+import src.detectors as detectors
 
-def magic_preparation(T, T_lat_surg, t_round, error_rate):
+def magic_preparation(T, T_lat_surg, t_round, error_rate, repeat=False, noise_tags=False, with_mask=False, fuse_noise=False, lean=False):
     """
     Args:
         T_sc_pre: number of rounds of surface code stabilizer measurements during the initial preparation stage
@@ -13,48 +16,86 @@ def magic_preparation(T, T_lat_surg, t_round, error_rate):
         T_ps_grow: number of post-selected rounds of surface code stabilizer measurements during lattice growth
         T_maintain: number of rounds of surface code stabilizer measurements after lattice growth
         error_rate: physical error rate for each gate
+        repeat: emit runs of identical syndrome rounds as stim REPEAT blocks instead of unrolling them
+        noise_tags: tag the noise channels with their stage ('qrm', 'sc', 'surgery'), so that the circuit
+            can serve as a noise.NoiseSkeleton and be instantiated for other error rates
+        with_mask: also return the post-selection mask, recorded by the builders as they append the detectors
+            (bit-packed like sinter.post_selection_mask_from_4th_coord, without its pass over the circuit)
+        fuse_noise: merge stacked noise channels on the same qubits and drop the noiseless ones (see passes.fuse_noise)
+        lean: sampling-only circuit, without QUBIT_COORDS, SHIFT_COORDS and detector coordinates; the mask and the
+            detector metadata (stage, position, round, see MeasurementLedger.detector_metadata) come as side arrays
     Returns:
-        A stim circuit object that prepares a surface code magic state.
+        A stim circuit object that prepares a surface code magic state, or (circuit, mask) if with_mask,
+        or (circuit, mask, detector metadata) if lean.
     """
-    qrm_code = qrm.QRMCode(error_rate, x_pos_shift=-10)
+    circuit, ledger = _magic_preparation(T, T_lat_surg, t_round, error_rate, repeat, noise_tags, coords=not lean)
+    if fuse_noise:
+        circuit = passes.fuse_noise(circuit)
+    if lean:
+        return circuit, ledger.postselection_mask(), ledger.detector_metadata()
+    return (circuit, ledger.postselection_mask()) if with_mask else circuit
+
+def magic_stages(T, T_lat_surg, t_round, error_rate, repeat=False, noise_tags=False):
+    """
+    The circuit of magic_preparation and its stages:
+    a list of (stage name, index of its first measurement, index of its first instruction), see MeasurementLedger.
+    """
+    circuit, ledger = _magic_preparation(T, T_lat_surg, t_round, error_rate, repeat, noise_tags)
+    return circuit, list(ledger.stages)
+
+def magic_detectors(T, T_lat_surg, t_round, error_rate, repeat=False, noise_tags=False):
+    """
+    The circuit of magic_preparation and the index of its detectors, see detectors.DetectorIndex.
+    """
+    circuit, ledger = _magic_preparation(T, T_lat_surg, t_round, error_rate, repeat, noise_tags)
+    return circuit, detectors.DetectorIndex(ledger.detector_metadata())
+
+def _magic_preparation(T, T_lat_surg, t_round, error_rate, repeat, noise_tags, coords=True):
+    # one measurement record for all stages, so that detectors can look back across stages
+    ledger = ms.MeasurementLedger(coords=coords)
+    qrm_code = qrm.QRMCode(error_rate, x_pos_shift=-10, noise_tag='qrm' if noise_tags else '', measurements=ledger)
     sc_shift = qrm_code.total_qubit_number + 1 + 2
-    sc_code = sc.SurfaceCode(3, 3, error_rate, off_set=sc_shift)
+    sc_code = sc.SurfaceCode(3, 3, error_rate, off_set=sc_shift, noise_tag='sc' if noise_tags else '', measurements=ledger)
     surface_clock = 1
     if t_round <= T:
         # do T rounds of surface code stabilizer measurements
+        ledger.begin_stage('sc_pre', 0)
         circuit = sc_code.initialize_cycle('X', postselection='all')
-        for t in range(surface_clock, surface_clock + t_round):
-            sc_code.syndrome_cycle(circuit, t, error_rate, postselection='all')
+        sc_code.syndrome_cycles(circuit, surface_clock, t_round, postselection='all', repeat=repeat)
         surface_clock += t_round
+        ledger.begin_stage('readout', len(circuit))
         sc_code.logical_measurement(circuit, 'X', surface_clock)
         
-        return circuit
+        return circuit, ledger
     else:
+        ledger.begin_stage('qrm', 0)
         circuit = qrm_code.prepare_S_state()
+        ledger.begin_stage('sc_pre', len(circuit))
         circuit += sc_code.initialize_cycle('X', postselection='all')
         T_post = t_round - T
         # do T rounds of surface code stabilizer measurements
-        for t in range(surface_clock, surface_clock + T):
-            sc_code.syndrome_cycle(circuit, t, error_rate, postselection='all')
+        sc_code.syndrome_cycles(circuit, surface_clock, T, postselection='all', repeat=repeat)
         surface_clock += T
         # do T_lat_surg rounds of lattice surgery
         surgery_shift = qrm_code.total_qubit_number + 1
-        surgery_unit = sg.SurgeryUnit(qrm_code, sc_code, error_rate, sg_shift=surgery_shift, T_lat_surg=T_lat_surg)
-        surgery_unit.lattice_surgery(circuit, T, surface_clock)
+        surgery_unit = sg.SurgeryUnit(qrm_code, sc_code, error_rate, sg_shift=surgery_shift, T_lat_surg=T_lat_surg,
+                                      noise_tag='surgery' if noise_tags else '')
+        ledger.begin_stage('surgery', len(circuit))
+        surgery_unit.lattice_surgery(circuit, surface_clock)
         surface_clock += T_lat_surg
         # decouple
+        ledger.begin_stage('decouple', len(circuit))
         surgery_unit.decouple_after_surgery(circuit, surface_clock)
         surface_clock += 1
         # do T_post rounds of surface code stabilizer measurements
-        for t in range(surface_clock, surface_clock + T_post):
-            rec_shift = 0
-            if t == surface_clock:
-                rec_shift = 15 # shift due to lattice surgery and QRM measurement
-            sc_code.syndrome_cycle(circuit, t, rec_shift=rec_shift, postselection='all')
+        # (the first one looks back over the QRM measurement, see MeasurementLedger)
+        ledger.begin_stage('sc_post', len(circuit))
+        sc_code.syndrome_cycles(circuit, surface_clock, T_post, postselection='all', repeat=repeat)
         surface_clock += T_post
         # measure logical Y of the surface code
+        ledger.begin_stage('readout', len(circuit))
         sc_code.Y_measurement_noiseless(circuit)
         # one round of error-free syndrome measurement to finalize the detectors
-        sc_code.syndrome_cycle(circuit, surface_clock, error_rate=0.0, rec_shift=1)
+        sc_code.syndrome_cycle(circuit, surface_clock, error_rate=0.0)
 
-        return circuit
\ No newline at end of file
+        return circuit, ledger
\ No newline at end of file
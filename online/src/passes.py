@@ -0,0 +1,165 @@
+import numpy as np
+import stim
+
+# instructions whose targets are not acted on: coordinates, or measurement records
+NOT_A_GATE = ('QUBIT_COORDS', 'DETECTOR', 'OBSERVABLE_INCLUDE', 'SHIFT_COORDS')
+
+
+def _is_qubit(t: stim.GateTarget):
+    # a qubit target, possibly inverted or a Pauli factor of a product; not rec[-k], sweep[k] or a combiner
+    return t.is_qubit_target or t.is_x_target or t.is_y_target or t.is_z_target
+
+
+def _renamed(t: stim.GateTarget, q: int):
+    # the target t on qubit q instead, keeping its kind and inversion
+    if t.is_x_target:
+        return stim.target_x(q, t.is_inverted_result_target)
+    if t.is_y_target:
+        return stim.target_y(q, t.is_inverted_result_target)
+    if t.is_z_target:
+        return stim.target_z(q, t.is_inverted_result_target)
+    return stim.target_inv(q) if t.is_inverted_result_target else stim.GateTarget(q)
+
+
+def used_qubits(circuit: stim.Circuit):
+    """Sorted array of the qubits that some instruction acts on (QUBIT_COORDS alone does not count)."""
+    used = set()
+    for inst in circuit:
+        if isinstance(inst, stim.CircuitRepeatBlock):
+            used.update(used_qubits(inst.body_copy()).tolist())
+        elif inst.name not in NOT_A_GATE:
+            used.update(t.value for t in inst.targets_copy() if _is_qubit(t))
+    return np.array(sorted(used), dtype=np.int64)
+
+
+def compact_qubits(circuit: stim.Circuit):
+    """
+    Renumber the qubits densely (0, 1, ... in the original order), dropping the coordinates of unused qubits.
+    Stim's simulators and DEM analysis scale with the largest qubit index, which the fixed offsets of the
+    QRM / surgery / surface code blocks and the growth allocation leave well above the number of qubits in use.
+    The instructions are rebuilt with their original arguments, so the detector error model is unchanged.
+    Returns:
+        (compacted circuit, mapping): mapping[old] is the new index of an old qubit, -1 if it is unused.
+    """
+    used = used_qubits(circuit)
+    mapping = np.full(circuit.num_qubits, -1, dtype=np.int64)
+    mapping[used] = np.arange(len(used))
+    return _compacted(circuit, mapping.tolist()), mapping
+
+
+def _compacted(circuit: stim.Circuit, new_index):
+    compacted = stim.Circuit()
+    for inst in circuit:
+        if isinstance(inst, stim.CircuitRepeatBlock):
+            body = _compacted(inst.body_copy(), new_index)
+            compacted.append(stim.CircuitRepeatBlock(inst.repeat_count, body, tag=inst.tag))
+            continue
+        targets = inst.targets_copy()
+        if inst.name == 'QUBIT_COORDS':
+            targets = [t for t in targets if new_index[t.value] >= 0]
+            if not targets:
+                continue
+        targets = [_renamed(t, new_index[t.value]) if _is_qubit(t) else t for t in targets]
+        compacted.append(stim.CircuitInstruction(inst.name, targets, inst.gate_args_copy(), tag=inst.tag))
+    return compacted
+
+
+def stage_slices(circuit: stim.Circuit, stages):
+    """
+    Split a circuit into its stages.
+    stages: list of (name, first measurement, first instruction) as recorded by MeasurementLedger.begin_stage
+    Returns a list of (name, sub-circuit).
+    """
+    bounds = [position for _, _, position in stages] + [len(circuit)]
+    return [(name, circuit[bounds[k]:bounds[k + 1]]) for k, (name, _, _) in enumerate(stages)]
+
+
+def qubits_per_stage(circuit: stim.Circuit, stages):
+    """Number of distinct qubits acted on in each stage, {stage name: count}."""
+    return {name: len(used_qubits(part)) for name, part in stage_slices(circuit, stages)}
+
+
+# Pauli channels fused by fuse_noise, with the eigenvalue lambda(p) of the channel on the Paulis it does not commute with:
+# composing two channels of a type multiplies their lambdas
+FUSIBLE_NOISE = {
+    'DEPOLARIZE1': (lambda p: 1 - 4 * p / 3, lambda fidelity: 3 * (1 - fidelity) / 4),
+    'DEPOLARIZE2': (lambda p: 1 - 16 * p / 15, lambda fidelity: 15 * (1 - fidelity) / 16),
+    'X_ERROR': (lambda p: 1 - 2 * p, lambda fidelity: (1 - fidelity) / 2),
+    'Y_ERROR': (lambda p: 1 - 2 * p, lambda fidelity: (1 - fidelity) / 2),
+    'Z_ERROR': (lambda p: 1 - 2 * p, lambda fidelity: (1 - fidelity) / 2),
+}
+ANNOTATIONS = ('TICK', 'DETECTOR', 'OBSERVABLE_INCLUDE', 'QUBIT_COORDS', 'SHIFT_COORDS', 'MPAD')
+
+
+def fuse_noise(circuit: stim.Circuit):
+    """
+    Merge the Pauli channels of FUSIBLE_NOISE that act on the same qubits (the same pair for DEPOLARIZE2) with no
+    other operation on these qubits in between, e.g. the DEPOLARIZE1 after the H of initialize_circuit('X') and the
+    one of depolarize_all, into one channel of the exactly composed probability, and drop channels of probability 0.
+    Pauli channels commute, so other noise channels in between do not prevent a merge; TICKs and annotations neither.
+    Each merged channel stays where its first part was; the sampled statistics and the detector error model are
+    unchanged (up to rounding of the probabilities), with fewer noise instructions and error mechanisms.
+    Tagged channels are left as they are, since NoiseSkeleton.instantiate substitutes their probabilities:
+    fuse an instantiated circuit instead. REPEAT bodies are fused on their own.
+    """
+    # output items: a stim instruction or block, or a noise record [gate, tag, targets, probabilities]
+    # (targets are qubits, or qubit pairs for DEPOLARIZE2)
+    items = []
+    open_channels = {}  # (gate, qubit or sorted pair) -> (record, index of the target in the record)
+    open_keys = {}  # qubit -> keys of open_channels involving it
+
+    def close(qubits):
+        for q in qubits:
+            for key in open_keys.pop(q, ()):
+                open_channels.pop(key, None)
+
+    for inst in circuit:
+        if isinstance(inst, stim.CircuitRepeatBlock):
+            open_channels.clear()
+            open_keys.clear()
+            items.append(stim.CircuitRepeatBlock(inst.repeat_count, fuse_noise(inst.body_copy()), tag=inst.tag))
+            continue
+        if inst.name in ANNOTATIONS:
+            items.append(inst)
+            continue
+        args = inst.gate_args_copy()
+        if inst.name not in FUSIBLE_NOISE or inst.tag:
+            items.append(inst)
+            close(t.value for t in inst.targets_copy() if t.is_qubit_target or t.is_x_target or t.is_y_target
+                  or t.is_z_target)
+            continue
+        p = args[0]
+        if p == 0:
+            continue
+        to_fidelity, from_fidelity = FUSIBLE_NOISE[inst.name]
+        qubits = [t.value for t in inst.targets_copy()]
+        groups = [tuple(qubits[k:k + 2]) for k in range(0, len(qubits), 2)] if inst.name == 'DEPOLARIZE2' \
+            else [(q,) for q in qubits]
+        record = [inst.name, inst.tag, [], []]
+        for group in groups:
+            key = (inst.name, tuple(sorted(group)))
+            if key in open_channels:
+                previous, k = open_channels[key]
+                previous[3][k] = from_fidelity(to_fidelity(previous[3][k]) * to_fidelity(p))
+                continue
+            open_channels[key] = (record, len(record[2]))
+            for q in group:
+                open_keys.setdefault(q, []).append(key)
+            record[2].append(group)
+            record[3].append(p)
+        if record[2]:
+            items.append(record)
+
+    fused = stim.Circuit()
+    for item in items:
+        if not isinstance(item, list):
+            fused.append(item)
+            continue
+        # one instruction per probability, in the order of the targets
+        gate, tag, groups, probabilities = item
+        by_probability = {}
+        for group, p in zip(groups, probabilities):
+            by_probability.setdefault(p, []).extend(group)
+        for p, targets in by_probability.items():
+            fused.append(gate, targets, p, tag=tag)
+    return fused
@@ -0,0 +1,159 @@
+import json
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+import scipy.sparse as sp
+import stim
+
+# Binary sparse DEM (.sdem): one file holding
+#     H: (num_detectors, num_errors) parity-check matrix, CSC (for each error, the detectors it flips)
+#     L: (num_observables, num_errors) observable matrix, CSC
+#     p: (num_errors,) probability of each error (as in the DEM, not clamped)
+# Layout: MAGIC, the header length as little-endian uint64, a JSON header, then the arrays.
+# The header gives the offset (from the start of the file), dtype and length of each array; offsets are
+# multiples of ALIGNMENT so that every array can be memory-mapped in place (numpy, Julia's Mmap).
+# Indices are 0-based.
+MAGIC = b'SPARSDEM'
+VERSION = 1
+ALIGNMENT = 64
+ARRAY_DTYPES = {'H_indptr': '<i8', 'H_indices': '<i4', 'L_indptr': '<i8', 'L_indices': '<i4', 'p': '<f8'}
+
+
+@dataclass
+class SparseDem:
+    H: sp.csc_matrix
+    L: sp.csc_matrix
+    p: np.ndarray
+
+    @property
+    def num_detectors(self):
+        return self.H.shape[0]
+
+    @property
+    def num_observables(self):
+        return self.L.shape[0]
+
+    @property
+    def num_errors(self):
+        return len(self.p)
+
+
+def _csc(indptr, indices, num_rows, num_cols, data_length):
+    data = np.ones(data_length, dtype=np.uint8)
+    return sp.csc_matrix((data, indices, indptr), shape=(num_rows, num_cols), copy=False)
+
+
+def dem_to_sparse(dem: stim.DetectorErrorModel) -> SparseDem:
+    """
+    The parity-check matrix, observable matrix and probabilities of a DEM, one column per `error` instruction
+    (errors are not decomposed, separators are ignored; a detector listed twice in one error cancels).
+    """
+    dem = dem.flattened()
+    det_indptr: List[int] = [0]
+    det_indices: List[int] = []
+    obs_indptr: List[int] = [0]
+    obs_indices: List[int] = []
+    probs: List[float] = []
+    for inst in dem:
+        if inst.type != 'error':
+            continue
+        args = inst.args_copy()
+        if len(args) != 1:
+            raise ValueError(f"Unexpected error instruction args: {args}")
+        dets = set()
+        obs = set()
+        for t in inst.targets_copy():
+            if t.is_relative_detector_id():
+                dets ^= {t.val}
+            elif t.is_logical_observable_id():
+                obs ^= {t.val}
+        det_indices.extend(sorted(dets))
+        obs_indices.extend(sorted(obs))
+        det_indptr.append(len(det_indices))
+        obs_indptr.append(len(obs_indices))
+        probs.append(args[0])
+
+    num_errors = len(probs)
+    H = _csc(np.array(det_indptr, dtype=np.int64), np.array(det_indices, dtype=np.int32),
+             dem.num_detectors, num_errors, len(det_indices))
+    L = _csc(np.array(obs_indptr, dtype=np.int64), np.array(obs_indices, dtype=np.int32),
+             dem.num_observables, num_errors, len(obs_indices))
+    return SparseDem(H, L, np.array(probs, dtype=np.float64))
+
+
+def save(dem, path: str):
+    """
+    Write a stim.DetectorErrorModel (or a SparseDem) to a .sdem file.
+    """
+    if isinstance(dem, stim.DetectorErrorModel):
+        dem = dem_to_sparse(dem)
+    arrays = {
+        'H_indptr': dem.H.indptr, 'H_indices': dem.H.indices,
+        'L_indptr': dem.L.indptr, 'L_indices': dem.L.indices,
+        'p': dem.p,
+    }
+    arrays = {name: np.ascontiguousarray(a, dtype=ARRAY_DTYPES[name]) for name, a in arrays.items()}
+
+    # the offsets depend on the header length, which depends on the offsets: size the header generously first
+    def header_bytes(offsets):
+        header = {
+            'version': VERSION,
+            'num_detectors': int(dem.num_detectors),
+            'num_observables': int(dem.num_observables),
+            'num_errors': int(dem.num_errors),
+            'format': 'csc',
+            'arrays': {name: {'offset': offsets[name], 'dtype': ARRAY_DTYPES[name], 'length': int(len(a))}
+                       for name, a in arrays.items()},
+        }
+        return json.dumps(header).encode()
+
+    start = len(MAGIC) + 8 + len(header_bytes({name: 2 ** 62 for name in arrays}))
+    offsets = {}
+    position = -(-start // ALIGNMENT) * ALIGNMENT
+    for name, a in arrays.items():
+        offsets[name] = position
+        position += -(-a.nbytes // ALIGNMENT) * ALIGNMENT
+    header = header_bytes(offsets)
+    # pad the header with spaces (valid JSON) up to the first array
+    first = min(offsets.values())
+    header += b' ' * (first - len(MAGIC) - 8 - len(header))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(offsets[name])
+            f.write(a.tobytes())
+        f.truncate(position)
+
+
+def read_header(path: str):
+    """The JSON header of a .sdem file."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a sparse DEM file.")
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length))
+    if header['version'] != VERSION:
+        raise ValueError(f"Unsupported sparse DEM version {header['version']}, expected {VERSION}.")
+    return header
+
+
+def load(path: str) -> SparseDem:
+    """
+    Read a .sdem file. The index arrays and probabilities are memory-mapped read-only, so loading takes
+    a few milliseconds whatever the size of the DEM.
+    """
+    header = read_header(path)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        if spec['length'] == 0:
+            arrays[name] = np.zeros(0, dtype=spec['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=spec['dtype'], mode='r', offset=spec['offset'], shape=(spec['length'],))
+    num_errors = header['num_errors']
+    H = _csc(arrays['H_indptr'], arrays['H_indices'], header['num_detectors'], num_errors, len(arrays['H_indices']))
+    L = _csc(arrays['L_indptr'], arrays['L_indices'], header['num_observables'], num_errors, len(arrays['L_indices']))
+    return SparseDem(H, L, arrays['p'])
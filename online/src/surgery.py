@@ -2,10 +2,11 @@ import stim
 import numpy as np
 import src.surface_code as sc
 import src.qrm as qrm
+import src.ir as ir
 
 class SurgeryUnit:
     """A class for performing lattice surgery between a QRM code and a surface code."""
-    def __init__(self, qrm_code, sc_code: sc.SurfaceCode, error_rate, sg_shift, T_lat_surg):
+    def __init__(self, qrm_code, sc_code: sc.SurfaceCode, error_rate, sg_shift, T_lat_surg, noise_tag=''):
         self.qrm_code = qrm_code
         self.sc_code = sc_code
         self.error_rate = error_rate
@@ -14,6 +15,11 @@ class SurgeryUnit:
         self.check_list = self.generate_check_list()
         self.T_lat_surg = T_lat_surg
         self.flag_list = self.generate_flag_list()
+        self.noise_tag = noise_tag  # stim tag of the noise channels, e.g. 'surgery' to build a noise skeleton (see noise.py)
+        # both codes must append to the same measurement record, the detectors below look back across them
+        if qrm_code.measurements is not sc_code.measurements:
+            raise ValueError("The QRM code and the surface code must share a MeasurementLedger.")
+        self.measurements = sc_code.measurements
 
     def generate_check_list(self):
         surg_check = [
@@ -60,36 +66,35 @@ class SurgeryUnit:
         ]
         return flag_list
 
-    def lattice_surgery(self, circuit: stim.Circuit, T_sc_pre, time_shift):
+    def lattice_surgery(self, circuit: stim.Circuit, time_shift):
         """
         Args:
             circuit: a stim circuit object that prepares a surface code magic state
-            T_lat_surg: number of rounds of linking stabilizer measurements during the lattice surgery stage
-            error_rate: physical error rate for each gate
-            sc_shift: the offset of surface code qubits in the stim circuit
+            time_shift: round of the first linking stabilizer measurement
         Returns:
             A stim circuit object after performing lattice surgery.
+        The detectors compare each check with its previous measurement in the shared measurement ledger,
+        so they do not depend on how many rounds the earlier stages measured.
         """
-        for check in self.check_list[3:]:
-            circuit.append('QUBIT_COORDS', check['idx'], check['pos'])
-
-        # set rec_shift for detectors for the first round
-        rec_curr_shift = 8
-        rec_prev_shift = 8 * (T_sc_pre + 1) + 36 + rec_curr_shift + 16
-
+        # the surgery rounds are written into an instruction buffer and handed to stim in one pass
+        target = circuit
+        circuit = ir.CircuitBuffer()
+        if self.measurements.coords:
+            for check in self.check_list[3:]:
+                circuit.append('QUBIT_COORDS', check['idx'], check['pos'])
 
         # measure the stabilizers
         for t in range(time_shift, time_shift + self.T_lat_surg):
             # initialize flag for check face
             flag_idx_list = [34 + face_check for face_check in self.qrm_face_check]
             circuit.append('H', flag_idx_list)
-            circuit.append('DEPOLARIZE1', flag_idx_list, self.error_rate)
+            circuit.append('DEPOLARIZE1', flag_idx_list, self.error_rate, tag=self.noise_tag)
             circuit.append('TICK')
             CNOT_list = []
             for face_check in self.qrm_face_check:
                 CNOT_list.extend([34 + face_check, 16 + face_check])
             circuit.append('CNOT', CNOT_list)
-            circuit.append("DEPOLARIZE2", CNOT_list, self.error_rate)
+            circuit.append("DEPOLARIZE2", CNOT_list, self.error_rate, tag=self.noise_tag)
             circuit.append('TICK')
 
             # entangle data qubits with ancilla
@@ -101,7 +106,7 @@ class SurgeryUnit:
                         continue
                     CNOT_idx_list.extend([data_qubit, check['idx']])
                 circuit.append('CNOT', CNOT_idx_list)
-                circuit.append("DEPOLARIZE2", CNOT_idx_list, self.error_rate)
+                circuit.append("DEPOLARIZE2", CNOT_idx_list, self.error_rate, tag=self.noise_tag)
                 circuit.append('TICK')
 
             # finalize the flags
@@ -109,80 +114,69 @@ class SurgeryUnit:
             for face_check in self.qrm_face_check:
                 CNOT_list.extend([34 + face_check, 16 + face_check])
             circuit.append('CNOT', CNOT_list)
-            circuit.append("DEPOLARIZE2", CNOT_list, self.error_rate)
+            circuit.append("DEPOLARIZE2", CNOT_list, self.error_rate, tag=self.noise_tag)
             circuit.append('TICK')
             circuit.append('H', flag_idx_list)
-            circuit.append('DEPOLARIZE1', flag_idx_list, self.error_rate)
+            circuit.append('DEPOLARIZE1', flag_idx_list, self.error_rate, tag=self.noise_tag)
             circuit.append('TICK')
 
             # syndrome measurement
             check_idx_list = [check['idx'] for check in self.check_list]
-            circuit.append('X_ERROR', check_idx_list, self.error_rate)
+            circuit.append('X_ERROR', check_idx_list, self.error_rate, tag=self.noise_tag)
             circuit.append('MR', check_idx_list)
+            self.measurements.record(check_idx_list)
             # flag measurement
-            circuit.append('X_ERROR', flag_idx_list, self.error_rate)
+            circuit.append('X_ERROR', flag_idx_list, self.error_rate, tag=self.noise_tag)
             circuit.append('MR', flag_idx_list)
+            self.measurements.record(flag_idx_list)
             circuit.append('TICK')
 
-            # detectors
-            if t == time_shift:
-                for i, check in enumerate(self.check_list[:3]):
-                    mc = [i - rec_curr_shift, check['idx'] - rec_prev_shift]
-                    circuit.append('DETECTOR', [stim.target_rec(c) for c in mc], check['pos'] + [time_shift + t, 1])
-            if t > time_shift:
-                for i, check in enumerate(self.check_list):
-                    circuit.append('DETECTOR', [stim.target_rec(i - 8), stim.target_rec(i - 20)], check['pos'] + [time_shift + t, 1])
-            for i, flag in enumerate(self.flag_list):
-                circuit.append('DETECTOR', [stim.target_rec(i-3)], flag['pos'] + [time_shift + t, 1]) # flag detectors, position not tuned
+            # detectors: the QRM face checks were last measured in the QRM preparation,
+            # the linking checks have no previous measurement in the first round
+            checks = self.check_list[:3] if t == time_shift else self.check_list
+            for check in checks:
+                self.measurements.detector(circuit, self.measurements.rec([check['idx']]) + self.measurements.rec([check['idx']], back=1),
+                                           check['pos'] + [time_shift + t, 1], origin='SurgeryUnit.checks')
+            for flag in self.flag_list:
+                self.measurements.detector(circuit, self.measurements.rec([flag['idx']]), flag['pos'] + [time_shift + t, 1],
+                                           origin='SurgeryUnit.flags') # flag detectors, position not tuned
 
             # surface code checks
             self.sc_code.Z_syndrome_measurement(circuit)
 
             # add detectors except the (-1, 1) X check
-            check_list = [check for check in self.sc_code.check_list if check['type'] == 'Z']
-            check_count = len(check_list)
-            for i_crr, check in enumerate(check_list):
-                if not check['pos'] == [-1, 1]:
-                    rec_crr  = stim.target_rec(-(check_count - i_crr))
-                    rec_prev = stim.target_rec(-(check_count - i_crr) - check_count - 8)
-                    detector_pos = [check['pos'][0], check['pos'][1], t, 2]
-                    circuit.append('DETECTOR', [rec_crr, rec_prev], detector_pos)
+            is_Z = self.sc_code.checks_of_type('Z')
+            for idx, pos in zip(self.sc_code.check_idx[is_Z].tolist(), self.sc_code.check_pos[is_Z].tolist()):
+                if not pos == [-1, 1]:
+                    detector_pos = [pos[0], pos[1], t, 2]
+                    self.measurements.detector(circuit, self.measurements.rec([idx]) + self.measurements.rec([idx], back=1), detector_pos,
+                                               origin='SurgeryUnit.lattice_surgery')
 
         # observable
-        circuit.append('OBSERVABLE_INCLUDE', [stim.target_rec(-8), stim.target_rec(-9)], 0)
+        circuit.append('OBSERVABLE_INCLUDE', self.measurements.rec([self.check_list[4]['idx'], self.check_list[3]['idx']]), 0)
+        target += circuit.to_circuit()
 
     def decouple_after_surgery(self, circuit: stim.Circuit, round):
         """
         Logical X measurement on QRM and one round of stabilizer measurement on surface code to decouple the two codes.
         Handle the combined X-stabilzier.
         """
-        rec_shift = 12 * self.T_lat_surg
-        # rec_shift = 0
         # syndrome measurement of the surface code
         self.sc_code.syndrome_measurement(circuit)
 
         # add detectors except the (-1, 1) X check
-        check_count = len(self.sc_code.check_list)
-        for i_crr, check in enumerate(self.sc_code.check_list):
-            if check['type'] == 'Z':
-                rec_shift = 0
-            else:
-                rec_shift = 12 * self.T_lat_surg
-            if not check['pos'] == [-1, 1]:
-                rec_crr  = stim.target_rec(-(check_count - i_crr))
-                rec_prev = stim.target_rec(-(check_count - i_crr) - check_count - rec_shift)
-                detector_pos = [check['pos'][0], check['pos'][1], round, 2]
-                circuit.append('DETECTOR', [rec_crr, rec_prev], detector_pos)
-
-        rec_shift = 12 * self.T_lat_surg
-        i_crr = 0
-        for i, check in enumerate(self.sc_code.check_list):
-            if check['pos'] == [-1, 1]:
-                i_crr = i
-                break
-        ext_rec_crr = -(check_count - i_crr) - 15
-        ext_rec_prev = -(check_count - i_crr) - check_count - rec_shift - 15
-        ext_stabilizer = [ext_rec_crr, ext_rec_prev]
+        # (Z checks compare with the last surgery round, X checks with the round before the surgery)
+        ext_idx = None
+        for idx, pos in zip(self.sc_code.check_idx.tolist(), self.sc_code.check_pos.tolist()):
+            if pos == [-1, 1]:
+                ext_idx = idx
+                continue
+            detector_pos = [pos[0], pos[1], round, 2]
+            self.measurements.detector(circuit, self.measurements.rec([idx]) + self.measurements.rec([idx], back=1), detector_pos,
+                                       origin='SurgeryUnit.decouple_after_surgery')
+
+        # the (-1, 1) X check joins the first X check of the QRM code
+        ext_stabilizer = [(ext_idx, 0), (ext_idx, 1)]
 
         # measure logical X of the QRM code
         self.qrm_code.X_measurement(circuit, ext_stabilizer)
\ No newline at end of file
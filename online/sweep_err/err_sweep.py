@@ -1,5 +1,7 @@
 import stim
 import src.magic as magic# 假设这是你自定义的库
+import src.noise as noise
+import src.cache as cache_lib
 import sinter
 import numpy as np
 from typing import List
@@ -14,18 +16,25 @@ ERROR_RATE = 1e-6
 
 if __name__ == "__main__":
     tasks = []
-    
+
+    # 电路缓存在磁盘上, 重复运行或中断后继续时不再重新生成
+    cache = cache_lib.CircuitCache('circuit_cache')
+    skeletons = {}
+
+    def instantiate(t, error_rate):
+        # 每个 t 只构造一次带噪声标签的线路骨架，每个错误率只替换噪声参数 (仅在缓存未命中时)
+        if t not in skeletons:
+            skeletons[t] = noise.NoiseSkeleton(
+                magic.magic_preparation(T=T, T_lat_surg=3, t_round=t, error_rate=1e-3, noise_tags=True))
+        return skeletons[t].instantiate(error_rate)
+
     # 遍历参数 T_BEFORE_GROW (从 1 到 10)
     for logerr in np.linspace(-6, -3, 10):
         err = 10**logerr
         for t in [6,7]:
-            # 1. 生成 Circuit (使用当前的 t_maintain)
-            circuit = magic.magic_preparation(
-                T=T,
-                T_lat_surg=3,
-                t_round=t,
-                error_rate=err
-            )
+            # 1. 生成 Circuit
+            point = dict(T=T, T_lat_surg=3, t_round=t, error_rate=err)
+            circuit = cache.circuit(magic.magic_preparation, point, build=lambda: instantiate(t, err))
 
             # 2. 从该 Circuit 生成 Mask
             # psmask = sinter.post_selection_mask_from_4th_coord(circuit)
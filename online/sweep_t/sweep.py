@@ -22,7 +22,9 @@ if __name__ == "__main__":
             T=T,
             T_lat_surg=3,
             t_round=t,
-            error_rate=ERROR_RATE
+            error_rate=ERROR_RATE,
+            # 稳定子测量轮以 REPEAT 块输出: stim 折叠循环, 每个 t 的 DEM 只需分析约一轮, 而不是整条电路
+            repeat=True,
         )
 
         # 2. 从该 Circuit 生成 Mask
@@ -0,0 +1,33 @@
+import hashlib
+import sys
+
+import src.magic as magic
+
+# 基线 (重构之前的 magic_preparation) 生成的线路文本的 sha256 前 16 位
+# 参数顺序: T, T_lat_surg, t_round, error_rate
+BASELINE = [
+    ((1, 3, 1, 0.001), 'eb455930e79c396d'),
+    ((2, 3, 2, 0.001), '219603e200b41071'),
+    ((0, 4, 3, 0.0005), '439e3b3917c58b16'),
+    ((1, 3, 1, 0.0), 'ef8dd8b2439333fb'),
+]
+
+
+def text_hash(circuit):
+    return hashlib.sha256(str(circuit).encode()).hexdigest()[:16]
+
+
+if __name__ == "__main__":
+    # 默认参数 (不开 repeat / noise_tags / lean 等选项) 生成的线路必须与基线逐字节相同
+    failed = []
+    for args, expected in BASELINE:
+        got = text_hash(magic.magic_preparation(*args))
+        status = "ok" if got == expected else "MISMATCH"
+        print(f"magic_preparation{args}: {got} ({status})")
+        if got != expected:
+            failed.append(args)
+
+    if failed:
+        print(f">> FAIL: {len(failed)} default builds differ from the baseline.")
+        sys.exit(1)
+    print(">> PASSED: default builds match the baseline byte for byte.")
@@ -68,7 +68,8 @@ T_BEFORE_GROW=1 # should be at least 1 to read out the combined X check
 if __name__ == "__main__":
     # 1. 生成线路
     print("Generating circuit...")
-    circuit = magic.magic_preparation(
+    # 同时得到 detector 索引 (stage, 位置, 轮次, 来源), 用于定位出错的 detector
+    circuit, index = magic.magic_detectors(
         T=6,
         T_lat_surg=T_LAT_SURG,
         t_round=8,
@@ -126,5 +127,8 @@ if __name__ == "__main__":
             print(f"\n[Distance 2 Error Pairs Found] ({len(d2_pairs)} pairs):")
             for pair in d2_pairs:
                 print(f"  {pair[0]} <---> {pair[1]}")
+                ids = [int(d[1:]) for d in pair[0]]
+                for d, stage, origin, (x, y, t) in zip(ids, index.stage_of(ids), index.origin_of(ids), index.coords(ids).tolist()):
+                    print(f"      D{d}: stage={stage}, pos=({x:g}, {y:g}), round={t:g}, from {origin}")
     else:
         print("\n>> PASSED: No distance 1 or 2 errors found. Distance >= 3.")
\ No newline at end of file
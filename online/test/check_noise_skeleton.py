@@ -0,0 +1,26 @@
+import sys
+
+import src.magic as magic
+import src.noise as noise
+
+# 骨架线路的参数, 参数顺序: T, T_lat_surg, t_round
+SCHEDULES = [(1, 3, 1), (2, 3, 2), (0, 4, 3)]
+# 包括有效数字多于 6 位的错误率 (stim 的文本输出只保留 6 位)
+ERROR_RATES = [0.0, 0.0005, 0.001, 0.0018643565, 0.003]
+
+if __name__ == "__main__":
+    # NoiseSkeleton.instantiate(p) 必须与直接以错误率 p 生成的线路完全相同 (包括噪声参数的每一位)
+    failed = []
+    for schedule in SCHEDULES:
+        for repeat in (False, True):
+            skeleton = noise.NoiseSkeleton(magic.magic_preparation(*schedule, 0.001, noise_tags=True, repeat=repeat))
+            for error_rate in ERROR_RATES:
+                direct = magic.magic_preparation(*schedule, error_rate, repeat=repeat)
+                if skeleton.instantiate(error_rate) != direct:
+                    failed.append((schedule, repeat, error_rate))
+                    print(f">> Mismatch: {schedule} repeat={repeat} error_rate={error_rate}")
+
+    if failed:
+        print(f">> FAIL: {len(failed)} instantiated skeletons differ from the direct builds.")
+        sys.exit(1)
+    print(">> PASSED: instantiated skeletons equal the direct builds.")
@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import stim
+
+import src.magic as magic
+import src.sparse_dem as sparse_dem
+
+
+def same_sparse(a, b):
+    # 逐个比较 CSC 数组和概率 (概率必须逐位相同, 不允许舍入)
+    return (a.H.shape == b.H.shape and a.L.shape == b.L.shape
+            and np.array_equal(a.H.indptr, b.H.indptr) and np.array_equal(a.H.indices, b.H.indices)
+            and np.array_equal(a.L.indptr, b.L.indptr) and np.array_equal(a.L.indices, b.L.indices)
+            and np.array_equal(a.p, b.p))
+
+
+def dem_errors(dem):
+    # DEM 中每个 error 指令的 (概率, detectors, observables), 同一 detector 出现两次则抵消
+    errors = []
+    for inst in dem.flattened():
+        if inst.type != 'error':
+            continue
+        dets, obs = set(), set()
+        for t in inst.targets_copy():
+            if t.is_relative_detector_id():
+                dets ^= {t.val}
+            elif t.is_logical_observable_id():
+                obs ^= {t.val}
+        errors.append((inst.args_copy()[0], sorted(dets), sorted(obs)))
+    return errors
+
+
+def sparse_errors(dem):
+    H, L = dem.H.tocsc(), dem.L.tocsc()
+    return [(float(dem.p[k]), H.indices[H.indptr[k]:H.indptr[k + 1]].tolist(), L.indices[L.indptr[k]:L.indptr[k + 1]].tolist())
+            for k in range(dem.num_errors)]
+
+
+DEMS = {
+    'magic(1, 3, 1)': magic.magic_preparation(1, 3, 1, 0.0018643565).detector_error_model(),
+    'magic(2, 3, 2) repeat': magic.magic_preparation(2, 3, 2, 0.001, repeat=True).detector_error_model(),
+    'hand-written': stim.DetectorErrorModel("""
+        error(0.123456789012345) D0 D1 D1 ^ D2 L0
+        error(1e-17) D3
+        error(0.5) L1
+        repeat 2 {
+            error(0.25) D0
+            shift_detectors 4
+        }
+        detector D12
+    """),
+    'no errors': stim.DetectorErrorModel("detector D2"),
+}
+
+if __name__ == "__main__":
+    # .sdem 文件的保存和读取必须完全可逆: 矩阵和概率与原 DEM 相同, 再次保存得到相同的字节
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, dem in DEMS.items():
+            path, again = os.path.join(tmp, 'dem.sdem'), os.path.join(tmp, 'again.sdem')
+            sparse_dem.save(dem, path)
+            loaded = sparse_dem.load(path)
+            sparse_dem.save(loaded, again)
+            with open(path, 'rb') as f, open(again, 'rb') as g:
+                same_bytes = f.read() == g.read()
+            problems = []
+            if (loaded.num_detectors, loaded.num_observables) != (dem.num_detectors, dem.num_observables):
+                problems.append(f"shape {loaded.num_detectors}x{loaded.num_observables}")
+            if not same_sparse(loaded, sparse_dem.dem_to_sparse(dem)):
+                problems.append("loaded arrays != dem_to_sparse")
+            if sparse_errors(loaded) != dem_errors(dem):
+                problems.append("loaded errors != DEM errors")
+            if not same_bytes:
+                problems.append("saving the loaded DEM gives different bytes")
+            del loaded  # 关闭 memmap, 以便删除临时目录
+            if problems:
+                failed.append(name)
+                print(f">> Mismatch: {name}: {'; '.join(problems)}")
+            else:
+                print(f"{name}: {dem.num_detectors} detectors, {len(dem_errors(dem))} errors (ok)")
+
+    if failed:
+        print(f">> FAIL: {len(failed)} DEMs do not round-trip through .sdem files.")
+        sys.exit(1)
+    print(">> PASSED: .sdem files round-trip exactly.")